@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+""" Compares decoding a pokemons response fully against the projecting decoders
+
+    python3 benchmarks/bench_decode.py [--pokemons 5000] [--captured response.json]
+
+Without a captured response a synthetic one with the same shape as the
+real endpoint (~40 fields per pokemon) is used. Every decoder runs with
+none, 90% and all of the encounters already known, which is the usual
+case between two polls.
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ored-tg-bot'))
+from decode import DECODERS, FIELDS, decode_pokemons
+
+ROUNDS = 20
+
+
+def make_response(count: int) -> bytes:
+
+    now = int(time.time() * 1000)
+    pokes = []
+
+    for i in range(count):
+        pokes.append({
+            'encounter_id': str(10 ** 18 + i), 'spawnpoint_id': f'{i:x}', 'pokemon_id': i % 649 + 1,
+            'pokemon_name': f'Pokemon {i % 649}', 'pokemon_rarity': 'Common', 'pokemon_types': [{'type': 'Grass', 'color': '#78c84f'}],
+            'latitude': 52.6 + random.random() / 10, 'longitude': 13.1 + random.random() / 10,
+            'disappear_time': now + random.randint(60, 1800) * 1000, 'first_seen_timestamp': now, 'last_modified': now,
+            'is_verified_despawn': random.random() > 0.5, 'individual_attack': random.randint(0, 15),
+            'individual_defense': random.randint(0, 15), 'individual_stamina': random.randint(0, 15),
+            'move_1': 214, 'move_2': 118, 'weight': 6.5, 'height': 0.7, 'cp': random.randint(10, 3000),
+            'cp_multiplier': 0.7317, 'level': random.randint(1, 35), 'gender': 1, 'form': 0, 'costume': 0,
+            'weather_boosted_condition': 0, 'atk_iv_pct': 100, 'pvp_rankings_great_league': None,
+            'pvp_rankings_ultra_league': None, 'capture_1': 0.3, 'capture_2': 0.4, 'capture_3': 0.5,
+            'shiny': 0, 'display_pokemon_id': None, 'size': 2, 'encounter_source': 'wild',
+        })
+
+    return json.dumps({'pokemons': pokes, 'timestamp': now // 1000}).encode()
+
+
+def old_path(body: bytes, is_known) -> list:
+    """ What __get_data did before: full decode, dicts all the way """
+
+    return [poke for poke in json.loads(body)['pokemons'] if not is_known(poke.get('encounter_id', ''))]
+
+
+def measure(func, body: bytes, is_known):
+    """ Returns (ms per call, peak kB, allocated blocks, results) """
+
+    tracemalloc.start()
+    result = func(body, is_known)
+    _, peak = tracemalloc.get_traced_memory()
+    snapshot = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+
+    blocks = sum(stat.count for stat in snapshot.statistics('filename'))
+
+    started = time.perf_counter()
+    for _ in range(ROUNDS):
+        func(body, is_known)
+    elapsed = (time.perf_counter() - started) / ROUNDS
+
+    return elapsed * 1000, peak / 1024, blocks, len(result)
+
+
+def main() -> None:
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--pokemons', type=int, default=5000, help='size of the synthetic response')
+    parser.add_argument('--captured', help='a raw_data response to decode instead')
+    args = parser.parse_args()
+
+    if args.captured:
+        with open(args.captured, 'rb') as captured:
+            body = captured.read()
+    else:
+        body = make_response(args.pokemons)
+
+    ids = [str(poke['encounter_id']) for poke in json.loads(body)['pokemons']]
+    print(f'{len(ids)} pokemons, {len(body) / 1024:.0f}kB, projecting {len(FIELDS)} fields\n')
+
+    candidates = [('dicts (old)', old_path)]
+    candidates += [(name, lambda body, is_known, name=name: DECODERS[name](body, is_known, print)) for name in DECODERS]
+    candidates += [(f'scan + {name}', lambda body, is_known, name=name: decode_pokemons(body, is_known, name)) for name in DECODERS]
+
+    print(f'{"known":>6} {"decoder":<16} {"time":>10} {"peak":>10} {"blocks":>8} {"new":>6}')
+
+    for share in (0.0, 0.9, 1.0):
+        known = set(ids[:int(len(ids) * share)])
+
+        for name, func in candidates:
+            ms, peak, blocks, new = measure(func, body, known.__contains__)
+            print(f'{share:>6.0%} {name:<16} {ms:>8.2f}ms {peak:>8.0f}kB {blocks:>8} {new:>6}')
+        print()
+
+
+if __name__ == '__main__':
+    main()
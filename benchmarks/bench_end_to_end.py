@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+""" Drives OredScraper and reader.work end to end against the local fakes
+
+    python3 benchmarks/bench_end_to_end.py [--seconds 20] [--regions 4] [--chats 10] ...
+    python3 benchmarks/bench_end_to_end.py --replay captured1.json captured2.json
+
+The scraper polls a fake map server (see fakes.py) and delivers to a fake
+Telegram api with flood control, the RSS reader polls a fake feed. Reported
+are throughput, the latency from an encounter being served first until its
+message arrived at "Telegram", and memory. Nothing leaves 127.0.0.1.
+"""
+
+import argparse
+import asyncio
+import os
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+from typing import List
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.append(ROOT)
+sys.path.append(os.path.join(ROOT, 'ored-tg-bot'))
+sys.path.append(os.path.join(ROOT, 'psa-rss-bot'))
+
+from fakes import NAME_PATTERN, FakeFeed, FakeMapServer, FakeTelegram
+
+
+def percentiles(values: List[float], points=(50, 95, 99)) -> str:
+
+    if not values:
+        return 'n/a'
+
+    values = sorted(values)
+    return ', '.join(f'p{p} {values[min(len(values) - 1, int(len(values) * p / 100))] * 1000:.0f}ms' for p in points)
+
+
+def max_rss_mb() -> float:
+    # kB on linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 / (1024 if sys.platform == 'darwin' else 1)
+
+
+def bench_scraper(args, telegram: FakeTelegram) -> None:
+
+    replay = []
+    for path in args.replay:
+        with open(path, 'rb') as captured:
+            replay.append(captured.read())
+
+    site = FakeMapServer(pokes=args.pokes, new=args.new, latency=args.map_latency, replay=replay).start()
+
+    # the scraper reads its endpoint from the bot's secrets.py, this one points at the fake
+    sys.modules['secrets'] = types.SimpleNamespace(DOMAIN=site.url, API_ENDPOINT='raw_data')
+
+    from regions import Region
+    from scraper import OredScraper
+
+    regions = [ Region(f'bench{i}', 52.0 + i * 0.1, 13.0, 52.05 + i * 0.1, 13.1, args.delay) for i in range(args.regions) ]
+
+    scraper = OredScraper(telegram.bot(), chat_id='1', delay=args.delay, regions=regions, delay_bounds=(args.delay, args.delay), digest=args.digest)
+    for chat in range(args.chats):
+        scraper.subscribe(str(100 + chat), args.filters)
+
+    if args.trace_memory:
+        tracemalloc.start()
+
+    started = time.monotonic()
+    scraper.start()
+    time.sleep(args.seconds)
+    elapsed = time.monotonic() - started
+
+    # gives queued messages a few seconds to go out
+    scraper.stop()
+    stopping = time.monotonic() - started - elapsed
+
+    traced = tracemalloc.get_traced_memory()[1] if args.trace_memory else None
+    if args.trace_memory:
+        tracemalloc.stop()
+
+    latencies = []
+    for received, chat_id, text in telegram.messages:
+        for enc_id in NAME_PATTERN.findall(text):
+            if enc_id in site.first_served:
+                latencies.append(received - site.first_served[enc_id])
+
+    announced = len(site.first_served)
+    stats = scraper.get_sender_stats()
+
+    print(f'scraper: {args.regions} region(s) every {args.delay}s, {args.chats} chat(s), {elapsed:.1f}s (+{stopping:.1f}s to stop)')
+    print(f'  map:       {site.requests} polls ({site.requests / elapsed:.1f}/s), {site.bytes_served / elapsed / 1024:.0f}kB/s, {announced} new encounters')
+    print(f'  telegram:  {telegram.calls} calls, {telegram.flood_limited} flood limited (429), {len(telegram.messages)} messages, {len(telegram.locations)} locations')
+    print(f'  sender:    sent {stats["sent"]}, failed {stats["failed"]}, dropped {stats["dropped"]}, retried {stats["retried"]}, {stats["queued"]} still queued')
+    print(f'  latency:   served -> delivered {percentiles(latencies)}')
+    print(f'  memory:    dedup {scraper.get_pokes_db_size()} entries, max rss {max_rss_mb():.0f}MB' + (f', traced peak {traced / 1024 / 1024:.1f}MB' if traced else ''))
+
+
+def bench_reader(args, telegram: FakeTelegram) -> None:
+
+    feed_site = FakeFeed(items=args.feed_items, change_rate=args.change_rate).start()
+
+    # reader.py logs to ./rss.log and wants its chat at import time
+    os.environ.setdefault('TELEGRAM_CHAT_MYSELF_ID', '2')
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)
+        try:
+            import reader
+        finally:
+            os.chdir(cwd)
+
+        import logging
+        reader.log.setLevel(logging.WARNING)
+
+        import aiohttp
+
+        failed = []
+
+        async def run() -> List[float]:
+
+            feed = reader.Feed('bench', f'{feed_site.url}/feed', 60, os.path.join(tmp, 'rss.db'))
+            bot = telegram.bot()
+            durations = []
+
+            async with aiohttp.ClientSession() as session:
+                for _ in range(args.polls):
+                    started = time.monotonic()
+                    try:
+                        await reader.work(bot, session, feed)
+                    except Exception as err:
+                        # like reader.poll, a failed send only loses this poll
+                        failed.append(type(err).__name__)
+                    durations.append(time.monotonic() - started)
+
+            feed.store.close()
+            return durations
+
+        started = time.monotonic()
+        durations = asyncio.run(run())
+        elapsed = time.monotonic() - started
+
+    print(f'reader: {args.polls} polls of {args.feed_items} items, {elapsed:.1f}s ({args.polls / elapsed:.1f} polls/s)')
+    print(f'  feed:      {feed_site.requests - feed_site.not_modified} changed or refetched, {feed_site.not_modified} not modified (304)')
+    print(f'  telegram:  {len(telegram.messages)} messages, {telegram.flood_limited} flood limited (429), {len(failed)} poll(s) failed: {sorted(set(failed))}')
+    print(f'  latency:   per poll {percentiles(durations)}')
+    print(f'  memory:    max rss {max_rss_mb():.0f}MB')
+
+
+def main() -> None:
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--seconds', type=float, default=20)
+    parser.add_argument('--regions', type=int, default=4)
+    parser.add_argument('--delay', type=float, default=1, help='poll interval of every region')
+    parser.add_argument('--chats', type=int, default=10)
+    parser.add_argument('--filters', default='iv=80')
+    parser.add_argument('--digest', type=int, default=0, help='combine bursts of that many encounters into one message')
+    parser.add_argument('--pokes', type=int, default=200, help='encounters per response')
+    parser.add_argument('--new', type=int, default=5, help='new encounters per response')
+    parser.add_argument('--map-latency', type=float, default=0.05)
+    parser.add_argument('--replay', nargs='*', default=[], help='recorded raw_data responses to serve instead')
+    parser.add_argument('--tg-rate', type=float, default=30, help='global Telegram calls per second before 429s')
+    parser.add_argument('--tg-chat-rate', type=float, default=1)
+    parser.add_argument('--tg-latency', type=float, default=0.02)
+    parser.add_argument('--polls', type=int, default=50, help='feed polls of the reader')
+    parser.add_argument('--feed-items', type=int, default=50)
+    parser.add_argument('--change-rate', type=float, default=0.5)
+    parser.add_argument('--trace-memory', action='store_true', help='tracemalloc the scraper (slow)')
+    parser.add_argument('--only', choices=('scraper', 'reader'))
+    args = parser.parse_args()
+
+    if args.only != 'reader':
+        bench_scraper(args, FakeTelegram(args.tg_rate, args.tg_chat_rate, latency=args.tg_latency).start())
+        print()
+
+    if args.only != 'scraper':
+        # the reader sends to a single chat way faster than once per second here, only limit it globally
+        bench_reader(args, FakeTelegram(args.tg_rate, args.tg_rate, latency=args.tg_latency).start())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+""" Filtering throughput of compiled filters on large encounter batches
+
+    python3 benchmarks/bench_filters.py [--encounters 100000] [--subscribers 100]
+
+Every expression runs through a plain AST interpreter (what evaluating
+the parsed filter would cost without compiling it), the compiled
+predicate and, if numpy is installed, the vectorized mask. The mask is
+measured with and without building the columns, since the columns are
+shared by every filter of a batch. Finally a SubscriptionIndex routes
+the batch to many chats with different filters.
+"""
+
+import argparse
+import math
+import os
+import random
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ored-tg-bot'))
+from decode import Encounter
+from filters import ATTRIBUTES, OPERATORS, Columns, compile_filter, haversine_km, np, parse, to_expression
+from subscriptions import SubscriptionIndex
+
+EXPRESSIONS = [
+    'iv=97&exiv=113,149',
+    'iv >= 90 and (species in {113, 149, 242} or cp > 2500) and verified',
+    'not species in {16, 19, 41} and remaining > 300 and dist(52.52, 13.40) < 2.5',
+    'iv in 82..100 and level >= 25 and remaining in 120..1800',
+]
+
+ROUNDS = 5
+
+
+def make_batch(count: int, now: float):
+
+    batch = []
+
+    for i in range(count):
+        scanned = random.random() > 0.2
+        iv = lambda: random.randint(0, 15) if scanned else None
+
+        batch.append(Encounter(
+            str(10 ** 18 + i), random.randint(1, 649), f'Pokemon {i % 649}',
+            iv(), iv(), iv(), random.randint(1, 35) if scanned else None, random.randint(10, 3000) if scanned else None,
+            int(now * 1000) + random.randint(0, 1800) * 1000, random.random() > 0.5,
+            52.4 + random.random() * 0.25, 13.1 + random.random() * 0.5
+        ))
+
+    return batch
+
+
+def interpret(node: tuple, e: Encounter, now: float) -> bool:
+    """ Walks the AST for every encounter, the baseline """
+
+    kind = node[0]
+
+    if kind == 'and':
+        return interpret(node[1], e, now) and interpret(node[2], e, now)
+    if kind == 'or':
+        return interpret(node[1], e, now) or interpret(node[2], e, now)
+    if kind == 'not':
+        return not interpret(node[1], e, now)
+    if kind == 'verified':
+        return e.is_verified_despawn is True
+
+    operand = node[1]
+    if operand == 'iv':
+        value = None if e.individual_attack is None else (e.individual_attack + e.individual_defense + e.individual_stamina) / 45 * 100
+    elif operand == 'remaining':
+        value = e.disappear_time / 1000 - now
+    elif isinstance(operand, tuple):
+        value = haversine_km(e.latitude, e.longitude, operand[1], operand[2])
+    else:
+        value = getattr(e, ATTRIBUTES[operand])
+
+    if value is None:
+        return False
+    if kind == 'cmp':
+        return OPERATORS[node[2]](value, node[3])
+    if kind == 'range':
+        return node[2] <= value <= node[3]
+    return value in node[2]
+
+
+def throughput(func, count: int) -> float:
+    """ Returns encounters per second, best of ROUNDS """
+
+    best = math.inf
+    for _ in range(ROUNDS):
+        started = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - started)
+
+    return count / best
+
+
+def main() -> None:
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--encounters', type=int, default=100_000, help='encounters in the batch')
+    parser.add_argument('--subscribers', type=int, default=100, help='chats the batch is routed to')
+    args = parser.parse_args()
+
+    count = args.encounters
+    subscribers = args.subscribers
+
+    now = time.time()
+    batch = make_batch(count, now)
+
+    print(f'{count} encounters per batch, numpy {"available" if np is not None else "missing"}\n')
+    print(f'{"interpreted":>12} {"compiled":>12} {"mask+cols":>12} {"mask":>12} {"matches":>8}  filter')
+
+    for text in EXPRESSIONS:
+        flt = compile_filter(text)
+        node = parse(to_expression(text))
+
+        matches = sum(1 for e in batch if flt.predicate(e, now))
+
+        interpreted = throughput(lambda: [e for e in batch if interpret(node, e, now)], count)
+        compiled = throughput(lambda: [e for e in batch if flt.predicate(e, now)], count)
+
+        if flt.mask is not None:
+            assert int(flt.mask(Columns(batch), now).sum()) == matches
+            with_columns = throughput(lambda: flt.mask(Columns(batch), now), count)
+            columns = Columns(batch)
+            flt.mask(columns, now)
+            mask_only = throughput(lambda: flt.mask(columns, now), count)
+            vectorized = f'{with_columns / 1e6:>10.2f}M {mask_only / 1e6:>10.2f}M'
+        else:
+            vectorized = f'{"-":>11} {"-":>11}'
+
+        print(f'{interpreted / 1e6:>10.2f}M {compiled / 1e6:>10.2f}M {vectorized} {matches:>8}  {text}')
+
+    # many chats, a handful of distinct filters, like real subscriptions
+    index = SubscriptionIndex()
+    for chat_id in range(subscribers):
+        iv = random.choice((80, 90, 95, 97, 100))
+        index.subscribe(str(chat_id), compile_filter(random.choice((
+            f'iv={iv}&exiv=113,149', f'iv >= {iv} and verified', f'iv >= {iv} or dist(52.52, 13.40) < 1'
+        ))))
+
+    routed = index.route(batch, now)
+    print(f'\nrouting to {subscribers} chats: {throughput(lambda: index.route(batch, now), count) / 1e6:.2f}M encounters/s, '
+          f'{sum(len(encs) for encs in routed.values())} messages')
+
+    small = batch[:50]
+    print(f'routing polls of {len(small)}: {throughput(lambda: index.route(small, now), len(small)) / 1e6:.2f}M encounters/s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+""" Compares the BeautifulSoup and the streaming feed parser on synthetic feeds
+
+    python3 benchmarks/bench_rss_parse.py [--items 100 1000 5000]
+
+For every feed size this measures parsing all items with both parsers and
+the streaming parser stopping after the 10 newest items, the way the
+reader does once it reaches an already known article.
+"""
+
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+from itertools import islice
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'psa-rss-bot'))
+from feed import FeedStream, parse_soup
+
+CHUNK_SIZE = 16 * 1024
+NEW_ITEMS = 10
+
+
+def make_feed(items: int) -> bytes:
+    """ Builds a WordPress-like feed with `items` items, newest first """
+
+    parts = [
+        '<?xml version="1.0" encoding="UTF-8"?>',
+        '<rss version="2.0" xmlns:content="http://purl.org/rss/1.0/modules/content/" xmlns:dc="http://purl.org/dc/elements/1.1/">',
+        '<channel><title>Bench</title><link>https://example.org</link>',
+        '<lastBuildDate>Sat, 17 Oct 2026 12:00:00 +0000</lastBuildDate>',
+    ]
+
+    for i in range(items, 0, -1):
+        parts.append(
+            f'<item><title><![CDATA[Some.Show.S01E{i % 100:02d} [1080p] (x265) & more]]></title>'
+            f'<link>https://example.org/?p={i}</link>'
+            f'<dc:creator><![CDATA[someone]]></dc:creator>'
+            f'<pubDate>Sat, 17 Oct 2026 {i % 24:02d}:{i % 60:02d}:00 +0000</pubDate>'
+            f'<category><![CDATA[TV]]></category><category><![CDATA[x265]]></category><category><![CDATA[2026]]></category>'
+            f'<guid isPermaLink="false">https://example.org/?p={i}</guid>'
+            f'<description><![CDATA[{"Lorem ipsum dolor sit amet. " * 10}]]></description>'
+            f'<content:encoded><![CDATA[<p>{"Lorem ipsum dolor sit amet, consectetur adipiscing elit. " * 40}</p>]]></content:encoded>'
+            '</item>'
+        )
+
+    parts.append('</channel></rss>')
+    return '\n'.join(parts).encode('utf-8')
+
+
+def chunked(content: bytes):
+    for start in range(0, len(content), CHUNK_SIZE):
+        yield content[start:start + CHUNK_SIZE]
+
+
+def run_soup(content: bytes) -> int:
+    _, items = parse_soup(content)
+    return len(items)
+
+
+def run_stream(content: bytes, limit: int=None) -> int:
+    stream = FeedStream(chunked(content))
+    stream.read_header()
+    return sum(1 for _ in islice(stream, limit))
+
+
+def measure(func, *args):
+    """ Returns (seconds, peak bytes allocated, result) """
+
+    # the traced run doubles as warm up (lazy imports etc)
+    tracemalloc.start()
+    func(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    started = time.perf_counter()
+    result = func(*args)
+    elapsed = time.perf_counter() - started
+
+    return elapsed, peak, result
+
+
+def main() -> None:
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--items', type=int, nargs='+', default=[100, 1000, 5000], help='feed sizes to parse')
+    sizes = parser.parse_args().items
+
+    print(f'{"items":>6} {"feed":>9} {"parser":<16} {"time":>9} {"peak mem":>10} {"items":>6}')
+
+    for size in sizes:
+        content = make_feed(size)
+
+        for name, func, args in [
+            ('soup', run_soup, (content,)),
+            ('stream', run_stream, (content,)),
+            (f'stream (new {NEW_ITEMS})', run_stream, (content, NEW_ITEMS)),
+        ]:
+            elapsed, peak, count = measure(func, *args)
+            print(f'{size:>6} {len(content) / 1024:>7.0f}kB {name:<16} {elapsed * 1000:>7.1f}ms {peak / 1024:>8.0f}kB {count:>6}')
+
+
+if __name__ == '__main__':
+    main()
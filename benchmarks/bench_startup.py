@@ -0,0 +1,153 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+""" Measures how fast bot.py comes up: import cost and time until it answers
+
+    python3 benchmarks/bench_startup.py [--runs 5] [--top 10]
+
+Every run starts the bot in a fresh interpreter, with a secrets.py that
+points it at the fake Telegram api (see fakes.py) where a /ping and a /size
+are waiting already. Reported are the time `import bot` takes and its
+slowest imports (`python -X importtime`), and the time from starting the
+process until each command was answered. /size needs the scraper, which is
+loaded in the background, /ping doesnt. Nothing leaves 127.0.0.1.
+"""
+
+import argparse
+import os
+import re
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, List, Optional, Tuple
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+BOT_DIR = os.path.join(ROOT, 'ored-tg-bot')
+sys.path.append(ROOT)
+
+from fakes import FakeTelegram
+
+SECRETS = '''
+BOT_AUTH_TOKEN = '123:fake'
+BOT_MYSELF_CHAT_ID = 1
+BOT_API_URL = '{url}/bot'
+DOMAIN = 'http://127.0.0.1:9'
+API_ENDPOINT = 'raw_data'
+REGIONS = []
+AREA = []
+POSITION = None
+SPEED_KMH = 15
+METRICS_PORT = 0
+METRICS_TEXTFILE = ''
+DIGEST = 0
+LOG_PATH = ''
+STORE_PATH = ''
+WORKERS = 0
+HISTORY_PATH = ''
+WEBHOOK_URL = ''
+WEBHOOK_LISTEN = '127.0.0.1'
+WEBHOOK_PORT = 8443
+WEBHOOK_SECRET = ''
+'''
+
+# the fake secrets.py goes first, a real one next to bot.py must not be picked up
+PRELUDE = 'import sys; sys.path[:0] = [{secrets!r}, {bot_dir!r}]; '
+
+IMPORT_LINE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|( +)(\S+)')
+
+# command -> start of its answer
+COMMANDS = { '/ping': 'pong', '/size': 'Pokes in db' }
+
+
+def import_times(prelude: str) -> Tuple[float, List[Tuple[int, str]]]:
+    """ Seconds `import bot` took, and the cumulative µs of its direct imports """
+
+    code = prelude + 'import time; started = time.perf_counter(); import bot; print(time.perf_counter() - started)'
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], capture_output=True, text=True, check=True)
+
+    imports = []
+    for line in result.stderr.splitlines():
+        match = IMPORT_LINE.match(line)
+        # bot itself is at depth 1, what it imports at depth 2
+        if match and len(match[3]) == 3:
+            imports.append((int(match[2]), match[4]))
+
+    return float(result.stdout.split()[-1]), sorted(imports, reverse=True)
+
+
+def first_answers(directory: str, timeout: float=60) -> Dict[str, Optional[float]]:
+    """ Seconds from starting the bot until every command was answered, None if it wasnt """
+
+    telegram = FakeTelegram(global_rate=1000, chat_rate=1000).start()
+    for command in COMMANDS:
+        telegram.push(command)
+
+    with open(os.path.join(directory, 'secrets.py'), 'w') as f:
+        f.write(SECRETS.format(url=telegram.url))
+
+    started = time.monotonic()
+    bot = subprocess.Popen(
+        [sys.executable, '-c', PRELUDE.format(secrets=directory, bot_dir=BOT_DIR) + 'import bot; bot.main()'],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+
+    answers: Dict[str, Optional[float]] = { command: None for command in COMMANDS }
+
+    try:
+        while None in answers.values() and time.monotonic() - started < timeout:
+            for received, _, text in list(telegram.messages):
+                for command, answer in COMMANDS.items():
+                    if answers[command] is None and text.startswith(answer):
+                        answers[command] = received - started
+            time.sleep(0.005)
+    finally:
+        bot.send_signal(signal.SIGINT)
+        try:
+            bot.wait(10)
+        except subprocess.TimeoutExpired:
+            bot.kill()
+        telegram.stop()
+
+    return answers
+
+
+def main() -> None:
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=10, help='slowest imports to show')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        prelude = PRELUDE.format(secrets=directory, bot_dir=BOT_DIR)
+
+        # only the import, first_answers writes the real url into it
+        with open(os.path.join(directory, 'secrets.py'), 'w') as f:
+            f.write(SECRETS.format(url='http://127.0.0.1:9'))
+
+        durations = []
+        for _ in range(args.runs):
+            duration, imports = import_times(prelude)
+            durations.append(duration)
+
+        print(f'import bot: {statistics.median(durations) * 1000:.0f}ms median of {args.runs}')
+        for micros, name in imports[:args.top]:
+            print(f'  {micros / 1000:7.1f}ms {name}')
+
+        runs: Dict[str, List[float]] = { command: [] for command in COMMANDS }
+        for _ in range(args.runs):
+            for command, seconds in first_answers(directory).items():
+                if seconds is not None:
+                    runs[command].append(seconds)
+
+    print('first answers, from starting the process:')
+    for command, seconds in runs.items():
+        summary = f'{statistics.median(seconds) * 1000:.0f}ms median, {max(seconds) * 1000:.0f}ms max' if seconds else 'never'
+        print(f'  {command:6} {summary} ({len(seconds)} of {args.runs} runs)')
+
+
+if __name__ == '__main__':
+    main()
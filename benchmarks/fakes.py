@@ -0,0 +1,374 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+""" Local stand-ins for the map site, the Telegram bot api and a RSS feed
+
+Every fake is a `ThreadingHTTPServer` on 127.0.0.1 (port 0 picks a free
+one) running in a daemon thread, so the bots can be driven end to end
+without touching the network. They record what they served and received,
+with `time.monotonic()` timestamps comparable to the ones of the process.
+"""
+
+import json
+import random
+import re
+import sys
+import threading
+import time
+from collections import defaultdict, deque
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Deque, Dict, List, Optional, Sequence, Tuple
+from urllib.parse import parse_qs
+
+TOKEN = 'b' * 44
+
+# pokemon names carry the encounter id, so a sent message (or every line of a digest) can be traced back
+NAME_PATTERN = re.compile(r'(?:^|>)P(\d+)[ <]', re.MULTILINE)
+
+
+class _Server(ThreadingHTTPServer):
+
+    daemon_threads = True
+    # the scraper keeps its connections alive, dont let them queue up
+    request_queue_size = 128
+
+    def handle_error(self, request, client_address) -> None:
+        # clients closing their keep-alive connections at shutdown arent worth a traceback
+        if not isinstance(sys.exc_info()[1], (ConnectionResetError, BrokenPipeError)):
+            super().handle_error(request, client_address)
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    fake: '_Fake'
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def _body(self) -> bytes:
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _reply(self, status: int, body: bytes, content_type: str='application/json', headers: Optional[Dict[str, str]]=None) -> None:
+
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self) -> None:
+        self.fake.get(self)
+
+    def do_POST(self) -> None:
+        self.fake.post(self)
+
+
+class _Fake:
+    """ Runs a handler class bound to this fake in a thread """
+
+    def start(self, port: int=0) -> '_Fake':
+
+        handler = type('Handler', (_Handler,), { 'fake': self })
+        self.server = _Server(('127.0.0.1', port), handler)
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}'
+        threading.Thread(target=self.server.serve_forever, name=type(self).__name__, daemon=True).start()
+
+        return self
+
+    def stop(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+
+    def get(self, request: _Handler) -> None:
+        request._reply(404, b'{}')
+
+    def post(self, request: _Handler) -> None:
+        request._reply(404, b'{}')
+
+
+class FakeMapServer(_Fake):
+    """ Serves the token page on / and pokemons on /raw_data
+
+    Synthetic responses hold `pokes` encounters inside the requested box,
+    `new` of them never served before, the rest repeats the last ones of
+    that box. Requests with a `timestamp` only get the ones added after it,
+    like the real endpoint. With `replay` the given recorded response bodies are served
+    in turns instead. `latency` delays every response.
+    """
+
+    def __init__(self, pokes: int=50, new: int=5, latency: float=0.0, replay: Sequence[bytes]=(), ttl: float=900) -> None:
+        self.pokes = pokes
+        self.new = new
+        self.latency = latency
+        self.ttl = ttl
+        self.__replay = list(replay)
+
+        self.__lock = threading.Lock()
+        self.__next_id = 1
+        self.__recent: Dict[Tuple[str, ...], Deque[dict]] = defaultdict(deque)
+
+        self.requests = 0
+        self.bytes_served = 0
+        # encounter id -> when it was served first
+        self.first_served: Dict[str, float] = dict()
+
+    def get(self, request: _Handler) -> None:
+        request._reply(200, f"<html><script>var token = '{TOKEN}';</script></html>".encode(), 'text/html')
+
+    def __make(self, form: Dict[str, List[str]]) -> bytes:
+
+        box = tuple(form.get(key, ['0'])[0] for key in ('swLat', 'swLng', 'neLat', 'neLng'))
+        sw_lat, sw_lng, ne_lat, ne_lng = (float(v) for v in box)
+        now = time.time()
+
+        with self.__lock:
+            recent = self.__recent[box]
+
+            for _ in range(self.new):
+                enc_id = str(self.__next_id)
+                self.__next_id += 1
+
+                recent.append({
+                    'encounter_id': enc_id, 'pokemon_id': random.randint(1, 649), 'pokemon_name': f'P{enc_id}',
+                    'individual_attack': random.randint(0, 15), 'individual_defense': random.randint(0, 15),
+                    'individual_stamina': random.randint(0, 15), 'level': random.randint(1, 35), 'cp': random.randint(10, 3000),
+                    'disappear_time': int((now + self.ttl) * 1000), 'is_verified_despawn': True, 'last_modified': int(now * 1000),
+                    'latitude': random.uniform(sw_lat, ne_lat), 'longitude': random.uniform(sw_lng, ne_lng),
+                    'move_1': 214, 'move_2': 118, 'gender': 1, 'form': 0, 'weather_boosted_condition': 0,
+                })
+
+            while len(recent) > self.pokes:
+                recent.popleft()
+
+            served = time.monotonic()
+            for poke in list(recent)[-self.new:] if self.new else []:
+                self.first_served.setdefault(poke['encounter_id'], served)
+
+            since = int(form.get('timestamp', ['0'])[0] or 0) * 1000
+            pokes = [ poke for poke in recent if poke['last_modified'] > since ]
+
+        return json.dumps({ 'pokemons': pokes, 'timestamp': int(now) }).encode()
+
+    def post(self, request: _Handler) -> None:
+
+        form = parse_qs(request._body().decode())
+
+        if form.get('token', [''])[0] != TOKEN:
+            request._reply(400, b'{"error": "bad token"}')
+            return
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        with self.__lock:
+            self.requests += 1
+            replayed = self.__replay[self.requests % len(self.__replay)] if self.__replay else None
+
+        body = replayed if replayed is not None else self.__make(form)
+        self.bytes_served += len(body)
+
+        request._reply(200, body)
+
+
+class FakeTelegram(_Fake):
+    """ Answers sendMessage, sendLocation and getMe like the bot api
+
+    More than `chat_rate` calls per second for a chat or `global_rate`
+    overall get a 429 with `retry_after`, like Telegram's flood control.
+    Messages queued with `push` are handed out by getUpdates (long polling
+    at most a second), so a whole bot can run against it.
+    """
+
+    def __init__(self, global_rate: float=30, chat_rate: float=1, retry_after: int=1, latency: float=0.0) -> None:
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.retry_after = retry_after
+        self.latency = latency
+
+        self.__lock = threading.Lock()
+        self.__calls: Deque[float] = deque()
+        self.__chat_calls: Dict[str, Deque[float]] = defaultdict(deque)
+        self.__message_id = 0
+        self.__updates: List[dict] = []
+        self.__pushed = threading.Condition(self.__lock)
+
+        self.calls = 0
+        self.flood_limited = 0
+        # (received, chat_id, text) / (received, chat_id, lat, lng)
+        self.messages: List[Tuple[float, str, str]] = []
+        self.locations: List[Tuple[float, str, float, float]] = []
+
+    def __limited(self, chat_id: str, now: float) -> bool:
+        """ Sliding one second window, globally and per chat """
+
+        calls = self.__calls
+        chat_calls = self.__chat_calls[chat_id]
+
+        for window in (calls, chat_calls):
+            while window and now - window[0] > 1:
+                window.popleft()
+
+        if len(calls) >= self.global_rate or len(chat_calls) >= self.chat_rate:
+            return True
+
+        calls.append(now)
+        chat_calls.append(now)
+        return False
+
+    def post(self, request: _Handler) -> None:
+
+        method = request.path.rsplit('/', 1)[-1]
+        body = request._body()
+
+        if request.headers.get('Content-Type', '').startswith('application/json'):
+            params = json.loads(body or b'{}')
+        else:
+            params = { key: values[0] for key, values in parse_qs(body.decode()).items() }
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        if method == 'getUpdates':
+            request._reply(200, json.dumps({ 'ok': True, 'result': self.__get_updates(int(params.get('offset') or 0), float(params.get('timeout') or 0)) }).encode())
+            return
+
+        if method in ('deleteWebhook', 'setWebhook'):
+            request._reply(200, b'{"ok": true, "result": true}')
+            return
+
+        if method == 'getMe':
+            request._reply(200, json.dumps({ 'ok': True, 'result': { 'id': 1, 'is_bot': True, 'first_name': 'Fake', 'username': 'fake_bot' } }).encode())
+            return
+
+        if method not in ('sendMessage', 'sendLocation'):
+            request._reply(404, json.dumps({ 'ok': False, 'error_code': 404, 'description': 'Not Found' }).encode())
+            return
+
+        chat_id = str(params.get('chat_id'))
+        now = time.monotonic()
+
+        with self.__lock:
+            self.calls += 1
+
+            if self.__limited(chat_id, now):
+                self.flood_limited += 1
+                limited = True
+            else:
+                limited = False
+                self.__message_id += 1
+                message_id = self.__message_id
+
+                if method == 'sendMessage':
+                    self.messages.append((now, chat_id, params.get('text', '')))
+                else:
+                    self.locations.append((now, chat_id, float(params['latitude']), float(params['longitude'])))
+
+        if limited:
+            request._reply(429, json.dumps({
+                'ok': False, 'error_code': 429, 'description': f'Too Many Requests: retry after {self.retry_after}',
+                'parameters': { 'retry_after': self.retry_after }
+            }).encode())
+            return
+
+        message = { 'message_id': message_id, 'date': int(time.time()), 'chat': { 'id': int(chat_id) if chat_id.lstrip('-').isdigit() else 0, 'type': 'private' } }
+        if method == 'sendMessage':
+            message['text'] = params.get('text', '')
+        else:
+            message['location'] = { 'latitude': float(params['latitude']), 'longitude': float(params['longitude']) }
+
+        request._reply(200, json.dumps({ 'ok': True, 'result': message }).encode())
+
+    def push(self, text: str, chat_id: int=1) -> None:
+        """ Queues a message from `chat_id` to the bot, commands are marked as such """
+
+        with self.__lock:
+            update_id = len(self.__updates) + 1
+            message = { 'message_id': update_id, 'date': int(time.time()), 'chat': { 'id': chat_id, 'type': 'private' }, 'text': text }
+            if text.startswith('/'):
+                message['entities'] = [{ 'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0]) }]
+
+            self.__updates.append({ 'update_id': update_id, 'message': message })
+            self.__pushed.notify_all()
+
+    def __get_updates(self, offset: int, timeout: float) -> List[dict]:
+
+        with self.__lock:
+            if len(self.__updates) < max(offset, 1):
+                self.__pushed.wait(min(timeout, 1))
+            return self.__updates[max(0, offset - 1):]
+
+    def bot(self, token: str='123:fake', con_pool_size: int=8):
+        """ A python-telegram-bot Bot talking to this fake """
+
+        from telegram import Bot
+        from telegram.utils.request import Request
+
+        return Bot(token, base_url=f'{self.url}/bot', request=Request(con_pool_size=con_pool_size))
+
+
+class FakeFeed(_Fake):
+    """ Serves a WordPress-like feed on /feed with ETag / Last-Modified
+
+    Every request publishes `new` more items with probability `change_rate`,
+    conditional requests for an unchanged feed get a 304.
+    """
+
+    def __init__(self, items: int=50, new: int=2, change_rate: float=0.5) -> None:
+        self.items = items
+        self.new = new
+        self.change_rate = change_rate
+
+        self.__lock = threading.Lock()
+        self.__newest = items
+        self.__version = 0
+        self.__built = time.time()
+
+        self.requests = 0
+        self.not_modified = 0
+
+    def __feed(self) -> bytes:
+
+        parts = [
+            '<?xml version="1.0" encoding="UTF-8"?>',
+            '<rss version="2.0" xmlns:content="http://purl.org/rss/1.0/modules/content/">',
+            f'<channel><title>Fake</title><link>https://example.org</link><lastBuildDate>{formatdate(self.__built)}</lastBuildDate>',
+        ]
+
+        for i in range(self.__newest, self.__newest - self.items, -1):
+            parts.append(
+                f'<item><title><![CDATA[Some.Show.S01E{i % 100:02d} [1080p] (x265)]]></title>'
+                f'<link>https://example.org/?p={i}</link><pubDate>{formatdate(self.__built - (self.__newest - i) * 60)}</pubDate>'
+                f'<category><![CDATA[TV]]></category><category><![CDATA[x265]]></category>'
+                f'<guid isPermaLink="false">https://example.org/?p={i}</guid>'
+                f'<content:encoded><![CDATA[<p>{"Lorem ipsum dolor sit amet. " * 40}</p>]]></content:encoded></item>'
+            )
+
+        parts.append('</channel></rss>')
+        return '\n'.join(parts).encode()
+
+    def get(self, request: _Handler) -> None:
+
+        with self.__lock:
+            self.requests += 1
+
+            if random.random() < self.change_rate:
+                self.__newest += self.new
+                self.__version += 1
+                self.__built = max(time.time(), self.__built + 1)
+
+            etag = f'"v{self.__version}"'
+            modified = formatdate(self.__built, usegmt=True)
+
+            if request.headers.get('If-None-Match') == etag:
+                self.not_modified += 1
+                request._reply(304, b'', 'application/rss+xml', { 'ETag': etag, 'Last-Modified': modified })
+                return
+
+            body = self.__feed()
+
+        request._reply(200, body, 'application/rss+xml', { 'ETag': etag, 'Last-Modified': modified })
@@ -0,0 +1,5 @@
+""" Code shared by the bots in this repository
+
+The bots are run as scripts from their own folder, so they put the
+repository root on `sys.path` before importing from here.
+"""
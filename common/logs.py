@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+""" Logging that never makes the caller wait
+
+`start_logging` puts the records of a logger on a queue and has a listener
+thread hand them to the real handlers: the console, a rotating file and a
+`TelegramAlertHandler`, so a slow disk or Telegram never holds up a poll.
+If the queue is full records are dropped (and counted), not waited for.
+The bots attach it to the root logger, so the `common.*` modules and
+libraries log through it as well as the bot's own logger.
+
+DEBUG lines of busy call sites (one per encounter and so on) are sampled:
+the first `burst` of every call site get through, after that one in
+`sample_rate`. Worker processes send their records to the parent with
+`forward_logging`, which handles them like its own.
+
+Records of ERROR and up go to the admin chat, deduplicated by call site
+(see `ErrorAggregator`) and at most `per_minute`. Callers that sum up their
+errors themselves pass `extra=notify(chat_id)` to have a record sent as is,
+`extra=ALERTED` keeps a record out of the chat.
+"""
+
+import atexit
+import logging
+import queue
+import time
+from collections import deque
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Callable, Deque, Dict, Optional, Tuple
+
+from common.metrics import REGISTRY
+from common.resilience import ErrorAggregator
+
+# the message went to the chat some other way already
+ALERTED = { 'alerted': True }
+
+LOG_RECORDS_DROPPED = REGISTRY.counter('log_records_dropped', 'Log records dropped: sampled out, queue full or alert rate limited', ['reason'])
+
+
+def notify(chat_id) -> dict:
+    """ `extra` of a record to send to `chat_id` as is, whatever its level """
+    return { 'alert_chat': chat_id }
+
+
+class SamplingFilter(logging.Filter):
+    """ Lets through the first `burst` records of `level` and below per call site, then one in `rate` """
+
+    def __init__(self, rate: int=100, burst: int=20, level: int=logging.DEBUG) -> None:
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.level = level
+
+        # (file, line) -> records so far
+        self.__counts: Dict[Tuple[str, int], int] = dict()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+
+        # sampled in another process already, or meant for a chat
+        if record.levelno > self.level or self.rate <= 1 or getattr(record, 'sampled', False) or hasattr(record, 'alert_chat'):
+            return True
+
+        key = (record.pathname, record.lineno)
+        count = self.__counts.get(key, 0) + 1
+        self.__counts[key] = count
+
+        if count > self.burst:
+            if count % self.rate:
+                LOG_RECORDS_DROPPED.labels('sampled').inc()
+                return False
+            record.msg = f'{record.msg} [1 of {self.rate}]'
+
+        record.sampled = True
+        return True
+
+
+class _DroppingQueueHandler(QueueHandler):
+    """ Drops records instead of waiting for room in the queue """
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            LOG_RECORDS_DROPPED.labels('queue_full').inc()
+
+
+class TelegramAlertHandler(logging.Handler):
+    """ Sends records to a chat with `send(chat_id, text)`, meant to run on the listener thread
+
+    Records of `level` and up go to `chat_id`: the first one of a call site
+    right away, its repeats in a summary every `interval` seconds (with the
+    next record, there is no timer). Records with `notify` go to their chat
+    as they are. Beyond `per_minute` messages the rest is only counted.
+    """
+
+    def __init__(self, send: Callable[[object, str], None], chat_id, level: int=logging.ERROR, interval: float=900, per_minute: int=20, error_template: str='%s', template: str='%s') -> None:
+        super().__init__(logging.DEBUG)
+        self.__send = send
+        self.__chat_id = chat_id
+        self.__alert_level = level
+        self.__per_minute = per_minute
+        self.__error_template = error_template
+        self.__template = template
+
+        self.__errors = ErrorAggregator(interval)
+        self.__sent: Deque[float] = deque()
+        self.__dropped = 0
+
+    def __deliver(self, chat_id, text: str, is_err: bool) -> None:
+
+        now = time.monotonic()
+        while self.__sent and now - self.__sent[0] > 60:
+            self.__sent.popleft()
+
+        if len(self.__sent) >= self.__per_minute:
+            self.__dropped += 1
+            LOG_RECORDS_DROPPED.labels('rate_limited').inc()
+            return
+
+        if self.__dropped:
+            text = f'{text}\n({self.__dropped} more alert(s) were dropped)'
+            self.__dropped = 0
+
+        self.__sent.append(now)
+        self.__send(chat_id, (self.__error_template if is_err else self.__template) % text)
+
+    def emit(self, record: logging.LogRecord) -> None:
+
+        try:
+            chat_id = getattr(record, 'alert_chat', None)
+
+            if chat_id is not None:
+                self.__deliver(chat_id, record.getMessage(), record.levelno >= logging.ERROR)
+            elif record.levelno >= self.__alert_level and not getattr(record, 'alerted', False):
+                text = self.__errors.report(f'{record.module}:{record.lineno}', self.format(record))
+                if text:
+                    self.__deliver(self.__chat_id, text, True)
+
+            for summary in self.__errors.flush():
+                self.__deliver(self.__chat_id, summary, True)
+        except Exception:
+            self.handleError(record)
+
+
+class _Listener(QueueListener):
+
+    def stop(self) -> None:
+        """ Like `QueueListener.stop`, but does nothing if stopped already """
+        if self._thread is not None:
+            super().stop()
+
+
+def start_logging(logger: logging.Logger, *handlers: logging.Handler, sample_rate: int=100, max_queued: int=10000) -> QueueListener:
+    """ Has a thread hand the records of `logger` to `handlers`, returns it (already started) """
+
+    records: queue.Queue = queue.Queue(max_queued)
+
+    handler = _DroppingQueueHandler(records)
+    handler.addFilter(SamplingFilter(sample_rate))
+    logger.addHandler(handler)
+
+    listener = _Listener(records, *handlers, respect_handler_level=True)
+    listener.start()
+    # writes out what is still queued
+    atexit.register(listener.stop)
+
+    return listener
+
+
+def forward_logging(logger: logging.Logger, target, sample_rate: int=100) -> None:
+    """ Replaces the handlers of `logger` by one putting its records on `target`, anything with `put_nowait`
+
+    A worker process has no listener of its own, its records have to go to
+    the parent instead.
+    """
+
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+
+    handler = QueueHandler(target)
+    handler.addFilter(SamplingFilter(sample_rate))
+    logger.addHandler(handler)
+
+
+def rotating_file(path: str, max_bytes: int=10 * 1024 * 1024, backups: int=5, formatter: Optional[logging.Formatter]=None) -> logging.Handler:
+    """ A file handler starting a new file every `max_bytes`, keeping `backups` old ones """
+
+    handler = RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups, encoding='utf-8')
+    if formatter is not None:
+        handler.setFormatter(formatter)
+    return handler
@@ -0,0 +1,315 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+""" Counters, gauges and histograms in the Prometheus text format
+
+Updating a metric is a dict lookup and an addition, nothing is rendered
+until somebody asks: either an HTTP scrape of `/metrics` (see `serve`) or
+a periodic write for the node exporter's textfile collector (see
+`write_textfile`). Without either of them the metrics just sit in memory.
+
+Updates are not locked. Every metric is only updated from one event loop
+in the bots here, a lost increment across threads wouldnt matter anyway.
+"""
+
+import logging
+import math
+import os
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+log = logging.getLogger(__name__)
+
+# seconds, from a fast local call to a slow remote one
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# bytes, 1kB to 8MB
+SIZE_BUCKETS = tuple(1024 * 2 ** i for i in range(0, 14))
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str='') -> str:
+
+    pairs = [ f'{name}="{_escape(str(value))}"' for name, value in zip(names, values) ]
+    if extra:
+        pairs.append(extra)
+
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class _Metric:
+    """ A metric family, its children are the label combinations """
+
+    kind = ''
+    # counters are exposed as name_total
+    family_suffix = ''
+
+    def __init__(self, name: str, doc: str, labelnames: Sequence[str]=()) -> None:
+        self.name = name
+        self.doc = doc
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], '_Metric'] = dict()
+
+    def labels(self, *values) -> '_Metric':
+        """ Returns the child for these label values (positional, in `labelnames` order) """
+
+        key = tuple(str(value) for value in values)
+        child = self._children.get(key)
+
+        if child is None:
+            if len(key) != len(self.labelnames):
+                raise ValueError(f'{self.name} has labels {self.labelnames}, got {values}')
+            child = self._children[key] = self._child()
+
+        return child
+
+    def _child(self) -> '_Metric':
+        raise NotImplementedError
+
+    def _samples(self) -> Iterable[Tuple[str, str, float]]:
+        """ (suffix, extra label, value) of a single child """
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+
+        family = self.name + self.family_suffix
+        lines = [ f'# HELP {family} {self.doc}', f'# TYPE {family} {self.kind}' ]
+
+        children = list(self._children.items()) if self.labelnames else [((), self)]
+        for values, child in children:
+            for suffix, extra, value in child._samples():
+                lines.append(f'{family}{suffix}{_format_labels(self.labelnames, values, extra)} {_format_value(value)}')
+
+        return lines
+
+
+class Counter(_Metric):
+    """ Only goes up """
+
+    kind = 'counter'
+    family_suffix = '_total'
+
+    def __init__(self, name: str, doc: str, labelnames: Sequence[str]=()) -> None:
+        super().__init__(name, doc, labelnames)
+        self.value = 0.0
+
+    def _child(self) -> 'Counter':
+        return Counter(self.name, self.doc)
+
+    def inc(self, amount: float=1) -> None:
+        self.value += amount
+
+    def _samples(self):
+        yield '', '', self.value
+
+
+class Gauge(_Metric):
+    """ Goes up and down, or is read from `func` whenever it gets rendered """
+
+    kind = 'gauge'
+
+    def __init__(self, name: str, doc: str, labelnames: Sequence[str]=(), func: Optional[Callable[[], float]]=None) -> None:
+        super().__init__(name, doc, labelnames)
+        self.value = 0.0
+        self.func = func
+
+    def _child(self) -> 'Gauge':
+        return Gauge(self.name, self.doc)
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def inc(self, amount: float=1) -> None:
+        self.value += amount
+
+    def set_function(self, func: Callable[[], float]) -> None:
+        """ Reads the value from `func` on render only, so keeping it current costs nothing """
+        self.func = func
+
+    def _samples(self):
+        if self.func is not None:
+            try:
+                self.value = self.func()
+            except Exception:
+                log.exception(f'Reading gauge {self.name} failed')
+        yield '', '', self.value
+
+
+class _Timer:
+
+    def __init__(self, histogram: 'Histogram') -> None:
+        self.__histogram = histogram
+
+    def __enter__(self) -> '_Timer':
+        self.__started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.__histogram.observe(time.perf_counter() - self.__started)
+
+
+class Histogram(_Metric):
+    """ Counts observations into buckets, plus their sum and count """
+
+    kind = 'histogram'
+
+    def __init__(self, name: str, doc: str, labelnames: Sequence[str]=(), buckets: Sequence[float]=LATENCY_BUCKETS) -> None:
+        super().__init__(name, doc, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # one more for +Inf, not cumulative, that happens when rendering
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def _child(self) -> 'Histogram':
+        return Histogram(self.name, self.doc, buckets=self.buckets)
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def time(self) -> _Timer:
+        """ `with histogram.time():` observes how long the block took """
+        return _Timer(self)
+
+    def _samples(self):
+
+        total = 0
+        for bound, count in zip(self.buckets + (math.inf,), self.counts):
+            total += count
+            yield '_bucket', f'le="{_format_value(float(bound))}"', total
+
+        yield '_sum', '', self.sum
+        yield '_count', '', total
+
+
+class Registry:
+    """ All metrics of a process, by name """
+
+    def __init__(self) -> None:
+        self.__metrics: Dict[str, _Metric] = dict()
+        self.__lock = threading.Lock()
+
+    def __register(self, metric: _Metric) -> _Metric:
+        """ Returns the metric registered under that name before, if there is one """
+
+        with self.__lock:
+            existing = self.__metrics.get(metric.name)
+            if existing is not None:
+                if type(existing) is not type(metric) or existing.labelnames != metric.labelnames:
+                    raise ValueError(f'{metric.name} is already registered as a different metric')
+                return existing
+
+            self.__metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name: str, doc: str, labelnames: Sequence[str]=()) -> Counter:
+        return self.__register(Counter(name, doc, labelnames))
+
+    def gauge(self, name: str, doc: str, labelnames: Sequence[str]=(), func: Optional[Callable[[], float]]=None) -> Gauge:
+        gauge = self.__register(Gauge(name, doc, labelnames))
+        if func is not None:
+            gauge.set_function(func)
+        return gauge
+
+    def histogram(self, name: str, doc: str, labelnames: Sequence[str]=(), buckets: Sequence[float]=LATENCY_BUCKETS) -> Histogram:
+        return self.__register(Histogram(name, doc, labelnames, buckets))
+
+    def render(self) -> str:
+        """ Everything in the Prometheus text exposition format """
+
+        with self.__lock:
+            metrics = list(self.__metrics.values())
+
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+
+        return '\n'.join(lines) + '\n'
+
+
+# the metrics of this process
+REGISTRY = Registry()
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    registry: Registry = REGISTRY
+
+    def do_GET(self) -> None:
+
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+
+        body = self.registry.render().encode()
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args) -> None:
+        log.debug(f'{self.address_string()} {format % args}')
+
+
+def serve(port: int, addr: str='127.0.0.1', registry: Registry=REGISTRY) -> ThreadingHTTPServer:
+    """ Serves /metrics from a daemon thread """
+
+    handler = type('Handler', (_Handler,), { 'registry': registry })
+    server = ThreadingHTTPServer((addr, port), handler)
+    server.daemon_threads = True
+
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    log.info(f'Serving metrics on http://{addr}:{server.server_address[1]}/metrics')
+
+    return server
+
+
+def write_textfile(path: str, registry: Registry=REGISTRY) -> None:
+    """ Writes all metrics to `path` atomically, for the node exporter's textfile collector """
+
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        f.write(registry.render())
+    os.replace(tmp, path)
+
+
+def start_textfile(path: str, interval: float=15, registry: Registry=REGISTRY) -> threading.Thread:
+    """ Rewrites the textfile every `interval` seconds from a daemon thread """
+
+    def run() -> None:
+        while True:
+            try:
+                write_textfile(path, registry)
+            except OSError as err:
+                log.error(f'Writing metrics to {path} failed: {err}')
+            time.sleep(interval)
+
+    thread = threading.Thread(target=run, name='metrics-textfile', daemon=True)
+    thread.start()
+    return thread
+
+
+def start_exporter(port: Optional[int]=None, textfile: Optional[str]=None, registry: Registry=REGISTRY) -> None:
+    """ Starts whatever is configured, nothing if neither is """
+
+    if port:
+        serve(int(port), registry=registry)
+    if textfile:
+        start_textfile(textfile, registry=registry)
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+""" Looking into a running process without stopping it
+
+`sample_stacks` profiles every thread for a while by looking at their
+stacks (`sys._current_frames`) every few ms from a thread of its own. Nothing
+is hooked into the profiled code, so it costs the others little more than a
+sampler thread waking up now and then, and it can be turned on in production.
+The result sums up the hottest functions and has the stacks in the folded
+format of flamegraph.pl and speedscope.
+
+`Spans` keeps the recent cycles of a loop (a poll and what follows) with the
+time every stage of it took, always on: a few `perf_counter` calls a cycle.
+"""
+
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+from contextlib import contextmanager
+from typing import Deque, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+# leaf functions of threads waiting for something, they arent busy
+IDLE = {
+    ('selectors.py', 'select'),
+    ('threading.py', 'wait'),
+    ('threading.py', '_wait_for_tstate_lock'),
+    ('socket.py', 'readinto'),
+    ('socket.py', 'accept'),
+    ('ssl.py', 'read'),
+    ('ssl.py', 'recv_into'),
+    ('queue.py', 'get'),
+    # an executor thread waiting for work
+    ('thread.py', '_worker'),
+    # the main thread of a polling bot, sleeping until it is stopped
+    ('updater.py', 'idle'),
+}
+
+# under every thread, they would top the total of any profile
+ROOTS = { 'threading.py:_bootstrap', 'threading.py:_bootstrap_inner', 'threading.py:run' }
+
+
+def _label(code) -> str:
+    return f'{os.path.basename(code.co_filename)}:{code.co_name}'
+
+
+class Profile:
+    """ Stacks sampled from all threads, with how often each was seen """
+
+    def __init__(self, stacks: Counter, samples: int, seconds: float) -> None:
+        # 'thread;outermost;...;innermost' -> times seen
+        self.stacks = stacks
+        self.samples = samples
+        self.seconds = seconds
+
+    def busy(self) -> Counter:
+        """ The stacks of threads that were doing something, not waiting """
+
+        busy: Counter = Counter()
+        for stack, count in self.stacks.items():
+            leaf = tuple(stack.rsplit(';', 1)[-1].split(':', 1))
+            if leaf not in IDLE:
+                busy[stack] = count
+        return busy
+
+    def top(self, n: int=15) -> Tuple[List[Tuple[str, int]], List[Tuple[str, int]]]:
+        """ The `n` functions seen the most at the top of the busy stacks (self), and anywhere in them (total) """
+
+        own: Counter = Counter()
+        total: Counter = Counter()
+
+        for stack, count in self.busy().items():
+            frames = stack.split(';')[1:]
+            own[frames[-1]] += count
+            # recursion counts once
+            for frame in set(frames) - ROOTS:
+                total[frame] += count
+
+        return own.most_common(n), total.most_common(n)
+
+    def threads(self) -> Counter:
+        """ Busy samples per thread """
+
+        threads: Counter = Counter()
+        for stack, count in self.busy().items():
+            threads[stack.split(';', 1)[0]] += count
+        return threads
+
+    def report(self, n: int=15) -> str:
+        """ A summary short enough for a message """
+
+        busy = sum(self.busy().values())
+        if not busy:
+            return f'{self.samples} samples in {self.seconds:.0f}s, every thread was waiting'
+
+        own, total = self.top(n)
+        lines = [f'{self.samples} samples in {self.seconds:.0f}s, {busy} of {sum(self.stacks.values())} thread samples busy', '', 'Busy threads:']
+        lines += [f'{count / busy:6.1%}  {name}' for name, count in self.threads().most_common(n)]
+        lines += ['', 'Self:']
+        lines += [f'{count / busy:6.1%}  {name}' for name, count in own]
+        lines += ['', 'Total:']
+        lines += [f'{count / busy:6.1%}  {name}' for name, count in total]
+        return '\n'.join(lines)
+
+    def folded(self) -> str:
+        """ The stacks as flamegraph.pl and speedscope read them, waiting threads included """
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+
+def sample_stacks(seconds: float, interval: float=0.01) -> Profile:
+    """ Looks at the stacks of all other threads every `interval` seconds, for `seconds` """
+
+    me = threading.get_ident()
+    stacks: Counter = Counter()
+    samples = 0
+
+    started = time.monotonic()
+    deadline = started + seconds
+
+    while True:
+        names = { thread.ident: thread.name for thread in threading.enumerate() }
+
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+
+            frames = []
+            while frame is not None:
+                frames.append(_label(frame.f_code))
+                frame = frame.f_back
+
+            frames.append(names.get(ident, str(ident)).replace(';', ','))
+            stacks[';'.join(reversed(frames))] += 1
+
+        samples += 1
+
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        time.sleep(min(interval, remaining))
+
+    return Profile(stacks, samples, time.monotonic() - started)
+
+
+class Cycle(NamedTuple):
+    name: str
+    started: float  # unix time
+    seconds: float
+    # stage -> seconds, without the stages nested in it
+    stages: Dict[str, float]
+
+
+class CycleTimer:
+    """ The stages of one cycle as it runs, see `Spans.cycle` """
+
+    def __init__(self, spans: 'Spans', name: str) -> None:
+        self.__spans = spans
+        self.__name = name
+        self.__started = time.time()
+        self.__start = time.perf_counter()
+        self.__stages: Dict[str, float] = dict()
+        self.__open: List[List] = []
+
+    @contextmanager
+    def span(self, stage: str) -> Iterator[None]:
+        """ Times what runs in the block as `stage`, the time of stages nested in it goes to them only """
+
+        entry = [stage, 0.0]
+        self.__open.append(entry)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.__open.pop()
+            self.__stages[stage] = self.__stages.get(stage, 0) + elapsed - entry[1]
+            if self.__open:
+                self.__open[-1][1] += elapsed
+
+    def finish(self) -> Cycle:
+        cycle = Cycle(self.__name, self.__started, time.perf_counter() - self.__start, self.__stages)
+        self.__spans.add(cycle)
+        return cycle
+
+
+class Spans:
+    """ The last `capacity` cycles of a loop, with the time each of their stages took """
+
+    def __init__(self, capacity: int=256) -> None:
+        self.__cycles: Deque[Cycle] = deque(maxlen=capacity)
+
+    def cycle(self, name: str) -> CycleTimer:
+        """ Starts timing a cycle, which is kept once `finish` is called """
+        return CycleTimer(self, name)
+
+    def add(self, cycle: Cycle) -> None:
+        self.__cycles.append(cycle)
+
+    def recent(self, n: Optional[int]=None) -> List[Cycle]:
+        """ The last `n` cycles (all of them by default), oldest first """
+
+        cycles = list(self.__cycles)
+        return cycles[-n:] if n else cycles
+
+
+def _percentile(values: List[float], q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def summarize_spans(cycles: Iterable[Cycle], last: int=5) -> str:
+    """ p50, p95 and max of every stage, and the `last` cycles one by one, in ms """
+
+    cycles = sorted(cycles, key=lambda cycle: cycle.started)
+    if not cycles:
+        return 'No cycles yet'
+
+    stages: Dict[str, List[float]] = { 'total': [cycle.seconds for cycle in cycles] }
+    for cycle in cycles:
+        for stage, seconds in cycle.stages.items():
+            stages.setdefault(stage, []).append(seconds)
+
+    lines = [f'Last {len(cycles)} cycles, ms p50 / p95 / max:']
+    for stage, values in stages.items():
+        lines.append(f'{stage}: {_percentile(values, 0.5) * 1e3:.1f} / {_percentile(values, 0.95) * 1e3:.1f} / {max(values) * 1e3:.1f} ({len(values)}x)')
+
+    lines += ['', 'Latest:']
+    for cycle in cycles[-last:]:
+        stages_ms = ' '.join(f'{stage} {seconds * 1e3:.1f}' for stage, seconds in cycle.stages.items())
+        lines.append(f'{time.strftime("%H:%M:%S", time.localtime(cycle.started))} {cycle.name}: {cycle.seconds * 1e3:.1f} ({stages_ms})')
+
+    return '\n'.join(lines)
@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+""" Circuit breakers, backoff and error summaries for flaky endpoints
+
+A `CircuitBreaker` opens after `failure_threshold` failures in a row (of
+one caller, if they pass a key) and refuses requests until `reset_timeout`
+seconds passed. Then a single probe
+is let through (half open): if it succeeds the circuit closes, otherwise it
+opens again for twice as long (up to `max_reset_timeout`, with jitter).
+Breakers are shared per endpoint by name, see `circuit`.
+
+An `ErrorAggregator` keeps the admin chat from being flooded: the first
+error of a kind is reported right away, repeats only in a summary every
+`interval` seconds, and the recovery once more. It returns the texts to
+send instead of sending them, so it works for sync and async callers alike.
+"""
+
+import logging
+import random
+import time
+from typing import Callable, Dict, Hashable, List, Optional, Tuple
+
+from common.metrics import REGISTRY
+
+log = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+STATE_VALUES = { CLOSED: 0, HALF_OPEN: 0.5, OPEN: 1 }
+
+CIRCUIT_STATE = REGISTRY.gauge('circuit_breaker_state', 'Circuit breakers: closed (0), half open (0.5) or open (1)', ['circuit'])
+CIRCUIT_REJECTED = REGISTRY.counter('circuit_breaker_rejected', 'Requests not made because the circuit was open', ['circuit'])
+
+
+def backoff(attempt: int, base: float=1, cap: float=60) -> float:
+    """ Exponential backoff with jitter: between half and all of base * 2^attempt, capped """
+
+    return min(cap, base * 2 ** attempt) * random.uniform(0.5, 1)
+
+
+class CircuitBreaker:
+
+    def __init__(self, name: str, failure_threshold: int=5, reset_timeout: float=30, max_reset_timeout: float=600, clock: Callable[[], float]=time.monotonic) -> None:
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.__clock = clock
+
+        self.state = CLOSED
+        # failures since the circuit was last fine, and in a row per caller
+        self.failures = 0
+        self.__streaks: Dict[Hashable, int] = dict()
+        self.__timeout = reset_timeout
+        self.__opened_at = 0.0
+        self.__probe_at: Optional[float] = None
+
+        self.__set_state(CLOSED)
+
+    def __set_state(self, state: str) -> None:
+
+        if state != self.state:
+            log.info(f'Circuit {self.name} is {state.replace("_", " ")}')
+        self.state = state
+        CIRCUIT_STATE.labels(self.name).set(STATE_VALUES[state])
+
+    def allow(self) -> bool:
+        """ Whether a request may go out now, in half open state only one probe at a time """
+
+        if self.state == CLOSED:
+            return True
+
+        now = self.__clock()
+
+        if self.state == OPEN and now >= self.__opened_at + self.__timeout:
+            self.__set_state(HALF_OPEN)
+
+        # a probe that never reported back (cancelled) doesnt block forever
+        if self.state == HALF_OPEN and (self.__probe_at is None or now - self.__probe_at > self.__timeout):
+            self.__probe_at = now
+            return True
+
+        CIRCUIT_REJECTED.labels(self.name).inc()
+        return False
+
+    def success(self, key: Hashable=None) -> bool:
+        """ Closes the circuit, returns TRUE if it wasnt closed before
+
+        While closed only the failures of `key` are forgiven, callers doing
+        fine dont hide that another one keeps failing.
+        """
+
+        recovered = self.state != CLOSED
+
+        if recovered:
+            self.__streaks.clear()
+        else:
+            self.__streaks.pop(key, None)
+
+        if not self.__streaks:
+            self.failures = 0
+        self.__timeout = self.reset_timeout
+        self.__probe_at = None
+        self.__set_state(CLOSED)
+
+        return recovered
+
+    def failure(self, key: Hashable=None) -> None:
+
+        self.failures += 1
+        streak = self.__streaks[key] = self.__streaks.get(key, 0) + 1
+        now = self.__clock()
+
+        if self.state == HALF_OPEN:
+            # the probe failed, wait longer this time
+            self.__timeout = min(self.max_reset_timeout, self.__timeout * 2) * random.uniform(0.8, 1.2)
+        elif self.state == CLOSED and streak < self.failure_threshold:
+            return
+
+        self.__opened_at = now
+        self.__probe_at = None
+        self.__set_state(OPEN)
+
+    def retry_in(self) -> float:
+        """ Seconds until the next request may go out, 0 if it may right now """
+
+        if self.state != OPEN:
+            return 0.0
+        return max(0.0, self.__opened_at + self.__timeout - self.__clock())
+
+
+_BREAKERS: Dict[str, CircuitBreaker] = dict()
+
+
+def circuit(name: str, **kwargs) -> CircuitBreaker:
+    """ The breaker of an endpoint, created with `kwargs` on first use """
+
+    breaker = _BREAKERS.get(name)
+    if breaker is None:
+        breaker = _BREAKERS[name] = CircuitBreaker(name, **kwargs)
+    return breaker
+
+
+class ErrorAggregator:
+    """ Reports the first error of a kind, summarizes its repeats every `interval` seconds """
+
+    def __init__(self, interval: float=900, clock: Callable[[], float]=time.monotonic) -> None:
+        self.interval = interval
+        self.__clock = clock
+
+        # key -> (repeats not reported yet, last message)
+        self.__repeats: Dict[str, Tuple[int, str]] = dict()
+        # key -> errors since it was last fine
+        self.__totals: Dict[str, int] = dict()
+        self.__last_summary = clock()
+
+    def report(self, key: str, message: str) -> Optional[str]:
+        """ Returns the text to send now, None if it goes into the next summary """
+
+        total = self.__totals.get(key, 0)
+        self.__totals[key] = total + 1
+
+        if not total:
+            # repeats are summed up from here on
+            if not self.__repeats:
+                self.__last_summary = self.__clock()
+            return message
+
+        count, _ = self.__repeats.get(key, (0, message))
+        self.__repeats[key] = (count + 1, message)
+        return None
+
+    def resolve(self, key: str, message: str='') -> Optional[str]:
+        """ The kind of error is over, returns the text to send if there were any """
+
+        total = self.__totals.pop(key, 0)
+        self.__repeats.pop(key, None)
+
+        if not total:
+            return None
+        return f'{message or key} recovered after {total} error(s)'
+
+    def flush(self) -> List[str]:
+        """ The summaries due, once `interval` seconds passed since the last ones """
+
+        now = self.__clock()
+        if now - self.__last_summary < self.interval or not self.__repeats:
+            return []
+
+        self.__last_summary = now
+        repeats, self.__repeats = self.__repeats, dict()
+
+        return [ f'{key}: {count} more error(s) in the last {self.interval / 60:.0f} min, last one:\n{message}' for key, (count, message) in repeats.items() ]
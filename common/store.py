@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+import logging
+import sqlite3
+import time
+from threading import Lock
+from typing import Dict, Optional, Set, Tuple
+
+log = logging.getLogger(__name__)
+
+
+class Store:
+    """ Key/value pairs that expire, grouped by namespace
+
+    This base class keeps nothing, so dedup state only lives in memory.
+    """
+
+    def load(self, now: Optional[float]=None) -> Dict[str, Tuple[str, float]]:
+        """ Returns key -> (value, expires_at) for everything not expired yet """
+        return dict()
+
+    def put(self, key: str, value: str, expires_at: float) -> None:
+        """ Stores the value until `expires_at` (unix time), might be buffered """
+
+    def flush(self) -> None:
+        """ Writes out buffered values """
+
+    def claim(self, entries: Dict[str, float]) -> Set[str]:
+        """ Takes key -> expires_at right away, returns the keys nobody else holds
+
+        With only one process around every key is free.
+        """
+        return set(entries)
+
+    def close(self) -> None:
+        self.flush()
+
+
+class SqliteStore(Store):
+    """ Stores values in a SQLite file in WAL mode
+
+    Writes are buffered and go out in one transaction once `batch_size`
+    values are pending or `flush_interval` seconds passed, expired rows
+    are purged every `purge_interval` seconds while flushing.
+    """
+
+    def __init__(self, path: str, namespace: str, batch_size: int=100, flush_interval: float=5, purge_interval: float=600) -> None:
+        self.__namespace = namespace
+        self.__batch_size = batch_size
+        self.__flush_interval = flush_interval
+        self.__purge_interval = purge_interval
+
+        self.__pending: Dict[str, Tuple[str, float]] = dict()
+        self.__last_flush = time.monotonic()
+        self.__last_purge = 0.0
+        self.__lock = Lock()
+
+        self.__db = sqlite3.connect(path, check_same_thread=False)
+        self.__db.execute('PRAGMA journal_mode=WAL')
+        self.__db.execute('PRAGMA synchronous=NORMAL')
+        # other processes may claim in the same file, wait for their locks instead of failing
+        self.__db.execute('PRAGMA busy_timeout=5000')
+        with self.__db:
+            self.__db.execute('''
+                CREATE TABLE IF NOT EXISTS entries (
+                    namespace TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    expires_at REAL NOT NULL,
+                    PRIMARY KEY (namespace, key)
+                ) WITHOUT ROWID
+            ''')
+            self.__db.execute('CREATE INDEX IF NOT EXISTS entries_expiry ON entries (expires_at)')
+
+    def load(self, now: Optional[float]=None) -> Dict[str, Tuple[str, float]]:
+
+        now = time.time() if now is None else now
+
+        with self.__lock:
+            rows = self.__db.execute(
+                'SELECT key, value, expires_at FROM entries WHERE namespace = ? AND expires_at > ?',
+                (self.__namespace, now)
+            ).fetchall()
+
+        log.debug(f'Loaded {len(rows)} entries for {self.__namespace}')
+        return { key: (value, expires_at) for key, value, expires_at in rows }
+
+    def put(self, key: str, value: str, expires_at: float) -> None:
+
+        self.__pending[key] = (value, expires_at)
+
+        if len(self.__pending) >= self.__batch_size or time.monotonic() - self.__last_flush > self.__flush_interval:
+            self.flush()
+
+    def flush(self) -> None:
+
+        pending, self.__pending = self.__pending, dict()
+        self.__last_flush = now = time.monotonic()
+
+        with self.__lock, self.__db:
+            if pending:
+                self.__db.executemany(
+                    'INSERT OR REPLACE INTO entries (namespace, key, value, expires_at) VALUES (?, ?, ?, ?)',
+                    [ (self.__namespace, key, value, expires_at) for key, (value, expires_at) in pending.items() ]
+                )
+
+            self.__purge(now)
+
+    def __purge(self, now: float) -> None:
+        """ Deletes expired rows every `purge_interval` seconds, the caller holds the lock and transaction """
+
+        if now - self.__last_purge > self.__purge_interval:
+            self.__db.execute('DELETE FROM entries WHERE namespace = ? AND expires_at <= ?', (self.__namespace, time.time()))
+            self.__last_purge = now
+
+    def claim(self, entries: Dict[str, float]) -> Set[str]:
+        """ Takes the keys in one transaction, other processes sharing the file see them at once
+
+        A key is free if it is not stored yet or expired, claims arent buffered.
+        """
+
+        claimed = set()
+        now = time.time()
+
+        with self.__lock, self.__db:
+            for key, expires_at in entries.items():
+                cursor = self.__db.execute(
+                    '''INSERT INTO entries (namespace, key, value, expires_at) VALUES (?, ?, '', ?)
+                       ON CONFLICT (namespace, key) DO UPDATE SET expires_at = excluded.expires_at WHERE entries.expires_at <= ?''',
+                    (self.__namespace, key, expires_at, now)
+                )
+                if cursor.rowcount:
+                    claimed.add(key)
+
+            self.__purge(time.monotonic())
+
+        return claimed
+
+    def close(self) -> None:
+        self.flush()
+        with self.__lock:
+            self.__db.close()
+
+
+def open_store(path: Optional[str], namespace: str) -> Store:
+    """ Returns a SQLite backed store for `path`, or one that keeps nothing if `path` is empty """
+
+    if not path:
+        return Store()
+
+    return SqliteStore(path, namespace)
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+""" Keeps the token of the map site fresh in the background
+
+raw_data only answers requests carrying the token embedded in the landing
+page, along with the cookies that came with that page. A token is good until
+midnight (Europe/Berlin). `TokenManager.run` fetches the next one right at
+that boundary, polls that would go out with an expired token wait for the
+fetch in flight instead of earning a 400.
+"""
+
+import asyncio
+import logging
+import random
+import re
+from datetime import datetime, timedelta, tzinfo
+from http.cookies import BaseCookie
+from typing import Callable, NamedTuple, Optional, Tuple
+
+import aiohttp
+from yarl import URL
+
+from common.logs import ALERTED
+from common.metrics import REGISTRY
+
+log = logging.getLogger('ored-tg')
+
+# printable ASCII but the quote, anything else isnt a token
+TOKEN_PATTERN = re.compile(rb"var token = '([!-&(-~]{42,48})';")
+
+TOKEN_REFRESHES = REGISTRY.counter('ored_token_refreshes', 'Token requests by outcome', ['outcome'])
+TOKEN_SECONDS = REGISTRY.histogram('ored_token_seconds', 'Duration of token requests, until the token was found')
+
+
+class Token(NamedTuple):
+    """ A token and the cookies it belongs to, swapped as a whole """
+
+    value: str
+    cookies: BaseCookie
+    expires: datetime
+
+
+class TokenManager:
+    """ Fetches the token ahead of polls and swaps it in atomically
+
+    Only the start of the landing page is read, until the token shows up
+    (at most `max_bytes`). Every fetch uses its own cookie jar, so polls in
+    flight keep their cookies until `on_update` hands over the new ones.
+    Failed fetches are retried with a jittered backoff within `retry_bounds`
+    seconds, `on_error` is told about the first failure of a row only.
+    """
+
+    def __init__(self, url: str, tz: tzinfo, on_update: Callable[[Optional[Token], Token], None], on_error: Callable[[str], None], skew: float=2, retry_bounds: Tuple[float, float]=(5, 300), max_bytes: int=256 * 1024, chunk_size: int=4096) -> None:
+        self.url = url
+        self.__tz = tz
+        self.__on_update = on_update
+        self.__on_error = on_error
+
+        # the server may switch over a little after our midnight
+        self.__skew = skew
+        self.__retry_bounds = retry_bounds
+        self.__max_bytes = max_bytes
+        self.__chunk_size = chunk_size
+
+        self.__token: Optional[Token] = None
+        self.__refreshing: Optional[asyncio.Future] = None
+        self.__runner: Optional[asyncio.Task] = None
+        self.__failures = 0
+        self.__retry_at = 0.0
+
+    @property
+    def token(self) -> Optional[Token]:
+        return self.__token
+
+    def expires_in(self) -> float:
+        """ Seconds until the token expires, 0 if there is none or it did already """
+
+        if self.__token is None:
+            return 0.0
+        return max(0.0, (self.__token.expires - datetime.now(self.__tz)).total_seconds())
+
+    def retry_in(self) -> float:
+        """ Seconds until a fetch may be tried again after a failed one, 0 if it may right now """
+        return max(0.0, self.__retry_at - asyncio.get_running_loop().time())
+
+    def __retry_delay(self) -> float:
+        low, high = self.__retry_bounds
+        return min(high, low * 2 ** (self.__failures - 1)) * random.uniform(0.5, 1)
+
+    async def fetch(self, session: aiohttp.ClientSession) -> Optional[Token]:
+        """ Reads the landing page until the token shows up, None if it doesnt
+
+        Shares the connection pool of `session`, but not its cookies.
+        """
+
+        async with aiohttp.ClientSession(connector=session.connector, connector_owner=False, timeout=session.timeout, headers=session.headers) as fetcher:
+            async with fetcher.get(self.url) as r:
+
+                buffer = bytearray()
+                match = None
+
+                async for chunk in r.content.iter_chunked(self.__chunk_size):
+                    # the token could be split between two chunks
+                    start = max(0, len(buffer) - 64)
+                    buffer += chunk
+
+                    match = TOKEN_PATTERN.search(buffer, start)
+                    if match or len(buffer) >= self.__max_bytes:
+                        break
+
+                log.debug(f'Read {len(buffer)} bytes of the landing page')
+
+            if not match:
+                return None
+
+            cookies = fetcher.cookie_jar.filter_cookies(URL(self.url))
+
+        # midnight today
+        expires = datetime.now(self.__tz).replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(1)
+
+        return Token(match[1].decode('ascii'), cookies, expires)
+
+    async def __refresh(self, session: aiohttp.ClientSession) -> bool:
+
+        old = self.__token
+
+        try:
+            with TOKEN_SECONDS.time():
+                token = await self.fetch(session)
+            error = None if token else 'No token found!'
+            outcome = 'ok' if token else 'missing'
+        except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+            token = None
+            error = f'Token request failed: {err!r}'
+            outcome = 'failed'
+        finally:
+            self.__refreshing = None
+
+        TOKEN_REFRESHES.labels(outcome).inc()
+
+        if token is None:
+            self.__failures += 1
+            delay = self.__retry_delay()
+            self.__retry_at = asyncio.get_running_loop().time() + delay
+
+            # the first failure goes to the chat through on_error
+            log.error(f'{error} Retrying in {delay:.0f}s', extra=ALERTED)
+            if self.__failures == 1:
+                self.__on_error(error)
+            return False
+
+        self.__failures = 0
+        self.__token = token
+        self.__on_update(old, token)
+        return True
+
+    async def refresh(self, session: aiohttp.ClientSession, rejected: Optional[str]=None) -> bool:
+        """ Fetches a new token, returns FALSE if that failed
+
+        Concurrent callers share one fetch. Within the backoff after a failed
+        fetch it fails right away. With `rejected` (a token the server turned
+        down) nothing is fetched if another token replaced it meanwhile.
+        """
+
+        if rejected is not None and self.__token is not None and self.__token.value != rejected:
+            return True
+
+        if self.__refreshing is None:
+            if asyncio.get_running_loop().time() < self.__retry_at:
+                return False
+            self.__refreshing = asyncio.ensure_future(self.__refresh(session))
+
+        # a cancelled poll must not cancel the fetch the others wait for
+        return await asyncio.shield(self.__refreshing)
+
+    async def ensure(self, session: aiohttp.ClientSession) -> bool:
+        """ Returns TRUE once there is a token that has not expired yet """
+
+        if self.expires_in() > 0:
+            return True
+        return await self.refresh(session)
+
+    async def __run(self, session: aiohttp.ClientSession) -> None:
+
+        while True:
+            if self.__failures:
+                delay = self.__retry_at - asyncio.get_running_loop().time()
+            else:
+                delay = self.expires_in() + self.__skew
+
+            await asyncio.sleep(max(0.0, delay))
+            await self.refresh(session)
+
+    def start(self, session: aiohttp.ClientSession) -> None:
+        """ Refreshes the token at every expiry from now on, on the running event loop """
+
+        if self.__runner is None:
+            self.__runner = asyncio.create_task(self.__run(session))
+
+    async def close(self) -> None:
+        """ Stops refreshing, including a fetch in flight """
+
+        tasks = [ task for task in (self.__runner, self.__refreshing) if task is not None ]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+        self.__runner = None
+        self.__refreshing = None
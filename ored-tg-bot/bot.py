@@ -1,29 +1,70 @@
 #!/usr/bin/env python3
 # -*- coding: UTF-8 -*-
 
+import asyncio
 import logging
-from secrets import BOT_AUTH_TOKEN, BOT_MYSELF_CHAT_ID
+import os
+import signal
+import sys
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime
+from io import BytesIO
+from secrets import AREA, BOT_API_URL, BOT_AUTH_TOKEN, BOT_MYSELF_CHAT_ID, METRICS_PORT, METRICS_TEXTFILE, POSITION, REGIONS, SPEED_KMH, STORE_PATH, WORKERS, HISTORY_PATH, DIGEST, LOG_PATH, WEBHOOK_URL, WEBHOOK_LISTEN, WEBHOOK_PORT, WEBHOOK_SECRET
+from typing import Optional
+from urllib.parse import urlsplit
 
 from telegram import Update
 from telegram.ext import (CallbackContext, CommandHandler, Filters,
                           MessageHandler, Updater)
 
-from scraper import OredScraper
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.logs import TelegramAlertHandler, rotating_file, start_logging
+from common.metrics import start_exporter
+from common.profiling import sample_stacks, summarize_spans
+
+# the scraper and everything it needs (aiohttp, numpy, ...) is imported by load_scraper,
+# in the background while the bot already answers
 
 log = logging.getLogger('ored-tg')
 log.setLevel(logging.DEBUG)
 
-#fh = logging.FileHandler('./ored.log', 'w', 'utf-8')
-ch = logging.StreamHandler()
-formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s', '%Y-%m-%d %H:%M:%S')
-#fh.setFormatter(formatter)
-ch.setFormatter(formatter)
+# all set up by main(), importing this module has no side effects
+updater: Optional[Updater] = None
+scraper_future: Future = Future()
+recorder = None
+
+# one profile at a time, two would mostly see each other
+profiling = threading.Lock()
+PROFILE_SECONDS = 10
+
+def send_alert(chat_id, text: str) -> None:
+    """Runs on the logging thread, never on the scraper's"""
+    updater.bot.send_message(chat_id=chat_id, text=text)
+
+def setup_logging() -> None:
+
+    ch = logging.StreamHandler()
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s', '%Y-%m-%d %H:%M:%S')
+    ch.setFormatter(formatter)
 
-#log.addHandler(fh)
-log.addHandler(ch)
+    # errors (and whatever the scraper reports) go to the admin chat, see common/logs.py
+    alerts = TelegramAlertHandler(send_alert, BOT_MYSELF_CHAT_ID, error_template='❌❌❌\n%s\n❌❌❌', template='DEBUG:\n%s')
 
-# Create the Updater and pass it your bot's token.
-updater = Updater(BOT_AUTH_TOKEN)
+    # the handlers run on a thread of their own, DEBUG lines of busy spots are sampled.
+    # on the root logger, so common/ and the libraries dont log into the void
+    logging.getLogger('common').setLevel(logging.INFO)
+    start_logging(logging.getLogger(), ch, alerts, *([rotating_file(LOG_PATH, formatter=formatter)] if LOG_PATH else []))
+
+def get_scraper():
+    """The scraper, waits for it if it is still loading"""
+    return scraper_future.result()
+
+def scraper_loaded(future: Future) -> None:
+    """Tells about a broken config right away, not with the first command"""
+
+    if future.exception() is not None:
+        log.error(f'Loading the scraper failed: {future.exception()!r}')
 
 def error(update: Update, context: CallbackContext) -> None:
     """Log Errors caused by Updates."""
@@ -32,41 +73,217 @@ def error(update: Update, context: CallbackContext) -> None:
 # Define a few command handlers. These usually take the two arguments update and
 # context. Error handlers also receive the raised TelegramError object in error.
 def start(update: Update, context: CallbackContext) -> None:
-    """Send a message when the command /start is issued."""
+    """Subscribes the chat, starts the scraper for the first subscriber"""
+
+    scraper = get_scraper()
+    from filters import DEFAULT_FILTERS
 
     filters = context.user_data.get('filters', None)
     if not filters:
-        context.user_data['filters'] = 'iv=97&exiv=113,149'
+        filters = context.user_data['filters'] = DEFAULT_FILTERS
 
     log.debug(f'Attempting start with filters {filters}')
-    scraper.start(filters)
 
-    update.message.reply_text('Scraper started')
+    try:
+        scraper.subscribe(update.effective_chat.id, filters)
+    except ValueError as ve:
+        update.message.reply_text(f'Invalid filters "{filters}": {ve}, check /set')
+        return
+
+    if not scraper.is_running():
+        scraper.start()
+
+    update.message.reply_text(f'Subscribed with filters {filters}')
 
 def stop(update: Update, context: CallbackContext) -> None:
-    """Send a message when the command /stop is issued."""
+    """Unsubscribes the chat, stops the scraper after the last subscriber"""
+
+    scraper = get_scraper()
 
-    scraper.stop()
+    remaining = scraper.unsubscribe(update.effective_chat.id)
 
-    update.message.reply_text('Scraper stopped')
+    if not remaining and scraper.is_running():
+        scraper.stop()
+        update.message.reply_text('Unsubscribed, scraper stopped')
+    else:
+        update.message.reply_text(f'Unsubscribed, {remaining} chat(s) still subscribed')
 
 def ping(update: Update, context: CallbackContext) -> None:
     update.message.reply_text('pong')
 
 def db_size(update: Update, context: CallbackContext) -> None:
 
+    scraper = get_scraper()
+
     size = scraper.get_pokes_db_size()
-    update.message.reply_text(f'Pokes in db: {size}')
+    update.message.reply_text(
+        f'Pokes in db: {size}\nSubscribed chats: {scraper.get_subscriber_count()}\nUnreachable: {scraper.get_unreachable_count()}'
+    )
+
+def queue_stats(update: Update, context: CallbackContext) -> None:
+
+    scraper = get_scraper()
+
+    stats = scraper.get_sender_stats()
+    update.message.reply_text(
+        f"Queued: {stats['queued']}\nSent: {stats['sent']} (failed {stats['failed']}, expired {stats['expired']}, dropped {stats['dropped']}, retried {stats['retried']})\n"
+        f"Latency: {stats['latency_avg']:.2f}s avg, {stats['latency_p95']:.2f}s p95, {stats['call_latency_avg']:.2f}s per call"
+    )
+
+def poll_intervals(update: Update, context: CallbackContext) -> None:
+
+    scraper = get_scraper()
+
+    lines = []
+    for name, pacer in scraper.get_poll_intervals().items():
+        changes = ', '.join(f'{datetime.fromtimestamp(ts).strftime("%H:%M")} {delay:.0f}s' for ts, delay in pacer.changes())
+        lines.append(f'{name}: every {pacer.delay:.1f}s ({pacer.rate() * 60:.1f} new/min)\n  {changes}')
+
+    update.message.reply_text('\n'.join(lines) or 'Not polling')
 
 def set_filter(update: Update, context: CallbackContext) -> None:
 
-    new_filters = update.message.text[5:]
+    scraper = get_scraper()
+    from filters import compile_filter
+
+    new_filters = update.message.text[5:].strip()
+
+    if not new_filters:
+        current = scraper.get_filters(update.effective_chat.id) or context.user_data.get('filters')
+        update.message.reply_text(f'Filters: {current}' if current else 'No filters set, /set followed by filters sets them')
+        return
+
+    try:
+        compile_filter(new_filters)
+    except ValueError as ve:
+        update.message.reply_text(f'Invalid filters "{new_filters}": {ve}')
+        return
 
     context.user_data['filters'] = new_filters
-    scraper.update_filters(new_filters)
+
+    # subscribed chats get their new filters right away, others with their next /start
+    if scraper.get_filters(update.effective_chat.id) is not None:
+        scraper.subscribe(update.effective_chat.id, new_filters)
 
     update.message.reply_text('Filters updated')
 
+def set_position(update: Update, context: CallbackContext) -> None:
+    """/pos lat,lng sets where the chat starts from, /pos off sends everything again"""
+
+    scraper = get_scraper()
+    from routing import parse_position
+
+    text = update.message.text[5:].strip()
+
+    if not text:
+        position = scraper.get_position(update.effective_chat.id)
+        update.message.reply_text(f'Routing from {position[0]:.5f}, {position[1]:.5f}' if position else 'Not routing, /pos lat,lng to start')
+        return
+
+    if text == 'off':
+        scraper.set_position(update.effective_chat.id, None)
+        update.message.reply_text('Position cleared')
+        return
+
+    position = parse_position(text)
+    if position is None:
+        update.message.reply_text(f'Not a position: "{text}", use /pos lat,lng')
+        return
+
+    scraper.set_position(update.effective_chat.id, position)
+    update.message.reply_text(f'Routing from {position[0]:.5f}, {position[1]:.5f}')
+
+def shared_location(update: Update, context: CallbackContext) -> None:
+    """A shared location works like /pos"""
+
+    scraper = get_scraper()
+
+    location = update.message.location
+    scraper.set_position(update.effective_chat.id, (location.latitude, location.longitude))
+    update.message.reply_text(f'Routing from {location.latitude:.5f}, {location.longitude:.5f}')
+
+def set_digest(update: Update, context: CallbackContext) -> None:
+    """/digest n combines bursts of n or more encounters into one message, /digest off sends them one by one"""
+
+    scraper = get_scraper()
+
+    text = update.message.text[8:].strip()
+
+    if not text:
+        threshold = scraper.get_digest(update.effective_chat.id)
+        update.message.reply_text(f'Bursts of {threshold}+ encounters come as one message' if threshold else 'Sending encounters one by one, /digest n to combine bursts')
+        return
+
+    if text == 'off':
+        threshold = 0
+    elif text.isdigit() and int(text) > 0:
+        threshold = int(text)
+    else:
+        update.message.reply_text(f'Not a number: "{text}", use /digest n or /digest off')
+        return
+
+    scraper.set_digest(update.effective_chat.id, threshold)
+    update.message.reply_text(f'Bursts of {threshold}+ encounters come as one message' if threshold else 'Sending encounters one by one')
+
+def is_admin(update: Update) -> bool:
+    """Profiles show the code and whoever uses the bot, only the admin chat gets them"""
+
+    if str(update.effective_chat.id) == str(BOT_MYSELF_CHAT_ID):
+        return True
+    update.message.reply_text('Only for the admin chat')
+    return False
+
+def send_profile(chat_id, seconds: float) -> None:
+    """Samples all threads for a while and sends the hottest functions, and the stacks as a file"""
+
+    if not profiling.acquire(blocking=False):
+        updater.bot.send_message(chat_id=chat_id, text='Already profiling')
+        return
+
+    try:
+        log.debug(f'Profiling for {seconds:.0f}s')
+        profile = sample_stacks(seconds)
+
+        updater.bot.send_message(chat_id=chat_id, text=profile.report()[:4096])
+        # flamegraph.pl profile.folded > profile.svg, or drop it on speedscope.app
+        updater.bot.send_document(
+            chat_id=chat_id, document=BytesIO(profile.folded().encode()),
+            filename=f'profile-{datetime.now().strftime("%Y%m%d-%H%M%S")}.folded'
+        )
+    except Exception as err:
+        log.error(f'Profiling failed: {err!r}')
+    finally:
+        profiling.release()
+
+def start_profile(chat_id, seconds: float=PROFILE_SECONDS) -> None:
+    """The profile runs on a thread of its own, handlers and signal handlers return right away"""
+    threading.Thread(target=send_profile, args=(chat_id, seconds), name='ored-profile', daemon=True).start()
+
+def profile(update: Update, context: CallbackContext) -> None:
+    """/profile [seconds] samples what every thread does for a while, admin only"""
+
+    if not is_admin(update):
+        return
+
+    text = update.message.text[8:].strip()
+
+    if text and not (text.isdigit() and 1 <= int(text) <= 300):
+        update.message.reply_text(f'Not a number of seconds: "{text}", use /profile or /profile 1-300')
+        return
+
+    seconds = int(text) if text else PROFILE_SECONDS
+    update.message.reply_text(f'Profiling for {seconds}s')
+    start_profile(update.effective_chat.id, seconds)
+
+def spans(update: Update, context: CallbackContext) -> None:
+    """/spans shows how long the stages of the recent polls took, admin only"""
+
+    if not is_admin(update):
+        return
+
+    scraper = get_scraper()
+    update.message.reply_text(summarize_spans(scraper.get_spans())[:4096])
+
 def help_command(update: Update, context: CallbackContext) -> None:
     """Send a message when the command /help is issued."""
     update.message.reply_text('/start to start scraping. /stop to stop it /ping to check if server is alive')
@@ -75,12 +292,109 @@ def echo(update: Update, context: CallbackContext) -> None:
     """Echo the user message."""
     update.message.reply_text(f'I dont know: "{update.message.text}", check /help')
 
-log.debug('Loading scraper')
-scraper = OredScraper(tg_bot=updater.bot, chat_id=BOT_MYSELF_CHAT_ID)
+def load_scraper(loop: Optional[asyncio.AbstractEventLoop]):
+    """Imports and builds the scraper, nothing goes to the network before the first /start"""
+
+    global recorder
+
+    from common.store import open_store
+    from regions import regions_from_config
+    from tiling import TilePlanner
+
+    log.debug('Loading scraper')
+
+    if WORKERS:
+        from sharding import ShardedScraper
+
+        return ShardedScraper(
+            tg_bot=updater.bot,
+            chat_id=BOT_MYSELF_CHAT_ID,
+            workers=WORKERS,
+            regions=regions_from_config(REGIONS) if REGIONS or not AREA else [],
+            planner=TilePlanner(AREA) if AREA else None,
+            store_path=STORE_PATH,
+            claims_path=STORE_PATH,
+            history_path=HISTORY_PATH,
+            position=POSITION,
+            speed_kmh=SPEED_KMH,
+            digest=DIGEST,
+            loop=loop
+        )
+
+    from history import HistoryRecorder
+    from scraper import OredScraper
+
+    recorder = HistoryRecorder(HISTORY_PATH) if HISTORY_PATH else None
+    return OredScraper(
+        tg_bot=updater.bot,
+        chat_id=BOT_MYSELF_CHAT_ID,
+        regions=regions_from_config(REGIONS) if REGIONS or not AREA else [],
+        store=open_store(STORE_PATH, 'encounters'),
+        planner=TilePlanner(AREA) if AREA else None,
+        position=POSITION,
+        speed_kmh=SPEED_KMH,
+        recorder=recorder,
+        digest=DIGEST,
+        loop=loop
+    )
+
+def shutdown() -> None:
+    """Stop scraper when bot gets killed"""
+
+    try:
+        scraper = get_scraper()
+    except Exception:
+        # never loaded, nothing to stop
+        return
+
+    if scraper.is_running():
+        scraper.stop()
+    if recorder is not None:
+        recorder.close()
+
+async def serve_webhook(dispatcher, loop: asyncio.AbstractEventLoop) -> None:
+    """Takes updates posted to WEBHOOK_URL until SIGINT or SIGTERM"""
+
+    from webhook import WebhookServer
+
+    # without a configured secret every run gets its own
+    secret = WEBHOOK_SECRET or os.urandom(24).hex()
+    server = WebhookServer(dispatcher, urlsplit(WEBHOOK_URL).path or '/', secret, WEBHOOK_LISTEN, WEBHOOK_PORT)
+    await server.start()
+
+    # the bot calls block, they must not hold up the polls
+    await loop.run_in_executor(None, lambda: updater.bot.set_webhook(WEBHOOK_URL, secret_token=secret))
+
+    stopped = asyncio.Event()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopped.set)
+    loop.add_signal_handler(signal.SIGUSR1, start_profile, BOT_MYSELF_CHAT_ID)
+    await stopped.wait()
+
+    # the webhook stays set, Telegram keeps the updates until the next start
+    await server.close()
+    await loop.run_in_executor(None, shutdown)
 
 def main() -> None:
     """Start the bot."""
 
+    global updater, scraper_future
+
+    # Create the Updater and pass it your bot's token.
+    updater = Updater(BOT_AUTH_TOKEN, base_url=BOT_API_URL or None)
+    setup_logging()
+
+    # with a webhook the updates come in on the event loop of the scraper, run by the main thread
+    loop = asyncio.new_event_loop() if WEBHOOK_URL else None
+
+    # the bot answers right away, commands needing the scraper wait for it. Who the bot
+    # is is asked in the meantime as well, instead of with the first command
+    startup = ThreadPoolExecutor(max_workers=2, thread_name_prefix='ored-startup')
+    scraper_future = startup.submit(load_scraper, loop)
+    scraper_future.add_done_callback(scraper_loaded)
+    startup.submit(updater.bot.get_me)
+    startup.shutdown(wait=False)
+
     # Get the dispatcher to register handlers
     dispatcher = updater.dispatcher
 
@@ -88,27 +402,42 @@ def main() -> None:
     dispatcher.add_handler(CommandHandler("start", start))
     dispatcher.add_handler(CommandHandler("stop", stop))
     dispatcher.add_handler(CommandHandler("size", db_size))
+    dispatcher.add_handler(CommandHandler("queue", queue_stats))
+    dispatcher.add_handler(CommandHandler("pace", poll_intervals))
     dispatcher.add_handler(CommandHandler("ping", ping))
     dispatcher.add_handler(CommandHandler("set", set_filter))
+    dispatcher.add_handler(CommandHandler("pos", set_position))
+    dispatcher.add_handler(CommandHandler("digest", set_digest))
+    dispatcher.add_handler(CommandHandler("profile", profile))
+    dispatcher.add_handler(CommandHandler("spans", spans))
     dispatcher.add_handler(CommandHandler("help", help_command))
 
     # on noncommand i.e message - echo the message on Telegram
+    dispatcher.add_handler(MessageHandler(Filters.location, shared_location))
     dispatcher.add_handler(MessageHandler(Filters.text & ~Filters.command, echo))
     dispatcher.add_error_handler(error)
 
+    # nothing is collected on top of the counters unless something reads them
+    start_exporter(METRICS_PORT, METRICS_TEXTFILE)
+
     log.debug('Starting...')
 
-    # Start the Bot
-    updater.start_polling()
+    if WEBHOOK_URL:
+        loop.run_until_complete(serve_webhook(dispatcher, loop))
+        loop.close()
+    else:
+        # Start the Bot
+        updater.start_polling()
 
-    # Run the bot until you press Ctrl-C or the process receives SIGINT,
-    # SIGTERM or SIGABRT. This should be used most of the time, since
-    # start_polling() is non-blocking and will stop the bot gracefully.
-    updater.idle()
+        # kill -USR1 sends a profile to the admin chat, like /profile
+        signal.signal(signal.SIGUSR1, lambda signum, frame: start_profile(BOT_MYSELF_CHAT_ID))
 
-    # Stop scraper when bot gets killed
-    if scraper.is_running():
-        scraper.stop()
+        # Run the bot until you press Ctrl-C or the process receives SIGINT,
+        # SIGTERM or SIGABRT. This should be used most of the time, since
+        # start_polling() is non-blocking and will stop the bot gracefully.
+        updater.idle()
+
+        shutdown()
 
     log.debug('Killed')
 
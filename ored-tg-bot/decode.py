@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+import json
+import re
+from functools import partial
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Union
+
+
+class Encounter(NamedTuple):
+    """ The fields of a pokemon the scraper actually uses """
+
+    encounter_id: str
+    pokemon_id: int
+    pokemon_name: str
+    individual_attack: Optional[int]
+    individual_defense: Optional[int]
+    individual_stamina: Optional[int]
+    level: Optional[int]
+    cp: Optional[int]
+    # in ms
+    disappear_time: int
+    is_verified_despawn: bool
+    latitude: float
+    longitude: float
+
+
+FIELDS = Encounter._fields
+
+ENCOUNTER_ID_PATTERN = re.compile(rb'"encounter_id"\s*:\s*"?([^",}\s]+)')
+
+# server time of a response, sent back to only get what changed since
+TIMESTAMP_PATTERN = re.compile(rb'"timestamp"\s*:\s*"?(\d+)')
+
+class InvalidResponse(ValueError):
+    """ The response is JSON, but its "pokemons" arent a list """
+
+
+# decodes the whole response, then projects only unknown pokemons into Encounters,
+# telling the callback why a pokemon was skipped
+Decoder = Callable[[bytes, Callable[[str], bool], Callable[[str], None]], List[Encounter]]
+
+
+# without these a pokemon cant be told apart from others, filtered or placed
+REQUIRED = ('encounter_id', 'pokemon_id', 'disappear_time', 'latitude', 'longitude')
+
+
+def _int(value: Any) -> int:
+    """ Whole numbers as msgspec takes them leniently: 12, 12.0 and "12" """
+
+    if type(value) is int:
+        return value
+    if isinstance(value, bool):
+        raise ValueError(f'{value!r} is no number')
+
+    number = float(value)
+    if not number.is_integer():
+        raise ValueError(f'{value!r} is no whole number')
+    return int(number)
+
+
+def _number(value: Any) -> Union[int, float]:
+
+    if type(value) is float or type(value) is int:
+        return value
+    if isinstance(value, bool):
+        raise ValueError(f'{value!r} is no number')
+    return float(value)
+
+
+def _optional(convert: Callable[[Any], Any], value: Any) -> Any:
+    return None if value is None else convert(value)
+
+
+def _check_required(get: Callable[[str], Any]) -> None:
+
+    missing = [ field for field in REQUIRED if get(field) is None ]
+    if missing:
+        raise ValueError(f'{", ".join(missing)} missing')
+
+
+def _encounter(get: Callable[[str], Any]) -> Encounter:
+    """ The fields of a decoded pokemon checked the way msgspec does it, ValueError or TypeError for one that cant be used """
+
+    _check_required(get)
+
+    pokemon_id = _int(get('pokemon_id'))
+    name = get('pokemon_name')
+
+    return Encounter(
+        str(get('encounter_id')), pokemon_id, f'#{pokemon_id}' if name is None else str(name),
+        _optional(_int, get('individual_attack')), _optional(_int, get('individual_defense')), _optional(_int, get('individual_stamina')),
+        _optional(_number, get('level')), _optional(_int, get('cp')), _number(get('disappear_time')), bool(get('is_verified_despawn')),
+        _number(get('latitude')), _number(get('longitude'))
+    )
+
+
+def _pokemons(data: Any) -> Any:
+
+    if not isinstance(data, dict):
+        raise InvalidResponse(f'response is {type(data).__name__}, not an object')
+    return data['pokemons']
+
+
+def _project(pokes: Any, is_known: Callable[[str], bool], skipped: Callable[[str], None]) -> List[Encounter]:
+
+    if not isinstance(pokes, list):
+        raise InvalidResponse(f'"pokemons" is {type(pokes).__name__}, not a list')
+
+    encounters = []
+
+    for poke in pokes:
+        if not isinstance(poke, dict):
+            skipped(f'{poke!r:.100} is no object')
+            continue
+
+        if is_known(str(poke.get('encounter_id', ''))):
+            continue
+
+        try:
+            encounters.append(_encounter(poke.get))
+        except (ValueError, TypeError) as e:
+            skipped(f'{poke.get("encounter_id")}: {e}')
+
+    return encounters
+
+
+def _decode_json(body: bytes, is_known: Callable[[str], bool], skipped: Callable[[str], None]) -> List[Encounter]:
+    return _project(_pokemons(json.loads(body)), is_known, skipped) # sic!
+
+
+DECODERS: Dict[str, Decoder] = { 'json': _decode_json }
+
+try:
+    import orjson
+
+    def _decode_orjson(body: bytes, is_known: Callable[[str], bool], skipped: Callable[[str], None]) -> List[Encounter]:
+        return _project(_pokemons(orjson.loads(body)), is_known, skipped)
+
+    DECODERS['orjson'] = _decode_orjson
+except ImportError:
+    pass
+
+try:
+    import msgspec
+
+    class _Poke(msgspec.Struct):
+        """ Only these fields get decoded, everything else is skipped by msgspec
+
+        Decoded leniently (1 for true, "12" for 12, floats where ints are
+        usual), `_encounter` takes the same from the json backends.
+        """
+
+        encounter_id: Union[int, str, None] = None
+        pokemon_id: Optional[int] = None
+        pokemon_name: Optional[str] = None
+        individual_attack: Optional[int] = None
+        individual_defense: Optional[int] = None
+        individual_stamina: Optional[int] = None
+        level: Union[int, float, None] = None
+        cp: Optional[int] = None
+        disappear_time: Union[int, float, None] = None
+        is_verified_despawn: Optional[bool] = None
+        latitude: Optional[float] = None
+        longitude: Optional[float] = None
+
+    # anything but objects is skipped below
+    _Entry = Union[_Poke, None, bool, int, float, str, list]
+
+    class _Response(msgspec.Struct):
+        # missing is told apart from null
+        pokemons: Union[List[_Entry], None, msgspec.UnsetType] = msgspec.UNSET
+
+    class _RawResponse(msgspec.Struct):
+        pokemons: List[msgspec.Raw]
+
+    _response_decoder = msgspec.json.Decoder(_Response, strict=False)
+    _raw_decoder = msgspec.json.Decoder(_RawResponse)
+    _entry_decoder = msgspec.json.Decoder(_Entry, strict=False)
+
+    def _entries(body: bytes, is_known: Callable[[str], bool], skipped: Callable[[str], None]) -> List:
+        """ The unknown pokemons one by one, without those with a bad field, after they failed the response """
+
+        entries = []
+        for raw in _raw_decoder.decode(body).pokemons:
+            match = ENCOUNTER_ID_PATTERN.search(raw)
+            enc_id = match[1].decode() if match else None
+            if enc_id is not None and is_known(enc_id):
+                continue
+
+            try:
+                entries.append(_entry_decoder.decode(raw))
+            except msgspec.ValidationError as ve:
+                skipped(f'{enc_id}: {ve}')
+        return entries
+
+    def _decode_msgspec(body: bytes, is_known: Callable[[str], bool], skipped: Callable[[str], None]) -> List[Encounter]:
+
+        try:
+            pokes = _response_decoder.decode(body).pokemons
+        except msgspec.ValidationError as ve:
+            # "pokemons" is a list, one of them has a bad field
+            try:
+                pokes = _entries(body, is_known, skipped)
+            except msgspec.ValidationError:
+                raise InvalidResponse(str(ve)) from ve
+        except msgspec.DecodeError as de:
+            raise ValueError(str(de)) from de
+
+        if pokes is msgspec.UNSET:
+            raise KeyError('pokemons')
+        if pokes is None:
+            raise InvalidResponse('"pokemons" is NoneType, not a list')
+
+        encounters = []
+
+        for poke in pokes:
+            if not isinstance(poke, _Poke):
+                skipped(f'{poke!r:.100} is no object')
+                continue
+
+            enc_id = str(poke.encounter_id)
+            if is_known(enc_id):
+                continue
+
+            try:
+                _check_required(partial(getattr, poke))
+            except ValueError as e:
+                skipped(f'{poke.encounter_id}: {e}')
+                continue
+
+            encounters.append(Encounter(
+                enc_id, poke.pokemon_id, f'#{poke.pokemon_id}' if poke.pokemon_name is None else poke.pokemon_name,
+                poke.individual_attack, poke.individual_defense, poke.individual_stamina,
+                poke.level, poke.cp, poke.disappear_time, bool(poke.is_verified_despawn),
+                poke.latitude, poke.longitude
+            ))
+
+        return encounters
+
+    DECODERS['msgspec'] = _decode_msgspec
+except ImportError:
+    pass
+
+# fastest one available
+BACKEND = next(name for name in ('msgspec', 'orjson', 'json') if name in DECODERS)
+
+
+def decode_pokemons(body: bytes, is_known: Callable[[str], bool], backend: str=BACKEND,
+                    skipped: Callable[[str], None]=lambda reason: None) -> List[Encounter]:
+    """ Returns the pokemons of a response that are not known yet
+
+    If a quick scan over the raw bytes finds only known encounter ids the
+    JSON is not decoded at all.
+
+    Pokemons that arent objects or have a field that cant be what it should
+    are left out, `skipped` gets why. Raises ValueError for invalid JSON,
+    KeyError if "pokemons" is missing and InvalidResponse if it isnt a list.
+    """
+
+    # every id is known, nothing to decode (the scan stops at the first unknown one,
+    # a nested encounter_id somewhere would only cost a full decode)
+    if b'"pokemons"' in body and all(is_known(m[1].decode()) for m in ENCOUNTER_ID_PATTERN.finditer(body)):
+        return []
+
+    return DECODERS[backend](body, is_known, skipped)
+
+
+def decode_timestamp(body: bytes) -> Optional[int]:
+    """ The "timestamp" of a response, None if it has none
+
+    Found with a scan over the raw bytes, so it costs nothing extra when the
+    pokemons are not decoded at all.
+    """
+
+    match = TIMESTAMP_PATTERN.search(body)
+    return int(match[1]) if match else None
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+import heapq
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+
+class EncounterIndex:
+    """ Remembers encounters until they despawn
+
+    Despawn times are kept in a min-heap next to the lookup dict, so
+    expired encounters are evicted a few at a time on every insert or
+    lookup instead of scanning the whole db periodically.
+
+    (for simplicity, we consider encounters with less than `grace`
+    seconds remaining time to be expired, since we couldnt get to them
+    anyway)
+
+    If a `store` (see common/store.py) is given, live encounters are read
+    from it on creation and every add is written through to it.
+    """
+
+    def __init__(self, grace: float=5, clock: Callable[[], float]=time.time, store=None) -> None:
+        self.grace = grace
+        self.__clock = clock
+        self.__store = store
+        self.__despawns: Dict[str, float] = dict()
+        self.__heap: List[Tuple[float, str]] = []
+
+        if store is not None:
+            for enc_id, (_, despawn_time) in store.load(clock()).items():
+                self.__despawns[enc_id] = despawn_time
+            self.__heap = [(t, e) for e, t in self.__despawns.items()]
+            heapq.heapify(self.__heap)
+
+    def __evict(self, now: float) -> None:
+
+        heap = self.__heap
+        limit = now + self.grace
+
+        while heap and heap[0][0] < limit:
+            despawn_time, enc_id = heapq.heappop(heap)
+
+            # skip heap entries that got replaced by a later add
+            if self.__despawns.get(enc_id) == despawn_time:
+                del self.__despawns[enc_id]
+
+    def is_expired(self, despawn_time: float, now: Optional[float]=None) -> bool:
+        """ Whether an encounter despawning at `despawn_time` (in s) counts as expired """
+
+        return despawn_time - (self.__clock() if now is None else now) < self.grace
+
+    def add(self, enc_id: str, despawn_time: float) -> None:
+        """ Stores the encounter until `despawn_time` (in s) """
+
+        self.__evict(self.__clock())
+
+        if self.__despawns.get(enc_id) == despawn_time:
+            return
+
+        self.__despawns[enc_id] = despawn_time
+        heapq.heappush(self.__heap, (despawn_time, enc_id))
+
+        if self.__store is not None:
+            self.__store.put(enc_id, '', despawn_time)
+
+        # rebuild the heap once replaced entries make up most of it
+        if len(self.__heap) > 2 * len(self.__despawns) + 64:
+            self.__heap = [(t, e) for e, t in self.__despawns.items()]
+            heapq.heapify(self.__heap)
+
+    def __contains__(self, enc_id: str) -> bool:
+        self.__evict(self.__clock())
+        return enc_id in self.__despawns
+
+    def flush(self) -> None:
+        """ Writes out adds the store still buffers """
+
+        if self.__store is not None:
+            self.__store.flush()
+
+    def __len__(self) -> int:
+        return len(self.__despawns)
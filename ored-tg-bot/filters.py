@@ -0,0 +1,559 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+""" Compiles filters into predicates (and numpy masks) over Encounters
+
+Filters are small expressions, e.g.
+
+    iv >= 90 and (species in {113, 242} or cp > 2500) and verified
+    not species in {16, 19} and remaining > 300 and dist(52.52, 13.40) < 2.5
+    iv in 82..100 and level >= 25
+
+- fields: species, iv (percent), atk, def, sta, cp, level, lat, lng,
+  remaining (seconds until despawn), verified, dist(lat, lng) (km)
+- comparisons: < <= > >= == !=, sets: in {a, b}, ranges: in a..b (inclusive)
+- and, or, not, parentheses
+
+Unknown values (IVs, CP and level of unscanned encounters) never compare
+true. The old "iv=97&exiv=113,149" strings still work, they are translated
+into the same expressions.
+"""
+
+import logging
+import math
+import operator
+import re
+from typing import Callable, Dict, FrozenSet, List, NamedTuple, Optional, Sequence, Tuple
+
+from decode import Encounter
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+log = logging.getLogger('ored-tg')
+
+DEFAULT_FILTERS = 'iv=97&exiv=113,149'
+
+EARTH_RADIUS_KM = 6371.0088
+
+# a degree of latitude is never shorter than this (in km), used to bound dist() cheaply
+KM_PER_DEG_LAT_MIN = 110.5
+
+# fields that are None for encounters that werent scanned
+NULLABLE = { 'atk', 'def', 'sta', 'cp', 'level' }
+
+# field -> its Encounter attribute (iv, remaining and dist are computed)
+ATTRIBUTES = {
+    'species': 'pokemon_id',
+    'atk': 'individual_attack',
+    'def': 'individual_defense',
+    'sta': 'individual_stamina',
+    'cp': 'cp',
+    'level': 'level',
+    'lat': 'latitude',
+    'lng': 'longitude',
+}
+
+NUMERIC = set(ATTRIBUTES) | { 'iv', 'remaining' }
+
+OPERATORS = {
+    '<': operator.lt, '<=': operator.le, '>': operator.gt,
+    '>=': operator.ge, '==': operator.eq, '!=': operator.ne,
+}
+
+TOKEN_PATTERN = re.compile(r'\s*(?:(-?\d+(?:\.\d+)?)|(\.\.)|(<=|>=|==|!=|<|>)|([A-Za-z_]+)|([(){}\[\],]))')
+
+# a legacy filter starts with "key=" (a single "=")
+LEGACY_PATTERN = re.compile(r'\s*[a-z]+\s*=(?!=)')
+
+Predicate = Callable[[Encounter, float], bool]
+
+
+class CompiledFilter(NamedTuple):
+    """ A filter turned into a predicate
+
+    `predicate(encounter, now)` decides a single encounter (now in s),
+    `mask(columns, now)` a whole batch at once if numpy is available.
+
+    `min_iv` and `exempt` are what the upstream request can do for this
+    filter: every encounter it matches has at least `min_iv` percent IV
+    or is one of the `exempt` species.
+    """
+
+    text: str
+    predicate: Predicate
+    min_iv: float
+    exempt: FrozenSet[int]
+    mask: Optional[Callable[['Columns', float], 'np.ndarray']] = None
+    source: str = ''
+
+
+def iv_percent(enc: Encounter) -> Optional[float]:
+    """ IVs in percent, None if unknown """
+
+    if enc.individual_attack is None:
+        return None
+
+    return (enc.individual_attack + enc.individual_defense + enc.individual_stamina) / 45 * 100
+
+
+def haversine_km(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+
+    d_lat = math.radians(lat2 - lat1)
+    d_lng = math.radians(lng2 - lng1)
+    a = math.sin(d_lat / 2) ** 2 + math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.sin(d_lng / 2) ** 2
+
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(a))
+
+
+# --- parsing ---
+
+def _tokenize(text: str) -> List[Tuple[str, str]]:
+    """ Returns (kind, value) tokens, kind is one of num, range, op, name, punct """
+
+    tokens = []
+    pos = 0
+    text = text.rstrip()
+
+    while pos < len(text):
+        m = TOKEN_PATTERN.match(text, pos)
+        if not m:
+            raise ValueError(f'Unexpected "{text[pos:].strip()[:10]}" at {pos}')
+
+        kind = ('num', 'range', 'op', 'name', 'punct')[m.lastindex - 1]
+        tokens.append((kind, m[m.lastindex]))
+        pos = m.end()
+
+    return tokens
+
+
+class _Parser:
+    """ Recursive descent over the tokens, builds a tuple AST
+
+        expr      := term ('or' term)*
+        term      := factor ('and' factor)*
+        factor    := 'not' factor | '(' expr ')' | condition
+        condition := 'verified' | operand OP number | operand ['not'] 'in' (set | number '..' number)
+        operand   := field | 'dist' '(' number ',' number ')'
+    """
+
+    def __init__(self, text: str) -> None:
+        self.__tokens = _tokenize(text)
+        self.__pos = 0
+
+    def __peek(self) -> Tuple[str, str]:
+        return self.__tokens[self.__pos] if self.__pos < len(self.__tokens) else ('end', '')
+
+    def __next(self) -> Tuple[str, str]:
+        token = self.__peek()
+        self.__pos += 1
+        return token
+
+    def __expect(self, value: str) -> None:
+        kind, got = self.__next()
+        if got != value:
+            raise ValueError(f'Expected "{value}", got "{got or "end of filter"}"')
+
+    def __number(self) -> float:
+        kind, value = self.__next()
+        if kind != 'num':
+            raise ValueError(f'Expected a number, got "{value or "end of filter"}"')
+        return float(value)
+
+    def parse(self) -> tuple:
+
+        node = self.__expr()
+
+        if self.__peek()[0] != 'end':
+            raise ValueError(f'Unexpected "{self.__peek()[1]}"')
+        return node
+
+    def __expr(self) -> tuple:
+
+        node = self.__term()
+        while self.__peek() == ('name', 'or'):
+            self.__next()
+            node = ('or', node, self.__term())
+        return node
+
+    def __term(self) -> tuple:
+
+        node = self.__factor()
+        while self.__peek() == ('name', 'and'):
+            self.__next()
+            node = ('and', node, self.__factor())
+        return node
+
+    def __factor(self) -> tuple:
+
+        token = self.__peek()
+
+        if token == ('name', 'not'):
+            self.__next()
+            return ('not', self.__factor())
+
+        if token == ('punct', '('):
+            self.__next()
+            node = self.__expr()
+            self.__expect(')')
+            return node
+
+        return self.__condition()
+
+    def __condition(self) -> tuple:
+
+        kind, name = self.__next()
+
+        if kind != 'name':
+            raise ValueError(f'Expected a field, got "{name or "end of filter"}"')
+
+        if name == 'verified':
+            return ('verified',)
+
+        if name == 'dist':
+            self.__expect('(')
+            lat = self.__number()
+            self.__expect(',')
+            lng = self.__number()
+            self.__expect(')')
+            operand = ('dist', lat, lng)
+        elif name in NUMERIC:
+            operand = name
+        else:
+            raise ValueError(f'Unknown field "{name}"')
+
+        kind, op = self.__next()
+
+        if kind == 'op':
+            return ('cmp', operand, op, self.__number())
+
+        negate = (kind, op) == ('name', 'not')
+        if negate:
+            kind, op = self.__next()
+
+        if (kind, op) != ('name', 'in'):
+            raise ValueError(f'Expected a comparison or "in" after "{name}", got "{op or "end of filter"}"')
+
+        if self.__peek() in (('punct', '{'), ('punct', '[')):
+            closing = '}' if self.__next()[1] == '{' else ']'
+            values = [ self.__number() ]
+            while self.__peek() == ('punct', ','):
+                self.__next()
+                values.append(self.__number())
+            self.__expect(closing)
+            node = ('in', operand, frozenset(int(v) if v.is_integer() else v for v in values))
+        else:
+            low = self.__number()
+            if self.__next() != ('range', '..'):
+                raise ValueError(f'Expected a set {{a, b}} or a range a..b after "{name} in"')
+            node = ('range', operand, low, self.__number())
+
+        return ('not', node) if negate else node
+
+
+def parse(text: str) -> tuple:
+    """ Parses an expression into its AST, raises ValueError if it is malformed """
+
+    if not text.strip():
+        raise ValueError('Filter is empty')
+
+    return _Parser(text).parse()
+
+
+def _scale(operand, number: float) -> float:
+    """ Converts a constant to the unit the operand is computed in: IV sums and ms """
+
+    if operand == 'iv':
+        return number * 45 / 100
+    if operand == 'remaining':
+        return number * 1000
+    return number
+
+
+def _ints(value: str) -> FrozenSet[int]:
+    return frozenset(int(part) for part in value.split(',') if part.strip())
+
+
+def translate_legacy(text: str) -> str:
+    """ Turns "iv=97&exiv=113,149&lvl=20&only=1,2&area=swLat,swLng,neLat,neLng" into an expression """
+
+    min_iv = 0.0
+    exempt: FrozenSet[int] = frozenset()
+    clauses = []
+
+    for part in text.strip().split('&'):
+        key, sep, value = part.partition('=')
+
+        if not sep:
+            raise ValueError(f'Filter "{part}" is missing a "="')
+
+        key, value = key.strip(), value.strip()
+
+        if key == 'iv':
+            min_iv = float(value)
+        elif key == 'exiv':
+            exempt = _ints(value)
+        elif key == 'lvl':
+            clauses.append(f'level >= {int(value)}')
+        elif key == 'only':
+            clauses.append(f'species in {{{", ".join(str(s) for s in sorted(_ints(value)))}}}')
+        elif key == 'area':
+            area = [float(corner) for corner in value.split(',')]
+            if len(area) != 4:
+                raise ValueError(f'Area needs swLat,swLng,neLat,neLng, got "{value}"')
+            clauses.append(f'lat in {area[0]}..{area[2]} and lng in {area[1]}..{area[3]}')
+        else:
+            log.debug(f'Dont know filter: "{part}", ignoring...')
+
+    # unknown IVs only ever matched without a minimum
+    if min_iv > 0:
+        iv = f'iv >= {min_iv:g}'
+        if exempt:
+            iv = f'(species in {{{", ".join(str(s) for s in sorted(exempt))}}} or {iv})'
+        clauses.append(iv)
+
+    return ' and '.join(clauses)
+
+
+# --- analysis ---
+
+def bounds(node: tuple) -> Tuple[float, FrozenSet[int]]:
+    """ Returns (min IV, species) such that every match has at least min IV or is one of species """
+
+    kind = node[0]
+
+    if kind in ('cmp', 'range') and node[1] == 'iv':
+        if kind == 'range':
+            return node[2], frozenset()
+        if node[2] in ('>=', '>', '=='):
+            return node[3], frozenset()
+
+    if kind == 'in' and node[1] == 'species':
+        return math.inf, node[2]
+    if kind == 'cmp' and node[1] == 'species' and node[2] == '==':
+        return math.inf, frozenset([int(node[3])])
+
+    if kind == 'and':
+        left, right = bounds(node[1]), bounds(node[2])
+        # a side restricted to a few species alone is as tight as it gets
+        for side in sorted((left, right), key=lambda b: len(b[1])):
+            if side[0] == math.inf:
+                return side
+        return max(left[0], right[0]), left[1] | right[1]
+
+    if kind == 'or':
+        left, right = bounds(node[1]), bounds(node[2])
+        return min(left[0], right[0]), left[1] | right[1]
+
+    # anything else (not, cp, dist, ...) doesnt restrict IVs at all
+    return 0.0, frozenset()
+
+
+# --- code generation ---
+
+class _Codegen:
+    """ Turns the AST into the source of one Python function
+
+    Constant sets end up in the function's globals, IV thresholds are
+    rescaled to the IV sum and dist() is guarded by a cheap latitude check.
+    """
+
+    def __init__(self) -> None:
+        self.namespace: Dict[str, object] = { '_haversine': haversine_km }
+
+    def __constant(self, value) -> str:
+        name = f'_c{len(self.namespace)}'
+        self.namespace[name] = value
+        return name
+
+    def __value(self, operand) -> Tuple[str, Optional[str]]:
+        """ Returns (expression, None check), constants are scaled by `_scale` """
+
+        if operand == 'iv':
+            return '(e.individual_attack + e.individual_defense + e.individual_stamina)', 'e.individual_attack is not None'
+        if operand == 'remaining':
+            return '(e.disappear_time - now * 1000)', None
+        if isinstance(operand, tuple):
+            _, lat, lng = operand
+            return f'_haversine(e.latitude, e.longitude, {lat!r}, {lng!r})', None
+
+        attribute = f'e.{ATTRIBUTES[operand]}'
+        return attribute, f'{attribute} is not None' if operand in NULLABLE else None
+
+    def __guard(self, check: Optional[str], expr: str) -> str:
+        return f'({check} and {expr})' if check else f'({expr})'
+
+    def emit(self, node: tuple) -> str:
+
+        kind = node[0]
+
+        if kind == 'and':
+            return f'({self.emit(node[1])} and {self.emit(node[2])})'
+        if kind == 'or':
+            return f'({self.emit(node[1])} or {self.emit(node[2])})'
+        if kind == 'not':
+            return f'(not {self.emit(node[1])})'
+        if kind == 'verified':
+            return 'bool(e.is_verified_despawn)'
+
+        operand = node[1]
+        value, check = self.__value(operand)
+
+        if kind == 'cmp':
+            _, _, op, number = node
+            expr = f'{value} {op} {_scale(operand, number)!r}'
+
+            # most points are far away, skip the trigonometry for them
+            if isinstance(operand, tuple) and op in ('<', '<='):
+                check = f'abs(e.latitude - {operand[1]!r}) <= {number / KM_PER_DEG_LAT_MIN!r}'
+            return self.__guard(check, expr)
+
+        if kind == 'range':
+            _, _, low, high = node
+            return self.__guard(check, f'{_scale(operand, low)!r} <= {value} <= {_scale(operand, high)!r}')
+
+        # in
+        values = frozenset(_scale(operand, v) for v in node[2])
+        return self.__guard(check, f'{value} in {self.__constant(values)}')
+
+
+def _compile_predicate(node: tuple) -> Tuple[Predicate, str]:
+
+    codegen = _Codegen()
+    source = f'def _filter(e, now):\n    return {codegen.emit(node)}\n'
+
+    # only whitelisted names and parsed numbers make it into the source, see _Codegen
+    exec(compile(source, '<filter>', 'exec'), codegen.namespace)
+
+    return codegen.namespace['_filter'], source
+
+
+# --- vectorized ---
+
+class Columns:
+    """ A batch of encounters as numpy columns, built on first use and shared by every mask """
+
+    def __init__(self, encounters: Sequence[Encounter]) -> None:
+        self.encounters = encounters
+        self.__columns: Dict[str, 'np.ndarray'] = dict()
+
+    def __len__(self) -> int:
+        return len(self.encounters)
+
+    def __build(self, name: str) -> 'np.ndarray':
+
+        encs = self.encounters
+        nan = math.nan
+
+        if name == 'iv':
+            # the IV sum, same unit as in the predicates
+            return np.fromiter(
+                (e.individual_attack + e.individual_defense + e.individual_stamina if e.individual_attack is not None else nan for e in encs),
+                dtype=np.float64, count=len(encs)
+            )
+        if name == 'despawn':
+            return np.fromiter((e.disappear_time for e in encs), dtype=np.float64, count=len(encs))
+        if name == 'verified':
+            return np.fromiter((bool(e.is_verified_despawn) for e in encs), dtype=bool, count=len(encs))
+
+        index = Encounter._fields.index(ATTRIBUTES[name])
+        if name in NULLABLE:
+            values = (nan if e[index] is None else e[index] for e in encs)
+        else:
+            values = (e[index] for e in encs)
+
+        return np.fromiter(values, dtype=np.float64, count=len(encs))
+
+    def __getitem__(self, name: str) -> 'np.ndarray':
+
+        column = self.__columns.get(name)
+        if column is None:
+            column = self.__columns[name] = self.__build(name)
+        return column
+
+
+def haversine_km_np(lat, lng, lat0, lng0) -> 'np.ndarray':
+    """ Degrees in, km out, arrays and scalars broadcast against each other """
+
+    lat, lng, lat0, lng0 = np.radians(lat), np.radians(lng), np.radians(lat0), np.radians(lng0)
+    a = np.sin((lat - lat0) / 2) ** 2 + np.cos(lat) * np.cos(lat0) * np.sin((lng - lng0) / 2) ** 2
+
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1)))
+
+
+def _compile_mask(node: tuple) -> Callable[[Columns, float], 'np.ndarray']:
+    """ Same semantics as the predicate, NaN (unknown) compares false everywhere """
+
+    kind = node[0]
+
+    if kind in ('and', 'or'):
+        left, right = _compile_mask(node[1]), _compile_mask(node[2])
+        combine = np.logical_and if kind == 'and' else np.logical_or
+        return lambda cols, now: combine(left(cols, now), right(cols, now))
+
+    if kind == 'not':
+        inner = _compile_mask(node[1])
+        return lambda cols, now: ~inner(cols, now)
+
+    if kind == 'verified':
+        return lambda cols, now: cols['verified']
+
+    operand = node[1]
+
+    if operand == 'remaining':
+        values = lambda cols, now: cols['despawn'] - now * 1000
+    elif isinstance(operand, tuple):
+        _, lat0, lng0 = operand
+        values = lambda cols, now: haversine_km_np(cols['lat'], cols['lng'], lat0, lng0)
+    else:
+        values = lambda cols, now: cols[operand]
+
+    # NaN != x is true, unknown values have to fail that one explicitly
+    known = operand in NULLABLE or operand == 'iv'
+
+    if kind == 'cmp':
+        _, _, op, number = node
+        number = _scale(operand, number)
+        func = OPERATORS[op]
+        if known and op == '!=':
+            return lambda cols, now: (lambda v: func(v, number) & ~np.isnan(v))(values(cols, now))
+        return lambda cols, now: func(values(cols, now), number)
+
+    if kind == 'range':
+        low, high = _scale(operand, node[2]), _scale(operand, node[3])
+        return lambda cols, now: (lambda v: (v >= low) & (v <= high))(values(cols, now))
+
+    members = np.array(sorted(_scale(operand, v) for v in node[2]), dtype=np.float64)
+    return lambda cols, now: np.isin(values(cols, now), members)
+
+
+def to_expression(text: str) -> str:
+    """ Returns the expression of a filter, translating legacy strings """
+
+    return translate_legacy(text) if LEGACY_PATTERN.match(text) else text
+
+
+def compile_filter(text: str) -> CompiledFilter:
+    """ Compiles a filter expression (or a legacy "iv=97&exiv=113,149" string)
+
+    Raises ValueError for malformed and empty filters.
+    """
+
+    # nothing at all is a mistake, not a wish for every spawn
+    if not text.strip():
+        raise ValueError('Filter is empty')
+
+    expression = to_expression(text)
+
+    # a legacy filter without restrictions ("exiv=") matches everything
+    if not expression.strip():
+        return CompiledFilter(text, lambda e, now: True, 0.0, frozenset(),
+                              (lambda cols, now: np.ones(len(cols), dtype=bool)) if np is not None else None)
+
+    node = parse(expression)
+    predicate, source = _compile_predicate(node)
+    min_iv, exempt = bounds(node)
+
+    return CompiledFilter(text, predicate, min_iv, exempt, _compile_mask(node) if np is not None else None, source)
@@ -0,0 +1,328 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+""" Records every new encounter for later analysis, and queries the records
+
+Records are fixed-width little-endian structs (`RECORD`, 33 bytes) appended
+to one file per hour (UTC) of first sight, e.g. `20240501-13.rec`, so a file
+is just an array that can be memory mapped as is. Writes are buffered and
+go out in batches from a thread of their own, recording costs the polls a
+`struct.pack` per encounter.
+
+    python3 history.py DIR summary
+    python3 history.py DIR heatmap [--cell 0.5] [--top 20]
+    python3 history.py DIR hours
+    python3 history.py DIR species [--min-iv 90]
+
+all with optional `--since 2024-05-01 --until 2024-05-02T12` and
+`--box swLat,swLng,neLat,neLng`. `heatmap` shows spawns per hour and how
+much time was left on them when first seen per cell: cells where that is
+short are polled too slowly. Queries need numpy.
+"""
+
+import argparse
+import glob
+import logging
+import os
+import queue
+import struct
+import sys
+import time
+import zlib
+from datetime import datetime, timezone
+from threading import Thread
+from typing import Dict, Iterable, List, Optional
+
+from decode import Encounter
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+log = logging.getLogger('ored-tg')
+
+# encounter_id, first_seen, disappear_time (both unix s), lat, lng, species, cp,
+# atk, def, sta, level, flags
+RECORD = struct.Struct('<QIIffHHBBBBB')
+
+FIELDS = ('encounter_id', 'first_seen', 'disappear_time', 'lat', 'lng', 'species', 'cp', 'atk', 'def', 'sta', 'level', 'flags')
+
+# unknown IVs, the unknown CP or level are 0
+UNKNOWN_IV = 255
+VERIFIED = 1
+
+SUFFIX = '.rec'
+
+if np is not None:
+    DTYPE = np.dtype({
+        'names': FIELDS,
+        'formats': ['<u8', '<u4', '<u4', '<f4', '<f4', '<u2', '<u2', 'u1', 'u1', 'u1', 'u1', 'u1'],
+        'offsets': [0, 8, 12, 16, 20, 24, 26, 28, 29, 30, 31, 32],
+        'itemsize': RECORD.size,
+    })
+
+
+def _encounter_id(enc_id: str) -> int:
+    """ Ids are decimal numbers, anything else gets a checksum """
+
+    if enc_id.isdigit() and len(enc_id) < 20:
+        return int(enc_id)
+    return zlib.crc32(enc_id.encode())
+
+
+def _int(value, unknown: int=0) -> int:
+    """ Maps come with floats ("30.0") and strings for ints now and then """
+    return unknown if value is None else int(round(float(value)))
+
+
+def pack(poke: Encounter, first_seen: float) -> bytes:
+    """ Raises ValueError, TypeError or struct.error for encounters that dont fit a record """
+
+    if poke.latitude is None or poke.longitude is None:
+        raise ValueError('no position')
+
+    return RECORD.pack(
+        _encounter_id(poke.encounter_id), int(first_seen), _int(poke.disappear_time) // 1000,
+        float(poke.latitude), float(poke.longitude), _int(poke.pokemon_id), _int(poke.cp),
+        _int(poke.individual_attack, UNKNOWN_IV), _int(poke.individual_defense, UNKNOWN_IV), _int(poke.individual_stamina, UNKNOWN_IV),
+        _int(poke.level), VERIFIED if poke.is_verified_despawn else 0
+    )
+
+
+def file_name(first_seen: float, suffix: str='') -> str:
+    return datetime.fromtimestamp(first_seen, tz=timezone.utc).strftime('%Y%m%d-%H') + suffix + SUFFIX
+
+
+class HistoryRecorder:
+    """ Buffers packed records and appends them from a writer thread
+
+    Buffers go out once `batch_size` records are pending or `flush_interval`
+    seconds passed. Scrapers sharing a directory need their own `suffix`,
+    the files of one hour are read together anyway.
+    """
+
+    def __init__(self, directory: str, suffix: str='', batch_size: int=500, flush_interval: float=10) -> None:
+        self.directory = directory
+        self.__suffix = suffix
+        self.__batch_size = batch_size
+        self.__flush_interval = flush_interval
+
+        os.makedirs(directory, exist_ok=True)
+
+        # file name -> packed records
+        self.__pending: Dict[str, bytearray] = dict()
+        self.__count = 0
+        self.__last_flush = time.monotonic()
+
+        self.__writes: queue.Queue = queue.Queue()
+        self.__writer = Thread(target=self.__write, name='ored-history', daemon=True)
+        self.__writer.start()
+
+        self.recorded = 0
+        self.skipped = 0
+
+    def record(self, pokes: Iterable[Encounter], first_seen: float) -> None:
+
+        name = file_name(first_seen, self.__suffix)
+        buffer = self.__pending.get(name)
+        if buffer is None:
+            buffer = self.__pending[name] = bytearray()
+
+        for poke in pokes:
+            # a record less is better than a region that stops polling
+            try:
+                buffer += pack(poke, first_seen)
+            except (ValueError, TypeError, struct.error) as err:
+                self.skipped += 1
+                log.warning(f'Not recording encounter {poke.encounter_id}: {err}')
+                continue
+            self.__count += 1
+
+        if self.__count >= self.__batch_size or time.monotonic() - self.__last_flush > self.__flush_interval:
+            self.flush()
+
+    def flush(self) -> None:
+        """ Hands the buffers to the writer thread """
+
+        pending, self.__pending = self.__pending, dict()
+        self.recorded += self.__count
+        self.__count = 0
+        self.__last_flush = time.monotonic()
+
+        if pending:
+            self.__writes.put(pending)
+
+    def __write(self) -> None:
+
+        while True:
+            pending = self.__writes.get()
+            try:
+                if pending is None:
+                    return
+
+                for name, buffer in pending.items():
+                    with open(os.path.join(self.directory, name), 'ab') as f:
+                        f.write(buffer)
+            except OSError as err:
+                log.error(f'Writing history failed: {err}')
+            finally:
+                self.__writes.task_done()
+
+    def close(self) -> None:
+        """ Writes out everything and stops the writer """
+
+        self.flush()
+        self.__writes.put(None)
+        self.__writer.join()
+
+
+def history_files(directory: str, since: Optional[datetime]=None, until: Optional[datetime]=None) -> List[str]:
+    """ The record files covering `since` to `until`, by their names """
+
+    first = since.astimezone(timezone.utc).strftime('%Y%m%d-%H') if since else ''
+    last = until.astimezone(timezone.utc).strftime('%Y%m%d-%H') if until else '~'
+
+    return [
+        path for path in sorted(glob.glob(os.path.join(directory, '*' + SUFFIX)))
+        if first <= os.path.basename(path)[:11] <= last
+    ]
+
+
+def load(paths: Iterable[str], since: Optional[datetime]=None, until: Optional[datetime]=None, box: Optional[List[float]]=None):
+    """ Memory maps the files and returns the matching records as one numpy array """
+
+    since_ts = since.timestamp() if since else 0
+    until_ts = until.timestamp() if until else 2 ** 32
+
+    parts = []
+
+    for path in paths:
+        # a writer might be in the middle of a record
+        count = os.path.getsize(path) // RECORD.size
+        if not count:
+            continue
+
+        records = np.memmap(path, dtype=DTYPE, mode='r', shape=(count,))
+        mask = (records['first_seen'] >= since_ts) & (records['first_seen'] < until_ts)
+
+        if box:
+            sw_lat, sw_lng, ne_lat, ne_lng = box
+            lat, lng = records['lat'], records['lng']
+            mask &= (lat >= sw_lat) & (lat <= ne_lat) & (lng >= sw_lng) & (lng <= ne_lng)
+
+        # copies only what matched, the mapping goes away with `records`
+        parts.append(records[mask])
+
+    return np.concatenate(parts) if parts else np.empty(0, dtype=DTYPE)
+
+
+def iv_percent(records):
+    """ IV in percent, NaN where unknown """
+
+    total = records['atk'].astype(np.float32) + records['def'] + records['sta']
+    known = records['atk'] != UNKNOWN_IV
+
+    return np.where(known, total * 100 / 45, np.nan)
+
+
+def summary(records, args) -> None:
+
+    if not len(records):
+        print('No encounters')
+        return
+
+    first, last = records['first_seen'].min(), records['first_seen'].max()
+    remaining = records['disappear_time'].astype(np.int64) - records['first_seen']
+
+    print(f'{len(records)} encounters from {datetime.fromtimestamp(first):%Y-%m-%d %H:%M} to {datetime.fromtimestamp(last):%Y-%m-%d %H:%M}')
+    print(f'{len(np.unique(records["species"]))} species, {np.mean(records["atk"] != UNKNOWN_IV) * 100:.0f}% with IVs, {np.mean(records["flags"] & VERIFIED) * 100:.0f}% verified')
+    print(f'{len(records) / max(1, (last - first) / 3600):.0f} per hour, remaining when first seen: median {np.median(remaining) / 60:.1f} min, p10 {np.percentile(remaining, 10) / 60:.1f} min')
+
+
+def heatmap(records, args) -> None:
+    """ Spawns per hour and remaining time at first sight per cell of `--cell` km """
+
+    if not len(records):
+        print('No encounters')
+        return
+
+    lat, lng = records['lat'].astype(np.float64), records['lng'].astype(np.float64)
+    cell_lat = args.cell / 110.574
+    cell_lng = args.cell / (111.320 * np.cos(np.radians(np.mean(lat))))
+
+    rows = np.floor(lat / cell_lat).astype(np.int64)
+    cols = np.floor(lng / cell_lng).astype(np.int64)
+    cells, inverse, counts = np.unique(np.stack([rows, cols], axis=1), axis=0, return_inverse=True, return_counts=True)
+    inverse = inverse.reshape(-1)
+
+    hours = max(1.0, (records['first_seen'].max() - records['first_seen'].min()) / 3600)
+    remaining = records['disappear_time'].astype(np.int64) - records['first_seen']
+
+    print(f'{"lat":>9} {"lng":>9} {"spawns":>7} {"per h":>6} {"p10 left":>9} {"median left":>12}')
+
+    for i in np.argsort(-counts)[:args.top]:
+        left = remaining[inverse == i]
+        row, col = cells[i]
+        print(
+            f'{(row + 0.5) * cell_lat:9.4f} {(col + 0.5) * cell_lng:9.4f} {counts[i]:7d} {counts[i] / hours:6.1f} '
+            f'{np.percentile(left, 10) / 60:7.1f}m {np.median(left) / 60:10.1f}m'
+        )
+
+
+def hours(records, args) -> None:
+    """ Spawns per local hour of the day """
+
+    if not len(records):
+        print('No encounters')
+        return
+
+    offset = datetime.now().astimezone().utcoffset().total_seconds()
+    hour = ((records['first_seen'].astype(np.int64) + int(offset)) // 3600) % 24
+    counts = np.bincount(hour, minlength=24)
+    scale = 50 / max(1, counts.max())
+
+    for h, count in enumerate(counts):
+        print(f'{h:02d}h {count:7d} {"#" * int(count * scale)}')
+
+
+def species(records, args) -> None:
+
+    if args.min_iv is not None:
+        records = records[iv_percent(records) >= args.min_iv]
+
+    ids, counts = np.unique(records['species'], return_counts=True)
+
+    for i in np.argsort(-counts)[:args.top]:
+        print(f'{ids[i]:4d} {counts[i]:7d} {counts[i] * 100 / len(records):5.1f}%')
+
+
+QUERIES = { 'summary': summary, 'heatmap': heatmap, 'hours': hours, 'species': species }
+
+
+def _time(value: str) -> datetime:
+    return datetime.fromisoformat(value).astimezone()
+
+
+def main() -> None:
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('directory')
+    parser.add_argument('query', choices=QUERIES)
+    parser.add_argument('--since', type=_time)
+    parser.add_argument('--until', type=_time)
+    parser.add_argument('--box', type=lambda value: [float(v) for v in value.split(',')], help='swLat,swLng,neLat,neLng')
+    parser.add_argument('--cell', type=float, default=0.5, help='heatmap cell size in km')
+    parser.add_argument('--top', type=int, default=20)
+    parser.add_argument('--min-iv', type=float)
+    args = parser.parse_args()
+
+    if np is None:
+        sys.exit('Querying the history needs numpy, pip3 install numpy')
+
+    records = load(history_files(args.directory, args.since, args.until), args.since, args.until, args.box)
+    QUERIES[args.query](records, args)
+
+
+if __name__ == '__main__':
+    main()
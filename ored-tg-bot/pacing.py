@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+import logging
+import time
+from collections import deque
+from typing import Deque, Iterable, List, Optional, Tuple
+
+log = logging.getLogger('ored-tg')
+
+
+class AdaptiveInterval:
+    """ Picks the delay until the next poll from what the last polls saw
+
+    - many new encounters per second -> poll faster
+    - new encounters that are about to despawn when first seen -> poll faster,
+      so short-lived spawns are not missed, for `window` seconds after the
+      last of them
+    - nothing new -> slowly back off towards `max_delay`
+    - slow responses -> never poll faster than twice the response time
+    - errors -> double the delay until a poll succeeds again
+
+    The result always stays within `min_delay` and `max_delay`.
+    """
+
+    def __init__(self, base: float, min_delay: float=2, max_delay: float=60, smoothing: float=0.3, window: float=300, name: str='') -> None:
+        self.name = name
+        self.base = base
+        self.min_delay = min(min_delay, base)
+        self.max_delay = max(max_delay, base)
+        self.delay = base
+
+        self.__smoothing = smoothing
+        self.__window = window
+        self.__rate = 0.0
+        self.__last_update: Optional[float] = None
+
+        # (monotonic time, seconds left) of the shortest-lived new encounter of the last few polls with any
+        self.__short_lived: Deque[Tuple[float, float]] = deque(maxlen=20)
+
+        # (unix time, delay) every time the delay changed noticeably
+        self.history: Deque[Tuple[float, float]] = deque([(time.time(), base)], maxlen=100)
+
+    def update(self, new_count: int, remaining: Iterable[float]=(), latency: float=0, error: bool=False) -> float:
+        """ Feeds in the outcome of one poll and returns the delay until the next one
+
+        `remaining` are the seconds until despawn of the new encounters,
+        `latency` is how long the request took in seconds.
+        """
+
+        now = time.monotonic()
+        elapsed = now - self.__last_update if self.__last_update is not None else self.delay
+        self.__last_update = now
+
+        if error:
+            delay = self.delay * 2
+        else:
+            rate = new_count / max(elapsed, 1e-3)
+            self.__rate += self.__smoothing * (rate - self.__rate)
+
+            remaining = list(remaining)
+            if remaining:
+                self.__short_lived.append((now, min(remaining)))
+
+            # a quiet region forgets its short-lived spawns and backs off
+            while self.__short_lived and now - self.__short_lived[0][0] > self.__window:
+                self.__short_lived.popleft()
+
+            if new_count:
+                # ~one poll per new encounter at the base delay, faster when it gets busy
+                delay = self.base / (1 + self.__rate * self.base)
+            else:
+                delay = self.delay * 1.25
+
+            # poll a few times within the lifetime of the shortest lived spawns
+            if self.__short_lived:
+                delay = min(delay, sum(left for _, left in self.__short_lived) / len(self.__short_lived) / 4)
+
+            delay = max(delay, 2 * latency)
+
+        delay = min(self.max_delay, max(self.min_delay, delay))
+
+        if abs(delay - self.delay) >= 0.1 * self.delay:
+            log.debug(f'Poll interval {self.name}: {self.delay:.1f}s -> {delay:.1f}s (rate {self.__rate:.3f}/s, latency {latency:.2f}s{", error" if error else ""})')
+            self.history.append((time.time(), delay))
+
+        self.delay = delay
+        return delay
+
+    def rate(self) -> float:
+        """ Smoothed new encounters per second """
+        return self.__rate
+
+    def changes(self, last: int=5) -> List[Tuple[float, float]]:
+        """ Returns the last few (unix time, delay) changes """
+        return list(self.history)[-last:]
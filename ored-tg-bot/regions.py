@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional
+
+
+@dataclass(frozen=True)
+class Region:
+    """ A bounding box that gets polled on its own cadence """
+
+    name: str
+    sw_lat: float
+    sw_lng: float
+    ne_lat: float
+    ne_lng: float
+
+    # seconds between two polls, falls back to the scraper delay if not set
+    delay: Optional[float] = None
+
+    def to_payload(self) -> Dict[str, str]:
+        """ Returns the bounding box fields of the request payload """
+
+        sw_lat, sw_lng, ne_lat, ne_lng = str(self.sw_lat), str(self.sw_lng), str(self.ne_lat), str(self.ne_lng)
+
+        return {
+            "swLat": sw_lat,
+            "swLng": sw_lng,
+            "neLat": ne_lat,
+            "neLng": ne_lng,
+            "oSwLat": sw_lat,
+            "oSwLng": sw_lng,
+            "oNeLat": ne_lat,
+            "oNeLng": ne_lng,
+        }
+
+
+DEFAULT_REGION = Region('default', 52.623190318134554, 13.151621818542482, 52.65587329539442, 13.261485099792482)
+
+
+def regions_from_config(entries: Iterable) -> List[Region]:
+    """ Builds regions from the `REGIONS` entries in secrets.py
+
+    Every entry is a tuple of (name, swLat, swLng, neLat, neLng) with
+    an optional delay as sixth element.
+    """
+
+    return [Region(*entry) for entry in entries] or [DEFAULT_REGION]
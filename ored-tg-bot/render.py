@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+""" Turns encounters into the HTML messages sent to the chats
+
+A burst of encounters is rendered for many chats, so everything that can be
+is prepared once: the header template of every species, the hex digits of
+the IVs and the UTC offset of the timezone, which only changes twice a year
+and is cached per quarter of an hour instead of asking the tz every time.
+"""
+
+from datetime import datetime, tzinfo
+from typing import Dict, List, Sequence
+
+from decode import Encounter
+
+# Telegram rejects longer messages
+MAX_MESSAGE_LENGTH = 4096
+
+MAP_LINK = 'https://maps.google.com/?q={:.6f},{:.6f}'
+
+HEX = '0123456789ABCDEF'
+
+# offsets only ever change on quarter hours
+_OFFSET_BUCKET = 900
+
+
+class Renderer:
+
+    def __init__(self, tz: tzinfo) -> None:
+        self.__tz = tz
+        # bucket -> UTC offset in s
+        self.__offsets: Dict[int, int] = dict()
+        # species name -> header template
+        self.__templates: Dict[str, str] = dict()
+
+    def clock(self, timestamp: float) -> str:
+        """ HH:MM:SS of the unix time in the timezone """
+
+        bucket = int(timestamp) // _OFFSET_BUCKET
+        offset = self.__offsets.get(bucket)
+
+        if offset is None:
+            if len(self.__offsets) > 64:
+                self.__offsets.clear()
+            utc_offset = datetime.fromtimestamp(bucket * _OFFSET_BUCKET, tz=self.__tz).utcoffset()
+            offset = self.__offsets[bucket] = int(utc_offset.total_seconds()) if utc_offset else 0
+
+        mins, secs = divmod((int(timestamp) + offset) % 86400, 60)
+        hours, mins = divmod(mins, 60)
+
+        return f'{hours:02d}:{mins:02d}:{secs:02d}'
+
+    def __template(self, name: str) -> str:
+
+        template = self.__templates.get(name)
+        if template is None:
+            # braces in names must not end up as fields
+            escaped = str(name).replace('{', '{{').replace('}', '}}')
+            template = self.__templates[name] = escaped + ' {} ({})\r\nVerified: {}\r\n'
+        return template
+
+    @staticmethod
+    def __ivs(poke: Encounter) -> str:
+
+        if poke.individual_attack is None:
+            return '???'
+        return HEX[poke.individual_attack] + HEX[poke.individual_defense] + HEX[poke.individual_stamina]
+
+    @staticmethod
+    def __lvlcp(poke: Encounter) -> str:
+
+        if poke.level:
+            return f'Lvl {poke.level} - <b>{poke.cp} CP</b>'
+        return 'Lvl ??? - CP ???'
+
+    def __remaining(self, poke: Encounter, now: int) -> str:
+
+        despawn_time = poke.disappear_time / 1e3
+        mins, secs = divmod(int(despawn_time) - now, 60)
+
+        return f'Bis: <b>{self.clock(despawn_time)}</b> (Noch <b>{mins} Min {secs}</b>)'
+
+    def render(self, poke: Encounter, now: int) -> str:
+        """ The message of a single encounter, its location is sent on its own """
+
+        header = self.__template(poke.pokemon_name).format(self.__lvlcp(poke), self.__ivs(poke), '✅' if poke.is_verified_despawn else '❌')
+        return header + self.__remaining(poke, now)
+
+    def digest(self, pokes: Sequence[Encounter], now: int) -> List[str]:
+        """ All encounters in as few messages as possible, one line each linking to its location """
+
+        messages = []
+        lines: List[str] = []
+        length = 0
+
+        for poke in pokes:
+            link = MAP_LINK.format(poke.latitude, poke.longitude)
+            line = (
+                f'<a href="{link}">{poke.pokemon_name}</a> {self.__lvlcp(poke)} ({self.__ivs(poke)}) '
+                f'{"✅" if poke.is_verified_despawn else "❌"}\r\n{self.__remaining(poke, now)}'
+            )
+
+            if lines and length + len(line) > MAX_MESSAGE_LENGTH:
+                messages.append('\r\n\r\n'.join(lines))
+                lines, length = [], 0
+
+            lines.append(line)
+            length += len(line) + 4
+
+        if lines:
+            messages.append('\r\n\r\n'.join(lines))
+
+        return messages
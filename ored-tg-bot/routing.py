@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+from typing import List, Optional, Sequence, Tuple
+
+from decode import Encounter
+from filters import haversine_km, haversine_km_np, np
+
+# (lat, lng)
+Position = Tuple[float, float]
+
+# the full distance matrix is n², larger bursts are only sorted by distance
+MAX_TOUR = 400
+
+
+def distances_km(encounters: Sequence[Encounter], origin: Position) -> List[float]:
+    """ Haversine distances from `origin` to every encounter, vectorized if numpy is there """
+
+    lat0, lng0 = origin
+
+    if np is None:
+        return [ haversine_km(lat0, lng0, e.latitude, e.longitude) for e in encounters ]
+
+    lat = np.fromiter((e.latitude for e in encounters), dtype=np.float64, count=len(encounters))
+    lng = np.fromiter((e.longitude for e in encounters), dtype=np.float64, count=len(encounters))
+
+    return haversine_km_np(lat, lng, lat0, lng0).tolist()
+
+
+def plan_route(encounters: Sequence[Encounter], origin: Position, speed_kmh: float, now: float, margin: float=60) -> Tuple[List[Encounter], int]:
+    """ Drops what cant be reached in time and orders the rest
+
+    An encounter is reachable if getting there from `origin` at `speed_kmh`
+    takes at least `margin` seconds less than it has left. The reachable
+    ones are ordered as a tour: starting at origin, always go to the one
+    that can be reached soonest while it's still there (nearest neighbour
+    with time windows). Whatever the tour cant fit in (its window closes
+    on the way) follows, nearest first.
+
+    Returns (ordered encounters, number of dropped ones).
+    """
+
+    if not encounters:
+        return [], 0
+
+    km_per_s = speed_kmh / 3600
+    dist = distances_km(encounters, origin)
+
+    reachable = [
+        i for i, e in enumerate(encounters)
+        if dist[i] / km_per_s <= e.disappear_time / 1e3 - now - margin
+    ]
+    dropped = len(encounters) - len(reachable)
+
+    if len(reachable) <= 1 or np is None or len(reachable) > MAX_TOUR:
+        reachable.sort(key=dist.__getitem__)
+        return [ encounters[i] for i in reachable ], dropped
+
+    return [ encounters[reachable[i]] for i in _tour(encounters, reachable, dist, km_per_s, now, margin) ], dropped
+
+
+def _tour(encounters: Sequence[Encounter], reachable: List[int], dist: List[float], km_per_s: float, now: float, margin: float) -> List[int]:
+    """ Greedy tour over `reachable`, returns positions in that list """
+
+    n = len(reachable)
+
+    lat = np.array([encounters[i].latitude for i in reachable])
+    lng = np.array([encounters[i].longitude for i in reachable])
+    # seconds to get from every encounter to every other
+    travel = haversine_km_np(lat[:, None], lng[:, None], lat[None, :], lng[None, :]) / km_per_s
+
+    deadline = np.array([encounters[i].disappear_time / 1e3 - margin for i in reachable])
+    arrival = now + np.array([dist[i] for i in reachable]) / km_per_s
+    visited = np.zeros(n, dtype=bool)
+
+    order = []
+
+    while True:
+        # arriving after the deadline or visited already, not an option
+        options = np.where(visited | (arrival > deadline), np.inf, arrival)
+        nxt = int(options.argmin())
+        if options[nxt] == np.inf:
+            break
+
+        order.append(nxt)
+        visited[nxt] = True
+        arrival = arrival[nxt] + travel[nxt]
+
+    rest = sorted((i for i in range(n) if not visited[i]), key=lambda i: dist[reachable[i]])
+
+    return order + rest
+
+
+def parse_position(text: str) -> Optional[Position]:
+    """ "52.52, 13.40" (or space separated) -> (52.52, 13.40), None if it isnt one """
+
+    parts = text.replace(',', ' ').split()
+
+    try:
+        lat, lng = (float(part) for part in parts)
+    except ValueError:
+        return None
+
+    if not (-90 <= lat <= 90 and -180 <= lng <= 180):
+        return None
+
+    return lat, lng
@@ -1,301 +1,680 @@
 #!/usr/bin/env python3
 # -*- coding: UTF-8 -*-
 
+import asyncio
 import logging
-import re
-import time
-from datetime import datetime, timedelta
+from datetime import datetime
+from functools import partial
 from secrets import API_ENDPOINT, DOMAIN
-from threading import Event, Thread
-from typing import List
+from threading import Thread
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+from urllib.parse import urlencode
 
+import aiohttp
 import dateutil.tz
-import requests
-from telegram import Bot, ParseMode
-from telegram.error import NetworkError
+from telegram import Bot
+from yarl import URL
+
+from auth import Token, TokenManager
+from common.metrics import REGISTRY, SIZE_BUCKETS
+from common.logs import notify
+from common.profiling import Cycle, CycleTimer, Spans
+from common.resilience import ErrorAggregator, circuit
+from decode import Encounter, InvalidResponse, decode_pokemons, decode_timestamp
+from encounters import EncounterIndex
+from filters import compile_filter
+from history import HistoryRecorder
+from pacing import AdaptiveInterval
+from regions import DEFAULT_REGION, Region
+from render import Renderer
+from routing import Position, plan_route
+from sender import MessageSender
+from subscriptions import SubscriptionIndex
+from tiling import TilePlanner
 
 log = logging.getLogger('ored-tg')
 
+POLL_SECONDS = REGISTRY.histogram('ored_poll_seconds', 'Duration of raw_data requests, including reading the body')
+POLLS = REGISTRY.counter('ored_polls', 'raw_data requests by outcome', ['outcome'])
+RESPONSE_BYTES = REGISTRY.histogram('ored_response_bytes', 'Size of raw_data responses, full or changes only (delta)', ['kind'], buckets=SIZE_BUCKETS)
+DECODE_SECONDS = REGISTRY.histogram('ored_decode_seconds', 'Time spent decoding raw_data responses')
+ENCOUNTERS = REGISTRY.counter('ored_encounters', 'Encounters in responses: seen, new, rescanned (IVs or CP came later), duplicate (known already), invalid (bad fields, skipped) or expired', ['kind'])
+
+class PollResult(NamedTuple):
+    """ What a single poll of a region returned """
+
+    # new encounters only, None if the request failed
+    pokes: Optional[List[Encounter]]
+    nbytes: int = 0
+    timed_out: bool = False
+    # server time of the response, the next poll only asks for what changed since
+    timestamp: Optional[int] = None
+
+# the server compares in whole seconds, a little overlap doesnt miss changes made while it answered
+DELTA_OVERLAP = 2
+
+
+def is_scanned(poke: Encounter) -> bool:
+    """ Whether the map knows its IVs or CP, filters on them never match before """
+    return poke.individual_attack is not None or poke.cp is not None
+
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/87.0.4280.88 Safari/537.36'
+
 class OredScraper:
 
-    def __init__(self, tg_bot: Bot, chat_id: str, delay: int=5) -> None:
+    def __init__(self, tg_bot: Bot, chat_id: str, delay: int=5, regions: Optional[Iterable[Region]]=None, max_connections: int=8, loop: Optional[asyncio.AbstractEventLoop]=None, store=None, delay_bounds: Tuple[float, float]=(2, 60), planner: Optional[TilePlanner]=None, position: Optional[Position]=None, speed_kmh: float=15, claims=None, sink: Optional[Callable]=None, recorder: Optional[HistoryRecorder]=None, digest: int=0, resync_interval: float=300) -> None:
         self.__running = False
-        self.__sess = requests.Session()
-        self.__sess.headers.update({
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/87.0.4280.88 Safari/537.36'
-        })
+        self.__sess: Optional[aiohttp.ClientSession] = None
+        self.__max_connections = max_connections
         self.__delay = delay
+
+        # every region adapts its poll interval within these bounds, see pacing.py
+        self.__delay_bounds = delay_bounds
+        self.__pacers: Dict[str, AdaptiveInterval] = dict()
+        # hand picked regions, plus the tiles of a large area if a planner is given
+        self.__regions = list(regions) if regions else ([] if planner else [DEFAULT_REGION])
+        self.__planner = planner
+        self.__tasks: Set[asyncio.Task] = set()
+        # region name -> pending restart of its crashed loop
+        self.__restarts: Dict[str, asyncio.TimerHandle] = dict()
+        # whether the region loops are spawned already, only touched on the event loop
+        self.__polling = False
         self.__hds = {
             'Content-Type': 'application/x-www-form-urlencoded; charset=UTF-8',
             'Origin': DOMAIN,
             'Referer': f'{DOMAIN}/',
             'X-Requested-With': 'XMLHttpRequest'
         }
+
+        # the bounding box fields are added per region, see `Region.to_payload`
         self.__payload = {
-                "login": "false",
-                "expireTimestamp": "0",
-                "pokemon": "true",
-                "lastpokemon": "true",
-                "pokestops": "false",
-                "lures": "false",
-                "quests": "false",
-                "dustamount": "0",
-                "reloaddustamount": "false",
-                "nests": "false",
-                "invasions": "true",
-                "lastnests": "false",
-                "communities": "false",
-                "lastcommunities": "false",
-                "portals": "false",
-                "pois": "false",
-                "lastpois": "false",
-                "newportals": "1",
-                "lastportals": "false",
-                "lastpokestops": "false",
-                "gyms": "false",
-                "lastgyms": "false",
-                "badges": "false",
-                "exEligible": "false",
-                "lastslocs": "false",
-                "spawnpoints": "false",
-                "scanlocations": "false",
-                "lastspawns": "false",
-                "minIV": "97",
-                "prevMinIV": "97",
-                "minLevel": "NaN",
-                "prevMinLevel": "0",
-                "minPVP": "",
-                "prevMinPVP": "0",
-                "bigKarp": "false",
-                "tinyRat": "false",
-                "swLat": "52.623190318134554",
-                "swLng": "13.151621818542482",
-                "neLat": "52.65587329539442",
-                "neLng": "13.261485099792482",
-                "oSwLat": "52.623190318134554",
-                "oSwLng": "13.151621818542482",
-                "oNeLat": "52.65587329539442",
-                "oNeLng": "13.261485099792482",
-                "reids": "",
-                "eids": "0",
-		        "exMinIV": "113,149"
+            "login": "false",
+            "expireTimestamp": "0",
+            "pokemon": "true",
+            "lastpokemon": "true",
+            "pokestops": "false",
+            "lures": "false",
+            "quests": "false",
+            "dustamount": "0",
+            "reloaddustamount": "false",
+            "nests": "false",
+            "invasions": "true",
+            "lastnests": "false",
+            "communities": "false",
+            "lastcommunities": "false",
+            "portals": "false",
+            "pois": "false",
+            "lastpois": "false",
+            "newportals": "1",
+            "lastportals": "false",
+            "lastpokestops": "false",
+            "gyms": "false",
+            "lastgyms": "false",
+            "badges": "false",
+            "exEligible": "false",
+            "lastslocs": "false",
+            "spawnpoints": "false",
+            "scanlocations": "false",
+            "lastspawns": "false",
+            "minIV": "0",
+            "prevMinIV": "0",
+            "minLevel": "NaN",
+            "prevMinLevel": "0",
+            "minPVP": "",
+            "prevMinPVP": "0",
+            "bigKarp": "false",
+            "tinyRat": "false",
+            "reids": "",
+            "eids": "0",
+            "exMinIV": ""
         }
 
-        self.__filters_string = 'iv=97&exiv=113,149'
+        # region name -> (payload, token, form encoded), only the timestamp changes between polls
+        self.__forms: Dict[str, Tuple[dict, str, bytes]] = dict()
+
+        # polls only ask for changes, every that many seconds for everything again
+        self.__resync_interval = resync_interval
+
+        # chat_id -> filter, the request asks for the union of all of them
+        self.__subscriptions = SubscriptionIndex()
 
-        self.__pokes_db = dict()
-        
-        self.__scraper_thread = None
-        self.__remover_thread = None
-        self.__stopper = Event()
+        # encounter_id -> despawn time, expired ones are evicted on every access
+        # with a store (see common/store.py) it survives restarts
+        self.__pokes_db = EncounterIndex(store=store)
 
-        self.__tg_bot = tg_bot
+        # encounter_id -> (despawn time, chats it went to) of known encounters without IVs and CP yet,
+        # they are decoded again and go to the chats matching them once they are scanned
+        self.__unscanned: Dict[str, Tuple[float, Set[str]]] = dict()
+        self.__unscanned_purge_at = 0
+
+        # shared with other scrapers (see sharding.py), new encounters are only announced once claimed there
+        self.__claims = claims
+
+        # keeps every new encounter for analysis, see history.py
+        self.__recorder = recorder
+
+        # read on scrape only
+        REGISTRY.gauge('ored_dedup_entries', 'Encounters in the dedup index', func=self.__pokes_db.__len__)
+        REGISTRY.gauge('ored_subscribers', 'Subscribed chats', func=self.__subscriptions.__len__)
+
+        # one event loop (and at most one thread running it) drives all regions
+        self.__loop = loop
+        self.__loop_thread = None
+        self.__main_future = None
+        self.__stopper = None
+
+        # admin chat, gets the logs and errors through the logging thread
         self.__CHAT_ID = chat_id
 
-        # check for expired encounters every this many seconds
-        self.CLEANUP_EXPIRED_INTERVAL = 600
+        # encounters are queued here and delivered without blocking the polls
+        self.__sender = MessageSender(tg_bot)
+        # or handed to `sink` instead, with the same arguments as `MessageSender.submit`
+        self.__submit = sink or self.__sender.submit
+
+        # where chats start from, encounters they cant reach in time arent sent (see routing.py)
+        self.__position = position
+        self.__positions: Dict[str, Position] = dict()
+        self.__speed_kmh = speed_kmh
+        self.__unreachable = 0
 
         self.__tz = dateutil.tz.gettz('Europe/Berlin')
+        self.__renderer = Renderer(self.__tz)
 
-        self.__token_expiration_date = None
+        # bursts of at least that many encounters go out as one message (see render.py), 0 never
+        self.__digest = digest
+        self.__digests: Dict[str, int] = dict()
 
-        self.__update_token()
+        # outages of the endpoint cost a probe now and then, and a summary of errors instead of one message each
+        self.__breaker = circuit(f'{DOMAIN}/{API_ENDPOINT}', failure_threshold=3, reset_timeout=15, max_reset_timeout=600)
+        self.__errors = ErrorAggregator(interval=900)
+        # region name -> kinds of errors since its last good poll, a kind is over once no region has it
+        self.__failing: Dict[str, Set[str]] = dict()
+        # region name -> pokemons with bad fields in its last poll
+        self.__skipped: Dict[str, int] = dict()
 
-    def __update_token(self) -> bool:
-        """ Calls the site once to get the token and setup the cookies """
+        # how long fetch, decode, dedup, render and send took in the recent polls, see /spans
+        self.__spans = Spans()
 
-        self.__sess.cookies.clear()
+        # the token and its cookies, refreshed in the background right when they expire
+        self.__tokens = TokenManager(f'{DOMAIN}/', self.__tz, self.__apply_token, lambda err: self.__log_msg(err, is_err=True))
 
-        r = self.__sess.get(f'{DOMAIN}/')
-        m = re.search(r'var token = \'(\S{42,48})\';', r.text)
+    def __apply_token(self, old: Optional[Token], token: Token) -> None:
+        """ Hands the cookies of a new token to the session, polls pick up the token itself """
 
-        if not m:
-            self.__log_msg(f'No token found!', is_err=True)
-            return False
+        # nothing awaits in between, so no poll goes out with the new cookies and the old token
+        self.__sess.cookie_jar.clear()
+        self.__sess.cookie_jar.update_cookies(token.cookies, URL(self.__tokens.url))
 
-        old_token = self.__payload.get('token', None)
-        self.__payload['token'] = m[1]
+        if old:
+            self.__log_msg(f'TOKEN UPDATED: "{old.value}" -> "{token.value}"')
+        else:
+            self.__log_msg(f'TOKEN SET: "{token.value}"')
 
-        # midnight today
-        self.__token_expiration_date = datetime.now(self.__tz).replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(1)
 
-        if old_token:
-            self.__log_msg(f'TOKEN UPDATED: "{old_token}" -> "{m[1]}"')
-        else:
-            self.__log_msg(f'TOKEN SET: "{m[1]}"')
-        return True
+    def __halt(self) -> None:
+        """ Stops all region loops from inside the event loop """
 
-    def __check_token(self) -> bool:
-        """ Returns TRUE if token expired and was successfully updated to a new one
+        self.__running = False
+        self.__stopper.set()
 
-        Returns FALSE if token is not expired
+    def __form(self, region: Region, token: str) -> bytes:
+        """ The encoded request of the region without the timestamp, encoded again only if filters or token changed """
 
-        Returns FALSE if token expired and was NOT updated to a new one because of errors
-        """
+        payload = self.__payload
+        cached = self.__forms.get(region.name)
+
+        if cached is None or cached[0] is not payload or cached[1] != token:
+            form = urlencode({**payload, **region.to_payload(), 'token': token}).encode()
+            cached = self.__forms[region.name] = (payload, token, form)
+
+        return cached[2]
+
+    async def __get_data(self, region: Region, cycle: CycleTimer, since: int=0) -> PollResult:
+        """ Queries data for one region from the endpoint, only what changed after `since` unless it is 0 """
 
-        now = datetime.now(self.__tz)
+        # waits for the refresh in flight if the token just expired
+        if not await self.__tokens.ensure(self.__sess):
+            POLLS.labels('no_token').inc()
+            return PollResult(None)
 
-        if (self.__token_expiration_date - now).total_seconds() < 0:
-            log.debug('Token needs update!')
-            return self.__update_token()
-        return False
+        # the endpoint is down, let the probe find out when it is back
+        if not self.__breaker.allow():
+            POLLS.labels('circuit_open').inc()
+            return PollResult(None)
 
-    def __get_data(self) -> List:
-        """ Queries data from the endpoint and returns it as a list"""
+        token = self.__tokens.token.value
+        form = self.__form(region, token) + b'&timestamp=%d' % since
 
         try:
-            response = self.__sess.post(f'{DOMAIN}/{API_ENDPOINT}', data=self.__payload, headers=self.__hds, timeout=10)
-            response.raise_for_status()
+            with POLL_SECONDS.time(), cycle.span('fetch'):
+                async with self.__sess.post(f'{DOMAIN}/{API_ENDPOINT}', data=form, headers=self.__hds) as response:
+                    response.raise_for_status()
+                    body = await response.read()
 
-        except requests.HTTPError as httpe:
+        except aiohttp.ClientResponseError as httpe:
+            POLLS.labels(f'http_{httpe.status}').inc()
 
-            if response.status_code == 400:
-                is_updated = self.__check_token()
+            if httpe.status == 400:
+                # the site answered, just not to this token
+                self.__recovered(region)
 
-                if not is_updated:
-                    # either token is not expired -> BAD, because we got a 400 error and we dont know why
-                    # or token expired and not updated -> BAD, we failed to get a new one
+                # the token got revoked early, unless a fresh one gets turned down as well
+                is_updated = await self.__tokens.refresh(self.__sess, rejected=token)
+
+                if not is_updated or self.__tokens.token.value == token:
+                    # either the site hands out the same token again -> BAD, because we got a 400 error and we dont know why
+                    # or we failed to get a new one -> BAD
                     self.__log_msg(f'Recieved {httpe}\n Failed to update the token OR unknown 400. Either way, stop scanning to be safe.', is_err=True)
-                    self.__running = False
-                    self.__stopper.set()
+                    self.__halt()
 
             else:
-                self.__log_msg(f'Stop scanning because: {httpe}', is_err=True)
-                self.__running = False
-                self.__stopper.set()
-            return []
-        except requests.exceptions.ConnectionError as cerr:
-            self.__log_msg(f'POST failed with network error: {cerr}', is_err=True)
-            return []
-        except requests.exceptions.Timeout:
-            self.__log_msg(f'POST timed out', is_err=True)
-            return []
-        except requests.exceptions.RequestException as err:
-            self.__log_msg(f'POST failed with request error: {err}', is_err=True)
-            return []
-
+                self.__failed(region, f'http_{httpe.status}', f'POST failed: {httpe}')
+            return PollResult(None)
+        except aiohttp.ClientConnectionError as cerr:
+            POLLS.labels('network_error').inc()
+            self.__failed(region, 'network_error', f'POST failed with network error: {cerr}')
+            return PollResult(None)
+        except asyncio.TimeoutError:
+            POLLS.labels('timeout').inc()
+            self.__failed(region, 'timeout', 'POST timed out')
+            return PollResult(None, timed_out=True)
+        except aiohttp.ClientError as err:
+            POLLS.labels('request_error').inc()
+            self.__failed(region, 'request_error', f'POST failed with request error: {err}')
+            return PollResult(None)
+
+        RESPONSE_BYTES.labels('delta' if since else 'full').observe(len(body))
+
+        # known encounters are skipped before they are turned into objects, bad ones are left out
+        skipped: List[str] = []
         try:
-            data = response.json()
+            with DECODE_SECONDS.time(), cycle.span('decode'):
+                pokes = decode_pokemons(body, self.__is_known, skipped=skipped.append)
+        except InvalidResponse as ire:
+            POLLS.labels('invalid_response').inc()
+            self.__failed(region, 'invalid_response', f'Recieved unexpected pokemons: {ire}')
+            return PollResult(None)
         except ValueError:
-            self.__log_msg(f'Recieved non-json response: {response.text}', is_err=True)
-            return []
-
-        try:
-            pokes = data['pokemons'] # sic!
+            POLLS.labels('bad_response').inc()
+            self.__failed(region, 'bad_response', f'Recieved non-json response: {body[:500].decode(errors="replace")}')
+            return PollResult(None)
         except KeyError:
-            self.__log_msg('JSON data is missing key "pokemons"')
-            log.debug(data)
-            return []
+            POLLS.labels('bad_response').inc()
+            self.__failed(region, 'bad_response', 'JSON data is missing key "pokemons"')
+            log.debug(body)
+            return PollResult(None)
+
+        POLLS.labels('ok').inc()
+        self.__recovered(region)
+
+        # a plain substring count, cheaper than counting while decoding
+        seen = body.count(b'"encounter_id"')
+        ENCOUNTERS.labels('seen').inc(seen)
+        ENCOUNTERS.labels('duplicate').inc(max(0, seen - len(pokes) - len(skipped)))
+
+        # they arent known afterwards and come again every poll, only warned about when that changes
+        if skipped:
+            ENCOUNTERS.labels('invalid').inc(len(skipped))
+        if len(skipped) != self.__skipped.get(region.name, 0):
+            self.__skipped[region.name] = len(skipped)
+            if skipped:
+                log.warning(f'Skipped {len(skipped)} pokemon(s) with bad fields in {region.name}, e.g. {skipped[0]}')
+
+        return PollResult(pokes, len(body), timestamp=decode_timestamp(body))
+
+    def __is_known(self, enc_id: str) -> bool:
+        """ Whether there is nothing new to learn about the encounter """
+        return enc_id in self.__pokes_db and enc_id not in self.__unscanned
+
+    def __failed(self, region: Region, kind: str, msg: str) -> None:
+        """ Counts a failed poll against the circuit, reports the first of its kind and sums up the rest """
+
+        self.__breaker.failure(region.name)
+        self.__failing.setdefault(region.name, set()).add(kind)
+
+        text = self.__errors.report(kind, msg)
+        if text:
+            self.__log_msg(text, is_err=True)
+        else:
+            log.warning(msg)
 
-        return pokes
+    def __recovered(self, region: Region) -> None:
 
-    def __send_encounter(self, poke, now: int) -> None:
+        was_open = self.__breaker.success(region.name)
 
-        # format IVs as hex string if they exist
-        if poke['individual_attack'] is not None:
-            ivs = f"{poke['individual_attack']:X}{poke['individual_defense']:X}{poke['individual_stamina']:X}"
+        # the endpoint is back for everyone, otherwise just this region is
+        if was_open:
+            kinds = set().union(*self.__failing.values())
+            self.__failing.clear()
         else:
-            ivs = '???'
+            kinds = self.__failing.pop(region.name, set()) - set().union(*self.__failing.values())
 
-        if poke['level']:
-            lvlcp = f"Lvl {poke['level']} - <b>{poke['cp']} CP</b>"
-        else:
-            lvlcp = "Lvl ??? - CP ???"
+        for kind in sorted(kinds):
+            text = self.__errors.resolve(kind, message=f'{API_ENDPOINT} ({kind})')
+            # single errors in between were reported already, only outages get a recovery message
+            if text and was_open:
+                self.__log_msg(text)
 
-        header = f"{poke['pokemon_name']} {lvlcp} ({ivs})\r\nVerified: {'✅' if poke['is_verified_despawn'] else '❌'}\r\n"
+    def __log_msg(self, msg_or_err, is_err = False) -> None:
+        """ Logs the message and has it sent to the admin chat, by the logging thread (see common/logs.py) """
 
-        despawn_time = poke['disappear_time'] / 1e3
-        mins, secs = divmod(int(despawn_time) - now, 60)
+        log.log(logging.ERROR if is_err else logging.DEBUG, msg_or_err, extra=notify(self.__CHAT_ID))
 
-        html_msg = f"{header}Bis: <b>{datetime.fromtimestamp(despawn_time, tz=self.__tz).strftime('%H:%M:%S')}</b> (Noch <b>{int(mins)} Min {int(secs)}</b>)"
+    async def __wait(self, timeout: float) -> bool:
+        """ Sleeps for `timeout` seconds, returns TRUE if the scraper got stopped meanwhile """
 
         try:
-            self.__tg_bot.send_message(chat_id=self.__CHAT_ID, text=html_msg, parse_mode=ParseMode.HTML)
-            self.__tg_bot.send_location(chat_id=self.__CHAT_ID, latitude=poke['latitude'], longitude=poke['longitude'])
+            await asyncio.wait_for(self.__stopper.wait(), max(timeout, 0))
+            return True
+        except asyncio.TimeoutError:
+            return False
 
-            # store despawn time in ms
-            # this lets us remove expired encounters
-            self.__pokes_db[poke['encounter_id']] = despawn_time
+    def __announce(self, fresh: List[Encounter], now: int, cycle: CycleTimer, rescanned: Dict[str, Set[str]]) -> None:
+        """ Queues new encounters for every chat whose filter they match, never waits for Telegram
 
-        except NetworkError:
-            log.debug('Sending failed')
+        `rescanned` are the chats encounters seen before without IVs went to already.
+        """
 
-    def __log_msg(self, msg_or_err, is_err = False) -> None:
+        # every encounter (and digest) is formatted once, no matter how many chats get it
+        messages: Dict[str, str] = dict()
+        digests: Dict[tuple, List[str]] = dict()
 
-        if is_err:
-            log.error(msg_or_err)
-        else:
-            log.debug(msg_or_err)
+        # chats with the same position and encounters share their route
+        routes: Dict[tuple, List[Encounter]] = dict()
 
-        self.__tg_bot.send_message(
-            chat_id=self.__CHAT_ID,
-            text=f'❌❌❌\n{msg_or_err}\n❌❌❌' if is_err else f'DEBUG:\n{msg_or_err}',
-            parse_mode=ParseMode.HTML
-        )
+        for chat_id, pokes in self.__subscriptions.route(fresh, now).items():
 
-    def __scraping_loop(self, filters = None) -> None:
-        """ Repeatedly gets data and sends messages with it """
+            if rescanned:
+                pokes = [ poke for poke in pokes if chat_id not in rescanned.get(poke.encounter_id, ()) ]
+                if not pokes:
+                    continue
 
-        if filters:
-            self.update_filters(filters)
+            position = self.__positions.get(chat_id, self.__position)
+            if position is not None:
+                key = (position, tuple(poke.encounter_id for poke in pokes))
+                if key not in routes:
+                    routes[key], dropped = plan_route(pokes, position, self.__speed_kmh, now)
+                    self.__unreachable += dropped
+                pokes = routes[key]
+
+            # without IVs they may match other chats later, these got them already
+            if self.__unscanned:
+                for poke in pokes:
+                    unscanned = self.__unscanned.get(poke.encounter_id)
+                    if unscanned is not None:
+                        unscanned[1].add(chat_id)
+
+            threshold = self.__digests.get(chat_id, self.__digest)
+            if threshold and len(pokes) >= threshold:
+                key = tuple(poke.encounter_id for poke in pokes)
+                if key not in digests:
+                    with cycle.span('render'):
+                        digests[key] = self.__renderer.digest(pokes, now)
+
+                # with a full queue they wait for room, until the last encounter despawned (see sender.py)
+                expires = max(poke.disappear_time for poke in pokes) / 1e3
+                for html_msg in digests[key]:
+                    self.__submit(chat_id, html_msg, expires=expires)
+                continue
+
+            for poke in pokes:
+                html_msg = messages.get(poke.encounter_id)
+                if html_msg is None:
+                    with cycle.span('render'):
+                        html_msg = messages[poke.encounter_id] = self.__renderer.render(poke, now)
+
+                self.__submit(chat_id, html_msg, location=(poke.latitude, poke.longitude), expires=poke.disappear_time / 1e3)
+
+    async def __region_loop(self, region: Region) -> None:
+        """ Repeatedly gets data for one region and sends messages with it """
+
+        min_delay, max_delay = self.__delay_bounds
+        pacer = self.__pacers[region.name] = AdaptiveInterval(region.delay or self.__delay, min_delay, max_delay, name=region.name)
+        is_tile = self.__planner is not None and self.__planner.is_tile(region)
+        loop = asyncio.get_running_loop()
+
+        # server time of the last response (0 asks for everything), and the filters it was for
+        since = 0
+        since_payload = self.__payload
+        resync_at = loop.time() + self.__resync_interval
 
         while self.__running:
 
+            started = loop.time()
             now_time = int(datetime.now(self.__tz).timestamp())
+            cycle = self.__spans.cycle(region.name)
+
+            # changed filters may let through encounters that didnt change, and nothing is missed for long either way
+            if since and (self.__payload is not since_payload or started >= resync_at):
+                since = 0
+            if not since:
+                since_payload = self.__payload
+                resync_at = started + self.__resync_interval
+            full = not since
+
+            result = await self.__get_data(region, cycle, since)
+            # after a failed poll the next one asks for everything since the last one that worked
+            if result.timestamp is not None:
+                since = max(0, result.timestamp - DELTA_OVERLAP)
+            latency = loop.time() - started
+            remaining = []
+            fresh = []
+            # encounter_id -> chats it went to without IVs
+            rescanned: Dict[str, Set[str]] = dict()
+
+            with cycle.span('dedup'):
+                if self.__unscanned and now_time >= self.__unscanned_purge_at:
+                    self.__unscanned = { enc_id: unscanned for enc_id, unscanned in self.__unscanned.items() if unscanned[0] > now_time }
+                    self.__unscanned_purge_at = now_time + 60
+
+                for poke in result.pokes or []:
+
+                    enc_id = poke.encounter_id
+
+                    # tiles share their borders, only the tile owning the spot keeps it
+                    if is_tile and not self.__planner.owns(region, poke.latitude, poke.longitude):
+                        continue
+
+                    # already in db, ignore unless it got its IVs or CP since
+                    if enc_id in self.__pokes_db:
+                        unscanned = self.__unscanned.get(enc_id)
+                        if unscanned is None or not is_scanned(poke):
+                            ENCOUNTERS.labels('duplicate').inc()
+                            continue
+
+                        del self.__unscanned[enc_id]
+                        rescanned[enc_id] = unscanned[1]
+                        ENCOUNTERS.labels('rescanned').inc()
+                        fresh.append(poke)
+                        continue
+
+                    # about to despawn, we couldnt get there anyway
+                    if self.__pokes_db.is_expired(poke.disappear_time / 1e3, now_time):
+                        ENCOUNTERS.labels('expired').inc()
+                        continue
+
+                    log.debug(f'New encounter with id {enc_id} added')
+
+                    # store despawn time in s, matched by any filter or not
+                    # this lets us remove expired encounters
+                    self.__pokes_db.add(enc_id, poke.disappear_time / 1e3)
+                    if not is_scanned(poke):
+                        self.__unscanned[enc_id] = (poke.disappear_time / 1e3, set())
+                    fresh.append(poke)
+                    remaining.append(poke.disappear_time / 1e3 - now_time)
+
+                # another scraper may have seen them first, rescanned ones were claimed here already
+                if len(fresh) > len(rescanned) and self.__claims is not None:
+                    claimed = self.__claims.claim({ poke.encounter_id: poke.disappear_time / 1e3 for poke in fresh if poke.encounter_id not in rescanned })
+                    ENCOUNTERS.labels('duplicate').inc(len(fresh) - len(rescanned) - len(claimed))
+
+                    for poke in fresh:
+                        if poke.encounter_id not in claimed and poke.encounter_id not in rescanned:
+                            self.__unscanned.pop(poke.encounter_id, None)
+                    fresh = [ poke for poke in fresh if poke.encounter_id in claimed or poke.encounter_id in rescanned ]
+
+            if fresh:
+                new = [ poke for poke in fresh if poke.encounter_id not in rescanned ] if rescanned else fresh
+                ENCOUNTERS.labels('new').inc(len(new))
+                # recorded once, when first seen
+                if self.__recorder is not None and new:
+                    self.__recorder.record(new, now_time)
+                with cycle.span('send'):
+                    self.__announce(fresh, now_time, cycle, rescanned)
+
+            cycle.finish()
+
+            delay = pacer.update(len(remaining), remaining, latency, error=result.pokes is None)
+
+            # tiles are sized by complete responses, changes only say little about how busy one is
+            if is_tile and ((result.pokes is not None and full) or result.timed_out):
+                for tile in self.__planner.observe(region, result.nbytes, result.timed_out):
+                    self.__spawn(tile)
+
+            for summary in self.__errors.flush():
+                self.__log_msg(summary, is_err=True)
+
+            # split or merged (by this tile or a sibling, maybe while it waited), the new tiles take over from here
+            if is_tile and self.__retired(region):
+                break
+
+            # keep the cadence, no matter how long the request took
+            if await self.__wait(delay - (loop.time() - started)) or (is_tile and self.__retired(region)):
+                break
+
+    def __retired(self, tile: Region) -> bool:
+        """ Whether the tile was replaced, forgets about it if so """
+
+        if self.__planner.is_active(tile):
+            return False
 
-            for poke in self.__get_data():
+        self.__pacers.pop(tile.name, None)
+        self.__forms.pop(tile.name, None)
+        # its errors wont recover, they arent its to report anymore
+        for kind in self.__failing.pop(tile.name, set()) - set().union(*self.__failing.values()):
+            self.__errors.resolve(kind)
+        return True
 
-                enc_id = poke.get('encounter_id', '')
+    def __spawn(self, region: Region) -> None:
+        """ Starts polling a region """
 
-                # already in db, ignore
-                if self.__pokes_db.get(enc_id, False):
-                    continue
+        self.__restarts.pop(region.name, None)
 
-                log.debug(f'New encounter with id {enc_id} added')
-                self.__send_encounter(poke, now_time)
+        task = asyncio.create_task(self.__region_loop(region))
+        self.__tasks.add(task)
+        task.add_done_callback(partial(self.__region_done, region))
 
-            time.sleep(self.__delay)
+    def __region_done(self, region: Region, task: asyncio.Task) -> None:
+        """ Restarts the loop of a region if it crashed, after its usual delay """
 
-    def __removing_loop(self) -> None:
-        """
-        Loops through the poke db and deletes
-        expired encounters 
-        
-        (for simplicity, we consider
-        encounters with less than 5 seconds remaining time to
-        be expired, since we couldnt get to them anyway)
-        """
+        self.__tasks.discard(task)
+
+        if task.cancelled() or task.exception() is None:
+            return
+
+        err = task.exception()
+        delay = region.delay or self.__delay
+        log.warning(f'Polling {region.name} crashed', exc_info=err)
 
-        # repeat until stop flag is set
-        while not self.__stopper.wait(self.CLEANUP_EXPIRED_INTERVAL):
-            now = int(datetime.now(self.__tz).timestamp())
-            log.debug('Removing...')
+        text = self.__errors.report('crash', f'Polling {region.name} crashed, restarting it in {delay}s: {err!r}')
+        if text:
+            self.__log_msg(text, is_err=True)
 
-            # iterate through database and remove expired encounters
-            for enc_id, despawn_time in self.__pokes_db.copy().items():
-                if despawn_time - now < 5:
-                    del self.__pokes_db[enc_id]
+        if self.__polling and not self.__stopper.is_set():
+            self.__restarts[region.name] = asyncio.get_running_loop().call_later(delay, self.__restart, region)
 
-    def start(self, *args) -> None:
-        """ Runs the scraper by starting a separate thread that runs the scraper loop """
+    def __restart(self, region: Region) -> None:
+
+        # stopped in the meantime, or the tile was replaced
+        if not self.__polling or self.__stopper.is_set() or (self.__planner is not None and self.__planner.is_tile(region) and not self.__planner.is_active(region)):
+            self.__restarts.pop(region.name, None)
+            return
+
+        self.__spawn(region)
+
+    async def __main(self) -> None:
+        """ Polls all regions concurrently over one pooled session until stopped """
+
+        connector = aiohttp.TCPConnector(limit=self.__max_connections)
+        timeout = aiohttp.ClientTimeout(sock_connect=10, sock_read=10)
+
+        try:
+            async with aiohttp.ClientSession(connector=connector, timeout=timeout, headers={'User-Agent': USER_AGENT}) as sess:
+                self.__sess = sess
+
+                # a fetch failed just before (e.g. right before a /stop), it isnt tried again sooner
+                retry_in = self.__tokens.retry_in()
+                if retry_in > 0:
+                    self.__log_msg(f'Getting a token failed a moment ago, trying again in {retry_in:.0f}s')
+                    if await self.__wait(retry_in):
+                        return
+
+                # fresh session means fresh cookies, so always get a matching token
+                if not await self.__tokens.refresh(sess):
+                    self.__log_msg('Could not get a token, stopped scanning. /start to try again', is_err=True)
+                    self.__halt()
+                    return
+
+                self.__tokens.start(sess)
+                self.__sender.start()
+
+                regions = self.__regions + (self.__planner.tiles() if self.__planner else [])
+                for region in regions:
+                    self.__spawn(region)
+                self.__polling = True
+                log.debug(f'Polling {len(regions)} region(s)')
+
+                await self.__stopper.wait()
+
+                for restart in self.__restarts.values():
+                    restart.cancel()
+                self.__restarts.clear()
+
+                tasks = list(self.__tasks)
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+                await self.__tokens.close()
+                await self.__sender.close()
+        except Exception:
+            log.exception('Scraper crashed')
+        finally:
+            self.__pokes_db.flush()
+            if self.__recorder is not None:
+                self.__recorder.flush()
+            self.__polling = False
+            self.__sess = None
+            self.__running = False
+
+    def __ensure_loop(self) -> asyncio.AbstractEventLoop:
+        """ Returns the event loop, starts a thread for it if none was given """
+
+        if self.__loop is None:
+            self.__loop = asyncio.new_event_loop()
+            self.__loop_thread = Thread(target=self.__loop.run_forever, name='ored-scraper', daemon=True)
+            self.__loop_thread.start()
+
+        return self.__loop
+
+    def start(self) -> None:
+        """ Runs the scraper by scheduling the region loops on the event loop """
 
         if self.__running:
             self.__log_msg('Already running')
             return
 
-        self.__check_token()
-
-        self.__stopper.clear()
-        self.__remover_thread = Thread(target=self.__removing_loop)
-        self.__remover_thread.start()
+        # a halted run may still be cleaning up, it must not reset the state of this one
+        if self.__main_future is not None:
+            self.__main_future.result()
 
         self.__running = True
-        self.__scraper_thread = Thread(target=self.__scraping_loop, args=args)
-        self.__scraper_thread.start()
+        self.__stopper = asyncio.Event()
+        self.__main_future = asyncio.run_coroutine_threadsafe(self.__main(), self.__ensure_loop())
         log.debug(f'Started')
 
     def stop(self) -> None:
-        """ Stops the scraper by joining the threads back together """
+        """ Stops the scraper and waits until all region loops are done """
 
         if not self.__running:
             self.__log_msg('Scraper is already stopped!')
@@ -303,49 +682,104 @@ class OredScraper:
 
         self.__running = False
 
-        log.debug('Stopping scraper thread...')
-        self.__scraper_thread.join()
-        log.debug('Stopped scraper thread!')
-        self.__scraper_thread = None
+        log.debug('Stopping region loops...')
+        self.__loop.call_soon_threadsafe(self.__stopper.set)
+        self.__main_future.result()
+        log.debug('Stopped region loops!')
+        self.__main_future = None
 
-        self.__stopper.set()
+    def add_regions(self, regions: Iterable[Region]) -> None:
+        """ Polls these regions as well, right away if the scraper is running """
 
-        log.debug('Stopping cleaner thread...')
-        self.__remover_thread.join()
-        log.debug('Stopped cleaner thread!')
-        self.__remover_thread = None
+        regions = list(regions)
 
-        self.__pokes_db = dict()
+        def add() -> None:
+            # on the event loop, so the region loops are either spawned already or pick them up
+            self.__regions.extend(regions)
+            if self.__polling:
+                for region in regions:
+                    self.__spawn(region)
+
+        if self.__running:
+            self.__loop.call_soon_threadsafe(add)
+        else:
+            add()
 
-    def update_filters(self, filters: str) -> None:
-        """Updates the filter
+    def subscribe(self, chat_id: str, filters: str) -> None:
+        """ Sends every encounter matching `filters` to the chat from now on
 
-        Currently, this is destructive, so new values are
-        not merged with old ones.
+        Replaces the chat's previous filters. Raises ValueError for malformed
+        filters, see filters.py
         """
 
-        log.debug(f'Updating filters to {filters}')
+        log.debug(f'Subscribing {chat_id} to {filters}')
 
-        parts = filters.split('&')
+        self.__subscriptions.subscribe(chat_id, compile_filter(filters))
+        self.__update_payload()
 
-        for part in parts:
-            value, key = part.split('=')
+    def unsubscribe(self, chat_id: str) -> int:
+        """ Stops sending to the chat, returns how many chats are still subscribed """
 
-            if value == 'iv':
-                self.__payload['prevMinIV'] = self.__payload['minIV']
-                self.__payload['minIV'] = key.strip()
-            elif value == 'exiv':
-                self.__payload['exMinIV'] = key.strip()
-            else:
-                log.debug(f'Dont know filter: "{part}", ignoring...')
+        if self.__subscriptions.unsubscribe(chat_id):
+            log.debug(f'Unsubscribed {chat_id}')
+            self.__update_payload()
+
+        return len(self.__subscriptions)
+
+    def __update_payload(self) -> None:
+        """ Requests the loosest filters that still cover every subscription """
+
+        min_iv, exempt = self.__subscriptions.upstream()
 
-        self.__filters_string = filters
+        # swap in a new dict, so polls in flight never see a half updated payload
+        payload = dict(self.__payload)
+        payload['prevMinIV'] = payload['minIV']
+        # filters on species only leave no IV limit (inf), 100 is as strict as the server gets
+        payload['minIV'] = str(int(min(min_iv, 100)))
+        payload['exMinIV'] = ','.join(str(species) for species in sorted(exempt))
 
-    def get_current_filters(self) -> str:
-        """Returns current filter as a string
-        (no formatting)
+        self.__payload = payload
+
+    def get_filters(self, chat_id: str) -> Optional[str]:
+        """ Returns the filter string of the chat, None if it isnt subscribed """
+
+        flt = self.__subscriptions.get(chat_id)
+        return flt.text if flt else None
+
+    def get_subscriber_count(self) -> int:
+        return len(self.__subscriptions)
+
+    def set_position(self, chat_id: str, position: Optional[Position]) -> None:
+        """ Sends the chat only encounters it can reach from `position`, nearest first
+
+        None falls back to the configured position.
+        """
+
+        if position is None:
+            self.__positions.pop(chat_id, None)
+        else:
+            self.__positions[chat_id] = position
+
+    def get_position(self, chat_id: str) -> Optional[Position]:
+        return self.__positions.get(chat_id, self.__position)
+
+    def set_digest(self, chat_id: str, threshold: Optional[int]) -> None:
+        """ Sends bursts of at least `threshold` encounters to the chat as one message, 0 never
+
+        None falls back to the configured threshold.
         """
-        return self.__filters_string
+
+        if threshold is None:
+            self.__digests.pop(chat_id, None)
+        else:
+            self.__digests[chat_id] = threshold
+
+    def get_digest(self, chat_id: str) -> int:
+        return self.__digests.get(chat_id, self.__digest)
+
+    def get_unreachable_count(self) -> int:
+        """ How many encounters were not sent because they couldnt be reached in time """
+        return self.__unreachable
 
     def get_pokes_db_size(self) -> int:
         """ Returns the size of the poke db
@@ -353,6 +787,21 @@ class OredScraper:
 
         return len(self.__pokes_db)
 
+    def get_sender_stats(self) -> dict:
+        """ Returns queue depth, counters and latencies of the send queue """
+
+        return self.__sender.stats()
+
+    def get_poll_intervals(self) -> Dict[str, AdaptiveInterval]:
+        """ Returns the interval pacer of every region, see pacing.py """
+
+        return dict(self.__pacers)
+
+    def get_spans(self, n: Optional[int]=None) -> List[Cycle]:
+        """ Returns the stages of the last `n` polls of all regions, see common/profiling.py """
+
+        return self.__spans.recent(n)
+
     def is_running(self) -> bool:
         """ Whether the scraper is currently running """
         return self.__running
@@ -1,5 +1,51 @@
 BOT_AUTH_TOKEN = ''
 BOT_MYSELF_CHAT_ID = 123
+# a local Bot API server (e.g. 'http://127.0.0.1:8081/bot') instead of https://api.telegram.org/bot
+BOT_API_URL = ''
 
 DOMAIN = ''
-API_ENDPOINT = ''
\ No newline at end of file
+API_ENDPOINT = ''
+
+# bounding boxes to poll concurrently, as (name, swLat, swLng, neLat, neLng) or
+# (name, swLat, swLng, neLat, neLng, delay), leave empty for the default box
+REGIONS = []
+
+# a whole city instead: polygon of (lat, lng) corners (or just the sw and ne corner),
+# it gets split into tiles that are resized from the observed response sizes
+AREA = []
+
+# (lat, lng) to route from, encounters that cant be reached before they despawn (at SPEED_KMH)
+# are not sent and the rest is sent nearest first. Chats can set their own with /pos, None sends everything
+POSITION = None
+SPEED_KMH = 15
+
+# serve Prometheus metrics on http://127.0.0.1:METRICS_PORT/metrics and/or write them to METRICS_TEXTFILE
+# (for the node exporter's textfile collector), 0 / empty to disable
+METRICS_PORT = 0
+METRICS_TEXTFILE = ''
+
+# bursts of at least DIGEST new encounters for a chat are sent as one message linking every location
+# instead of a message and a location each, 0 never. Chats can change it with /digest
+DIGEST = 0
+
+# rotating log file (10 MB, 5 old ones kept), empty logs to the console only
+LOG_PATH = ''
+
+# SQLite file that remembers announced encounters across restarts, leave empty to keep them in memory only
+STORE_PATH = ''
+
+# poll the regions (or tiles of AREA) from this many worker processes, 0 polls them all from the bot process.
+# Workers claim new encounters in STORE_PATH (a temporary file without one), so each is announced once
+WORKERS = 0
+
+# directory to record every new encounter in (one file per hour), for `python3 history.py HISTORY_PATH heatmap`
+# and friends, leave empty to record nothing
+HISTORY_PATH = ''
+
+# receive updates on a webhook instead of long polling, WEBHOOK_URL is the public https url Telegram posts to
+# (443, 80, 88 or 8443) and a reverse proxy forwards to http://WEBHOOK_LISTEN:WEBHOOK_PORT at the same path.
+# Updates without WEBHOOK_SECRET (A-Z, a-z, 0-9, _ and -) are refused, empty picks a new one every start
+WEBHOOK_URL = ''
+WEBHOOK_LISTEN = '127.0.0.1'
+WEBHOOK_PORT = 8443
+WEBHOOK_SECRET = ''
@@ -0,0 +1,377 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+import asyncio
+import logging
+import math
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from functools import partial
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+from telegram import Bot, ParseMode
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError
+
+from common.metrics import REGISTRY
+from common.resilience import backoff
+
+log = logging.getLogger('ored-tg')
+
+CALL_SECONDS = REGISTRY.histogram('ored_telegram_call_seconds', 'Duration of single Telegram api calls')
+DELIVERY_SECONDS = REGISTRY.histogram('ored_telegram_delivery_seconds', 'Seconds from queueing a message until it was delivered')
+MESSAGES = REGISTRY.counter('ored_telegram_messages', 'Queued messages by outcome: sent, failed, expired or dropped (queue and overflow full)', ['outcome'])
+ERRORS = REGISTRY.counter('ored_telegram_errors', 'Failed Telegram api calls by error', ['error'])
+
+
+class TokenBucket:
+    """ Refills `rate` tokens per second up to `capacity`
+
+    Tokens can be borrowed, `reserve` then returns how long the caller
+    has to wait until the borrowed tokens would have been available.
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float]=None) -> None:
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.__tokens = self.capacity
+        self.__updated = time.monotonic()
+
+    def __refill(self) -> None:
+
+        now = time.monotonic()
+        self.__tokens = min(self.capacity, self.__tokens + (now - self.__updated) * self.rate)
+        self.__updated = now
+
+    def reserve(self, amount: float=1) -> float:
+        """ Takes `amount` tokens and returns the seconds to wait before using them """
+
+        self.__refill()
+        self.__tokens -= amount
+        return max(0.0, -self.__tokens / self.rate)
+
+    def delay(self, amount: float=1) -> float:
+        """ Seconds until `amount` tokens are available, without taking them """
+
+        self.__refill()
+        return max(0.0, (amount - self.__tokens) / self.rate)
+
+
+@dataclass
+class Outgoing:
+    """ A message and its (optional) location, always delivered together """
+
+    chat_id: str
+    text: str
+    parse_mode: str = ParseMode.HTML
+    location: Optional[Tuple[float, float]] = None
+    # unix time after which it isnt worth sending anymore (the encounter despawned)
+    expires: Optional[float] = None
+    enqueued: float = field(default_factory=time.monotonic)
+
+    # how many of the api calls already went through, so retries dont send twice
+    done: int = 0
+    # failed tries of the next call
+    attempts: int = 0
+
+
+class MessageSender:
+    """ Delivers messages from bounded queues, so callers never wait for Telegram
+
+    Sends are rate limited globally and per chat (Telegram allows ~30 messages
+    per second overall and ~1 per second per chat), a flood limit (429) pauses
+    all chats for as long as Telegram asks and network errors are retried with
+    exponential backoff.
+
+    Every chat has a queue of its own, the chats take turns: a worker makes
+    one api call for the chat whose turn it is, a chat that has to wait (for
+    its rate limit or a retry) gets its next turn when it may go on, no
+    worker waits for it. So a burst to one chat never holds up the others.
+
+    Beyond `maxsize` queued messages, those with an expiry wait outside the
+    queues until there is room again (or they expired), others are dropped.
+    Of more than `max_overflow` waiting the oldest are dropped.
+    """
+
+    def __init__(self, tg_bot: Bot, maxsize: int=1000, max_overflow: int=1000, workers: int=4, global_rate: float=30, chat_rate: float=1, max_retries: int=5) -> None:
+        self.__tg_bot = tg_bot
+        self.__maxsize = maxsize
+        self.__max_overflow = max_overflow
+        self.__worker_count = workers
+        self.__workers: List[asyncio.Task] = []
+        self.__max_retries = max_retries
+
+        self.__global_bucket = TokenBucket(global_rate)
+        # monotonic time until which Telegram wants no calls at all (flood limit)
+        self.__paused_until = 0.0
+        self.__chat_rate = chat_rate
+        self.__chat_buckets: Dict[str, TokenBucket] = dict()
+
+        # chat -> its messages, in order. A chat with any is either up in `ready`, waiting
+        # for its turn in `timers` or being sent to, never two of them, so its messages
+        # and locations dont get mixed up
+        self.__chats: Dict[str, Deque[Outgoing]] = dict()
+        self.__ready: asyncio.Queue = asyncio.Queue()
+        self.__timers: Dict[str, asyncio.TimerHandle] = dict()
+        self.__queued = 0
+
+        # messages that didnt fit, in the order they came
+        self.__overflow: Deque[Outgoing] = deque()
+
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.expired = 0
+        self.retried = 0
+
+        # seconds from submit until delivered / duration of a single api call
+        self.__latencies: Deque[float] = deque(maxlen=500)
+        self.__call_latencies: Deque[float] = deque(maxlen=500)
+
+        REGISTRY.gauge('ored_telegram_queued', 'Messages waiting in the send queue', func=lambda: self.__queued + len(self.__overflow))
+
+    def submit(self, chat_id: str, text: str, location: Optional[Tuple[float, float]]=None, parse_mode: str=ParseMode.HTML, expires: Optional[float]=None) -> bool:
+        """ Queues a message, returns FALSE if the queue is full and the message was dropped
+
+        Messages with an `expires` (unix time) are never dropped for a full
+        queue, they wait for room as long as they are worth sending.
+        Must be called from the event loop the sender runs on.
+        """
+
+        job = Outgoing(chat_id, text, parse_mode, location, expires)
+
+        # waiting the longest, they are the first to expire
+        while self.__overflow and self.__expire(self.__overflow[0]):
+            self.__overflow.popleft()
+
+        # nothing overtakes what is waiting already
+        if self.__queued >= self.__maxsize or self.__overflow:
+            if expires is None:
+                self.__drop(job)
+                return False
+
+            if not self.__overflow:
+                log.warning('Send queue is full, messages wait for room until they expire')
+
+            if len(self.__overflow) >= self.__max_overflow:
+                self.__overflow = deque(waiting for waiting in self.__overflow if not self.__expire(waiting))
+                if len(self.__overflow) >= self.__max_overflow:
+                    self.__drop(self.__overflow.popleft())
+
+            self.__overflow.append(job)
+            return True
+
+        self.__enqueue(job)
+        return True
+
+    def __drop(self, job: Outgoing) -> None:
+
+        self.dropped += 1
+        MESSAGES.labels('dropped').inc()
+        log.warning(f'Send queue is full, dropped message for {job.chat_id}')
+
+    def __enqueue(self, job: Outgoing) -> None:
+
+        self.__queued += 1
+
+        jobs = self.__chats.get(job.chat_id)
+        if jobs is None:
+            jobs = self.__chats[job.chat_id] = deque()
+            self.__ready.put_nowait(job.chat_id)
+        jobs.append(job)
+
+    def __expire(self, job: Outgoing) -> bool:
+        """ Whether the message isnt worth sending anymore, counts it if so """
+
+        if job.expires is None or job.expires > time.time():
+            return False
+
+        self.expired += 1
+        MESSAGES.labels('expired').inc()
+        log.debug(f'Message for {job.chat_id} expired unsent')
+        return True
+
+    def start(self) -> None:
+        """ Starts the workers on the running event loop """
+
+        if not self.__workers:
+            self.__workers = [asyncio.create_task(self.__work()) for _ in range(self.__worker_count)]
+
+    async def close(self, timeout: float=5) -> None:
+        """ Gives queued messages `timeout` seconds to go out, then stops the workers """
+
+        try:
+            await asyncio.wait_for(self.__drained(), timeout)
+        except asyncio.TimeoutError:
+            log.warning(f'Stopping sender with {self.__queued + len(self.__overflow)} unsent message(s)')
+
+        for worker in self.__workers:
+            worker.cancel()
+        await asyncio.gather(*self.__workers, return_exceptions=True)
+        self.__workers = []
+
+        for timer in self.__timers.values():
+            timer.cancel()
+        self.__timers.clear()
+
+        # what is left goes out after the next start, every chat gets a turn again
+        self.__ready = asyncio.Queue()
+        for chat_id in self.__chats:
+            self.__ready.put_nowait(chat_id)
+
+    async def __drained(self) -> None:
+        while self.__queued or self.__overflow:
+            await asyncio.sleep(0.05)
+
+    def __chat_bucket(self, chat_id: str) -> TokenBucket:
+        bucket = self.__chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.__chat_buckets[chat_id] = TokenBucket(self.__chat_rate)
+        return bucket
+
+    async def __call(self, chat_id: str, call: Callable, attempt: int) -> Optional[float]:
+        """ Makes one api call, returns None if it went through, else the seconds until it may be retried (inf: never) """
+
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+
+        try:
+            await loop.run_in_executor(None, call)
+            self.__call_latencies.append(loop.time() - started)
+            CALL_SECONDS.observe(loop.time() - started)
+            return None
+
+        except RetryAfter as ra:
+            ERRORS.labels('RetryAfter').inc()
+            # the limit may be global, every chat waits it out
+            self.__paused_until = max(self.__paused_until, time.monotonic() + ra.retry_after)
+            log.warning(f'Flood limit hit for {chat_id}, pausing all sends for {ra.retry_after}s')
+            return ra.retry_after
+        except BadRequest as br:
+            ERRORS.labels('BadRequest').inc()
+            # no point in retrying these
+            log.error(f'Telegram rejected message for {chat_id}: {br}')
+            return math.inf
+        except NetworkError as ne:
+            ERRORS.labels(type(ne).__name__).inc()
+            delay = backoff(attempt)
+            log.debug(f'Sending to {chat_id} failed with "{ne}", retrying in {delay:.1f}s')
+            return delay
+        except TelegramError as te:
+            ERRORS.labels(type(te).__name__).inc()
+            log.error(f'Sending to {chat_id} failed: {te}')
+            return math.inf
+
+    def __wake(self, chat_id: str, delay: float=0) -> None:
+        """ Gives the chat its next turn in `delay` seconds """
+
+        if delay > 0:
+            self.__timers[chat_id] = asyncio.get_running_loop().call_later(delay, self.__wake, chat_id)
+        else:
+            self.__timers.pop(chat_id, None)
+            self.__ready.put_nowait(chat_id)
+
+    def __finish(self, chat_id: str) -> None:
+        """ Takes the chat's first message off its queue, the next one (if any) is up once the chat may send again """
+
+        jobs = self.__chats[chat_id]
+        jobs.popleft()
+        self.__queued -= 1
+
+        if jobs:
+            self.__wake(chat_id, self.__chat_bucket(chat_id).delay())
+        else:
+            del self.__chats[chat_id]
+
+        # there is room for one more
+        while self.__overflow and self.__queued < self.__maxsize:
+            job = self.__overflow.popleft()
+            if not self.__expire(job):
+                self.__enqueue(job)
+
+    async def __step(self, chat_id: str) -> None:
+        """ Makes the next api call for the chat, if its rate limit allows one yet """
+
+        job = self.__chats[chat_id][0]
+
+        # a location without its message would be confusing, once the message is out both go
+        if job.done == 0 and self.__expire(job):
+            self.__finish(chat_id)
+            return
+
+        bucket = self.__chat_bucket(chat_id)
+        wait = max(bucket.delay(), self.__paused_until - time.monotonic())
+        if wait > 0:
+            self.__wake(chat_id, wait)
+            return
+        bucket.reserve()
+
+        # the global limit would hold up any worker alike
+        await asyncio.sleep(self.__global_bucket.reserve())
+
+        if job.done == 0:
+            # digests link every location, a preview of the first one would only get in the way
+            call = partial(self.__tg_bot.send_message, chat_id=job.chat_id, text=job.text, parse_mode=job.parse_mode, disable_web_page_preview=True)
+        else:
+            latitude, longitude = job.location
+            call = partial(self.__tg_bot.send_location, chat_id=job.chat_id, latitude=latitude, longitude=longitude)
+
+        retry_in = await self.__call(chat_id, call, job.attempts)
+
+        if retry_in is not None:
+            job.attempts += 1
+
+            if retry_in == math.inf or job.attempts > self.__max_retries:
+                if retry_in != math.inf:
+                    log.error(f'Giving up on message for {chat_id} after {self.__max_retries} retries')
+                self.failed += 1
+                MESSAGES.labels('failed').inc()
+                self.__finish(chat_id)
+            else:
+                self.retried += 1
+                self.__wake(chat_id, retry_in)
+            return
+
+        job.done += 1
+        job.attempts = 0
+
+        # the location follows once the chat may send again
+        if job.location and job.done < 2:
+            self.__wake(chat_id, bucket.delay())
+            return
+
+        self.sent += 1
+        MESSAGES.labels('sent').inc()
+        self.__latencies.append(time.monotonic() - job.enqueued)
+        DELIVERY_SECONDS.observe(self.__latencies[-1])
+        self.__finish(chat_id)
+
+    async def __work(self) -> None:
+
+        while True:
+            chat_id = await self.__ready.get()
+            try:
+                await self.__step(chat_id)
+            except Exception:
+                self.failed += 1
+                MESSAGES.labels('failed').inc()
+                log.exception(f'Unexpected error while sending to {chat_id}')
+                self.__finish(chat_id)
+
+    def stats(self) -> Dict[str, float]:
+        """ Returns queue depth, counters and send latencies in seconds """
+
+        latencies = sorted(self.__latencies)
+        call_latencies = list(self.__call_latencies)
+
+        return {
+            'queued': self.__queued + len(self.__overflow),
+            'sent': self.sent,
+            'failed': self.failed,
+            'dropped': self.dropped,
+            'expired': self.expired,
+            'retried': self.retried,
+            'latency_avg': sum(latencies) / len(latencies) if latencies else 0.0,
+            'latency_p95': latencies[int(len(latencies) * 0.95)] if latencies else 0.0,
+            'call_latency_avg': sum(call_latencies) / len(call_latencies) if call_latencies else 0.0,
+        }
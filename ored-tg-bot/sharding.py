@@ -0,0 +1,436 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+""" Spreads the regions over worker processes
+
+`ShardedScraper` is a drop-in for `OredScraper` in the bot process. It keeps
+subscriptions and the Telegram side, every worker process runs an
+`OredScraper` of its own over a share of the regions, so decoding and
+formatting dont fight over one GIL. Workers hand whatever they would send
+back over a queue, the coordinator delivers it through one `MessageSender`
+that keeps Telegram's rate limits for all of them.
+
+Regions overlap and tiles share borders, so the same encounter can show up
+in two workers. Each one claims its new encounters in a SQLite file shared
+by all of them (`Store.claim`, see common/store.py) and only announces what
+it got, a Redis or similar `Store` would stretch that over several hosts.
+
+If a worker dies its regions are handed to the survivors. Workers start
+from a fresh interpreter (forkserver, or spawn where there is none) and get
+everything they need as arguments: a fork would copy the locks the sender,
+logging and updater threads of the bot hold right then, and never release
+them in the child.
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+import tempfile
+from dataclasses import dataclass, field
+from functools import partial
+from threading import Lock, Thread
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from telegram import Bot, ParseMode
+
+from common.logs import forward_logging, notify
+from common.profiling import Cycle
+from common.store import open_store
+from filters import compile_filter
+from history import HistoryRecorder
+from pacing import AdaptiveInterval
+from regions import DEFAULT_REGION, Region
+from routing import Position
+from scraper import OredScraper
+from sender import MessageSender
+from tiling import TilePlanner
+
+log = logging.getLogger('ored-tg')
+
+# polls of a worker sent with its stats, for /spans
+SPANS_REPORTED = 64
+
+_CONTEXT = multiprocessing.get_context('forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')
+
+
+class _Outbox:
+    """ Stands in for the sender and the log queue inside a worker, everything goes to the coordinator """
+
+    def __init__(self, results: multiprocessing.Queue) -> None:
+        self.__results = results
+
+    def submit(self, chat_id: str, text: str, location: Optional[Tuple[float, float]]=None, parse_mode: str=ParseMode.HTML, expires: Optional[float]=None) -> bool:
+        self.__results.put(('send', chat_id, text, location, parse_mode, expires))
+        return True
+
+    def put_nowait(self, record: logging.LogRecord) -> None:
+        self.__results.put(('log', record))
+
+
+def _work(index: int, regions: List[Region], subscriptions: Dict[str, str], positions: Dict[str, Position], digests: Dict[str, int], options: dict, commands: multiprocessing.Queue, results: multiprocessing.Queue) -> None:
+    """ Runs a scraper over `regions` until told to stop, reports its stats every `stats_interval` seconds """
+
+    # the forkserver is the parent of the process, not the coordinator
+    coordinator = multiprocessing.parent_process()
+
+    options = dict(options)
+    for name, level in options.pop('log_levels').items():
+        logging.getLogger(name).setLevel(level)
+    stats_interval = options.pop('stats_interval')
+    store_path = options.pop('store_path')
+    claims_path = options.pop('claims_path')
+    history_path = options.pop('history_path')
+
+    # appending to the same files would interleave partial records
+    recorder = HistoryRecorder(history_path, suffix=f'-w{index}') if history_path else None
+
+    outbox = _Outbox(results)
+    # the coordinator handles the records like its own, those of common/ too
+    forward_logging(logging.getLogger(), outbox)
+
+    scraper = OredScraper(
+        outbox,
+        regions=regions,
+        store=open_store(store_path, 'encounters'),
+        claims=open_store(claims_path, 'claims'),
+        sink=outbox.submit,
+        recorder=recorder,
+        **options
+    )
+
+    for chat_id, filters in subscriptions.items():
+        scraper.subscribe(chat_id, filters)
+    for chat_id, position in positions.items():
+        scraper.set_position(chat_id, position)
+    for chat_id, threshold in digests.items():
+        scraper.set_digest(chat_id, threshold)
+
+    scraper.start()
+    log.debug(f'Worker {index} ({os.getpid()}) polls {len(regions)} region(s)')
+
+    try:
+        while scraper.is_running():
+            try:
+                command, *args = commands.get(timeout=stats_interval)
+            except queue.Empty:
+                command, args = None, []
+
+            # nobody left to deliver anything
+            if command == 'stop' or not coordinator.is_alive():
+                break
+            elif command == 'subscribe':
+                scraper.subscribe(*args)
+            elif command == 'unsubscribe':
+                scraper.unsubscribe(*args)
+            elif command == 'position':
+                scraper.set_position(*args)
+            elif command == 'digest':
+                scraper.set_digest(*args)
+            elif command == 'regions':
+                scraper.add_regions(*args)
+
+            results.put(('stats', index, {
+                'dedup': scraper.get_pokes_db_size(),
+                'unreachable': scraper.get_unreachable_count(),
+                'pacers': scraper.get_poll_intervals(),
+                # the stats go out every few seconds, the latest polls are enough
+                'spans': scraper.get_spans(SPANS_REPORTED),
+            }))
+    finally:
+        if scraper.is_running():
+            scraper.stop()
+        if recorder is not None:
+            recorder.close()
+
+
+@dataclass
+class _Worker:
+
+    process: multiprocessing.Process
+    commands: multiprocessing.Queue
+    regions: List[Region] = field(default_factory=list)
+
+
+class ShardedScraper:
+    """ Polls the regions from `workers` processes, see the module docstring """
+
+    def __init__(self, tg_bot: Bot, chat_id: str, workers: int, regions: Optional[Iterable[Region]]=None, planner: Optional[TilePlanner]=None, store_path: str='', claims_path: str='', history_path: str='', position: Optional[Position]=None, speed_kmh: float=15, digest: int=0, delay: int=5, delay_bounds: Tuple[float, float]=(2, 60), max_connections: int=8, stats_interval: float=5, loop: Optional[asyncio.AbstractEventLoop]=None) -> None:
+
+        # tiles are split up once here, they dont get resized while sharded
+        self.__regions = list(regions or []) + (planner.tiles() if planner else [])
+        if not self.__regions:
+            self.__regions = [DEFAULT_REGION]
+
+        self.__worker_count = max(1, min(workers, len(self.__regions)))
+        self.__workers: Dict[int, _Worker] = dict()
+        self.__next_index = 0
+        self.__lock = Lock()
+
+        if not claims_path:
+            # only lives as long as this process, dedup across restarts needs a STORE_PATH anyway
+            fd, claims_path = tempfile.mkstemp(prefix='ored-claims-', suffix='.db')
+            os.close(fd)
+
+        self.__options = dict(
+            chat_id=chat_id, delay=delay, delay_bounds=delay_bounds, max_connections=max_connections,
+            position=position, speed_kmh=speed_kmh, digest=digest, store_path=store_path, claims_path=claims_path, history_path=history_path, stats_interval=stats_interval
+        )
+
+        self.__CHAT_ID = chat_id
+        self.__position = position
+        self.__digest = digest
+
+        # chat_id -> filter text / position / digest threshold, replayed to every new worker
+        self.__subscriptions: Dict[str, str] = dict()
+        self.__positions: Dict[str, Position] = dict()
+        self.__digests: Dict[str, int] = dict()
+
+        # worker index -> its last reported stats
+        self.__stats: Dict[int, dict] = dict()
+
+        self.__results = _CONTEXT.Queue()
+        self.__pump: Optional[Thread] = None
+
+        # the sender needs an event loop, it gets one in a thread of its own unless one is given
+        self.__sender = MessageSender(tg_bot)
+        self.__loop = loop
+        if self.__loop is None:
+            self.__loop = asyncio.new_event_loop()
+            Thread(target=self.__loop.run_forever, name='ored-sender', daemon=True).start()
+
+        self.__running = False
+        self.__stopping = False
+
+    def __log_msg(self, msg_or_err, is_err = False) -> None:
+        log.log(logging.ERROR if is_err else logging.DEBUG, msg_or_err, extra=notify(self.__CHAT_ID))
+
+    def __submit(self, *args) -> None:
+        self.__loop.call_soon_threadsafe(partial(self.__sender.submit, *args))
+
+    def __spawn(self, regions: List[Region]) -> None:
+        """ Starts a worker for these regions, the caller holds the lock """
+
+        index = self.__next_index
+        self.__next_index += 1
+
+        commands = _CONTEXT.Queue()
+        process = _CONTEXT.Process(
+            target=_work,
+            args=(index, regions, dict(self.__subscriptions), dict(self.__positions), dict(self.__digests), dict(self.__options, log_levels={ name: logging.getLogger(name).level for name in ('ored-tg', 'common') }), commands, self.__results),
+            name=f'ored-worker-{index}',
+            daemon=True
+        )
+        process.start()
+
+        self.__workers[index] = _Worker(process, commands, list(regions))
+
+    def __broadcast(self, *command) -> None:
+
+        with self.__lock:
+            for worker in self.__workers.values():
+                worker.commands.put(command)
+
+    def __rebalance(self, regions: List[Region]) -> None:
+        """ Hands the regions of a dead worker to the ones with the fewest regions, the caller holds the lock """
+
+        survivors = [ worker for worker in self.__workers.values() if worker.process.is_alive() ]
+
+        if not survivors:
+            self.__spawn(regions)
+            return
+
+        assigned: Dict[int, List[Region]] = dict()
+        for region in regions:
+            worker = min(survivors, key=lambda w: len(w.regions))
+            worker.regions.append(region)
+            assigned.setdefault(id(worker), []).append(region)
+
+        for worker in survivors:
+            if id(worker) in assigned:
+                worker.commands.put(('regions', assigned[id(worker)]))
+
+    def __check_workers(self) -> None:
+
+        with self.__lock:
+            for index, worker in list(self.__workers.items()):
+                if worker.process.is_alive():
+                    continue
+
+                del self.__workers[index]
+                self.__stats.pop(index, None)
+
+                if self.__stopping:
+                    continue
+
+                # a scraper that stopped itself (e.g. token trouble) would do the same elsewhere
+                if worker.process.exitcode == 0:
+                    log.warning(f'Worker {index} stopped scanning')
+                    continue
+
+                self.__log_msg(f'Worker {index} died ({worker.process.exitcode}), moving its {len(worker.regions)} region(s)', is_err=True)
+                self.__rebalance(worker.regions)
+
+            if not self.__workers:
+                self.__running = False
+
+    def __pump_results(self) -> None:
+        """ Forwards what the workers send and watches them, until the last one is gone
+
+        Then delivers what is still queued and stops the sender, whether the
+        workers were stopped or stopped scanning on their own.
+        """
+
+        while True:
+            try:
+                kind, *args = self.__results.get(timeout=1)
+            except queue.Empty:
+                kind = None
+
+            if kind == 'send':
+                self.__submit(*args)
+            elif kind == 'log':
+                record, = args
+                logging.getLogger(record.name).handle(record)
+            elif kind == 'stats':
+                index, stats = args
+                self.__stats[index] = stats
+
+            self.__check_workers()
+
+            if not self.__workers and kind is None:
+                break
+
+        asyncio.run_coroutine_threadsafe(self.__sender.close(), self.__loop).result()
+
+    def start(self) -> None:
+        """ Splits the regions round robin over the workers and starts them """
+
+        if self.__running:
+            self.__log_msg('Already running')
+            return
+
+        # the workers may have stopped on their own, the sender closes once they are gone
+        if self.__pump is not None:
+            self.__pump.join()
+
+        self.__running = True
+        self.__stopping = False
+        self.__loop.call_soon_threadsafe(self.__sender.start)
+
+        with self.__lock:
+            for i in range(self.__worker_count):
+                self.__spawn(self.__regions[i::self.__worker_count])
+
+        self.__pump = Thread(target=self.__pump_results, name='ored-pump', daemon=True)
+        self.__pump.start()
+        log.debug(f'Started {self.__worker_count} worker(s) for {len(self.__regions)} region(s)')
+
+    def stop(self, timeout: float=15) -> None:
+        """ Stops all workers, delivers what they sent until then """
+
+        if not self.__running:
+            self.__log_msg('Scraper is already stopped!')
+            return
+
+        self.__running = False
+        self.__stopping = True
+
+        with self.__lock:
+            workers = list(self.__workers.values())
+
+        for worker in workers:
+            worker.commands.put(('stop',))
+        for worker in workers:
+            worker.process.join(timeout)
+            if worker.process.is_alive():
+                log.warning(f'Killing {worker.process.name}')
+                worker.process.terminate()
+                worker.process.join()
+
+        # drains the queue, notices the workers are gone and closes the sender
+        self.__pump.join()
+        self.__pump = None
+
+        log.debug('Stopped workers!')
+
+    def subscribe(self, chat_id: str, filters: str) -> None:
+        """ Like `OredScraper.subscribe`, raises ValueError for malformed filters """
+
+        compile_filter(filters)
+
+        with self.__lock:
+            self.__subscriptions[chat_id] = filters
+        self.__broadcast('subscribe', chat_id, filters)
+
+    def unsubscribe(self, chat_id: str) -> int:
+
+        with self.__lock:
+            removed = self.__subscriptions.pop(chat_id, None) is not None
+        if removed:
+            self.__broadcast('unsubscribe', chat_id)
+
+        return len(self.__subscriptions)
+
+    def get_filters(self, chat_id: str) -> Optional[str]:
+        return self.__subscriptions.get(chat_id)
+
+    def get_subscriber_count(self) -> int:
+        return len(self.__subscriptions)
+
+    def set_position(self, chat_id: str, position: Optional[Position]) -> None:
+
+        with self.__lock:
+            if position is None:
+                self.__positions.pop(chat_id, None)
+            else:
+                self.__positions[chat_id] = position
+
+        self.__broadcast('position', chat_id, position)
+
+    def get_position(self, chat_id: str) -> Optional[Position]:
+        return self.__positions.get(chat_id, self.__position)
+
+    def set_digest(self, chat_id: str, threshold: Optional[int]) -> None:
+
+        with self.__lock:
+            if threshold is None:
+                self.__digests.pop(chat_id, None)
+            else:
+                self.__digests[chat_id] = threshold
+
+        self.__broadcast('digest', chat_id, threshold)
+
+    def get_digest(self, chat_id: str) -> int:
+        return self.__digests.get(chat_id, self.__digest)
+
+    def get_unreachable_count(self) -> int:
+        return sum(stats['unreachable'] for stats in list(self.__stats.values()))
+
+    def get_pokes_db_size(self) -> int:
+        """ Summed over the workers, encounters on shard borders count twice """
+        return sum(stats['dedup'] for stats in list(self.__stats.values()))
+
+    def get_sender_stats(self) -> dict:
+        return self.__sender.stats()
+
+    def get_poll_intervals(self) -> Dict[str, AdaptiveInterval]:
+        """ Copies of the pacers, as of the last stats of every worker """
+
+        pacers = dict()
+        for stats in list(self.__stats.values()):
+            pacers.update(stats['pacers'])
+        return pacers
+
+    def get_spans(self, n: Optional[int]=None) -> List[Cycle]:
+        """ The last `n` polls of all workers, as of their last stats """
+
+        spans = sorted((cycle for stats in list(self.__stats.values()) for cycle in stats['spans']), key=lambda cycle: cycle.started)
+        return spans[-n:] if n else spans
+
+    def get_worker_count(self) -> int:
+        return len(self.__workers)
+
+    def is_running(self) -> bool:
+        return self.__running
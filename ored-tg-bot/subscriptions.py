@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+from bisect import bisect_right
+from collections import defaultdict
+import time
+from threading import Lock
+from typing import Dict, FrozenSet, Iterable, List, Optional, Tuple
+
+from decode import Encounter
+from filters import CompiledFilter, Columns, iv_percent
+
+# batches at least this large are filtered with numpy masks (if available)
+VECTORIZE_MIN = 256
+
+
+class _Index:
+    """ Immutable routing snapshot, rebuilt whenever subscriptions change
+
+    Chats with the same filter share one group, so every distinct filter
+    runs once per encounter. Groups are indexed by their `min_iv` and
+    `exempt` species, so only filters that can match an encounter at all
+    are evaluated.
+    """
+
+    def __init__(self, subscriptions: Dict[str, CompiledFilter]) -> None:
+
+        by_text: Dict[str, List[str]] = defaultdict(list)
+        filters: Dict[str, CompiledFilter] = dict()
+
+        for chat_id, flt in subscriptions.items():
+            by_text[flt.text].append(chat_id)
+            filters[flt.text] = flt
+
+        self.groups: List[Tuple[CompiledFilter, List[str]]] = [ (filters[text], chats) for text, chats in by_text.items() ]
+
+        # groups sorted by min_iv, an encounter with x% IV can only match the ones up to x
+        order = sorted(range(len(self.groups)), key=lambda i: self.groups[i][0].min_iv)
+        self.thresholds = [ self.groups[i][0].min_iv for i in order ]
+        self.by_threshold = order
+
+        self.by_species: Dict[int, List[int]] = defaultdict(list)
+        for i, (flt, _) in enumerate(self.groups):
+            for species in flt.exempt:
+                self.by_species[species].append(i)
+
+    def candidates(self, enc: Encounter) -> Iterable[int]:
+
+        iv = iv_percent(enc)
+        upto = bisect_right(self.thresholds, iv if iv is not None else 0)
+
+        exempt = self.by_species.get(enc.pokemon_id)
+        if not exempt:
+            return self.by_threshold[:upto]
+
+        return set(self.by_threshold[:upto]).union(exempt)
+
+
+class SubscriptionIndex:
+    """ Chats and their filters, routes every encounter to the chats it matches """
+
+    def __init__(self) -> None:
+        self.__lock = Lock()
+        self.__subscriptions: Dict[str, CompiledFilter] = dict()
+        self.__index = _Index(self.__subscriptions)
+
+    def subscribe(self, chat_id: str, flt: CompiledFilter) -> None:
+        """ Adds the chat or replaces its filter """
+
+        with self.__lock:
+            self.__subscriptions[chat_id] = flt
+            self.__index = _Index(self.__subscriptions)
+
+    def unsubscribe(self, chat_id: str) -> bool:
+        """ Removes the chat, returns FALSE if it wasnt subscribed """
+
+        with self.__lock:
+            if self.__subscriptions.pop(chat_id, None) is None:
+                return False
+            self.__index = _Index(self.__subscriptions)
+            return True
+
+    def get(self, chat_id: str) -> Optional[CompiledFilter]:
+        return self.__subscriptions.get(chat_id)
+
+    def __len__(self) -> int:
+        return len(self.__subscriptions)
+
+    def upstream(self) -> Tuple[float, FrozenSet[int]]:
+        """ The loosest (min IV, exempt species) that still covers every subscription """
+
+        filters = list(self.__subscriptions.values())
+        if not filters:
+            return 0.0, frozenset()
+
+        return min(flt.min_iv for flt in filters), frozenset().union(*[flt.exempt for flt in filters])
+
+    def route(self, encounters: List[Encounter], now: Optional[float]=None) -> Dict[str, List[Encounter]]:
+        """ Returns chat_id -> the encounters it subscribed to """
+
+        index = self.__index
+        routed: Dict[str, List[Encounter]] = defaultdict(list)
+        now = time.time() if now is None else now
+
+        # large batches: every filter masks the whole batch at once
+        if len(encounters) >= VECTORIZE_MIN and all(flt.mask for flt, _ in index.groups):
+            columns = Columns(encounters)
+
+            for flt, chats in index.groups:
+                matches = [ encounters[i] for i in flt.mask(columns, now).nonzero()[0] ]
+                if matches:
+                    for chat_id in chats:
+                        routed[chat_id].extend(matches)
+
+            return routed
+
+        for enc in encounters:
+            for i in index.candidates(enc):
+                flt, chats = index.groups[i]
+                if flt.predicate(enc, now):
+                    for chat_id in chats:
+                        routed[chat_id].append(enc)
+
+        return routed
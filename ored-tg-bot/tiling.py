@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+import logging
+import math
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from regions import Region
+
+log = logging.getLogger('ored-tg')
+
+# (lat, lng) corners, in order
+Polygon = Sequence[Tuple[float, float]]
+
+KM_PER_DEG_LAT = 111.32
+
+
+def point_in_polygon(lat: float, lng: float, polygon: Polygon) -> bool:
+    """ Ray casting test, points on the border may go either way """
+
+    inside = False
+    j = len(polygon) - 1
+
+    for i in range(len(polygon)):
+        lat_i, lng_i = polygon[i]
+        lat_j, lng_j = polygon[j]
+
+        if (lng_i > lng) != (lng_j > lng) and lat < (lat_j - lat_i) * (lng - lng_i) / (lng_j - lng_i) + lat_i:
+            inside = not inside
+        j = i
+
+    return inside
+
+
+def tile_area_km2(tile: Region) -> float:
+
+    mid_lat = math.radians((tile.sw_lat + tile.ne_lat) / 2)
+    height = (tile.ne_lat - tile.sw_lat) * KM_PER_DEG_LAT
+    width = (tile.ne_lng - tile.sw_lng) * KM_PER_DEG_LAT * math.cos(mid_lat)
+
+    return abs(height * width)
+
+
+class TilePlanner:
+    """ Splits a large scan area into tiles and resizes them from what polls return
+
+    The area is a polygon (or a plain bounding box with two corners). It is
+    covered with a grid of square tiles of `tile_km` edge length, tiles that
+    dont touch the polygon are skipped. Every tile is polled as its own region,
+    so busy tiles get polled more often by their interval pacer.
+
+    After every poll the planner gets the response size: tiles whose responses
+    exceed `max_bytes` are split into as many sub tiles as their bytes per km²
+    suggest, tiles that time out (no size known) as many as the bytes per km²
+    seen over all tiles suggest. Sibling tiles that all stay far below it are
+    merged back.
+
+    Tiles share their borders and the server returns encounters on a border
+    for both of them, so every encounter is only kept by the tile that `owns`
+    its coordinates.
+    """
+
+    def __init__(self, area: Polygon, tile_km: float=2.0, max_bytes: int=500_000, min_tile_km: float=0.25, name: str='tile') -> None:
+
+        if len(area) == 2:
+            (sw_lat, sw_lng), (ne_lat, ne_lng) = area
+            area = [(sw_lat, sw_lng), (sw_lat, ne_lng), (ne_lat, ne_lng), (ne_lat, sw_lng)]
+
+        self.__polygon = list(area)
+        self.__max_bytes = max_bytes
+        self.__min_tile_km = min_tile_km
+        self.__name = name
+
+        # observed response bytes per km², smoothed over all tiles
+        self.bytes_per_km2: Optional[float] = None
+
+        self.__active: Dict[str, Region] = dict()
+        # child name -> parent tile / parent name -> (child names)
+        self.__parents: Dict[str, Region] = dict()
+        self.__children: Dict[str, List[str]] = dict()
+        # last response size of every active tile
+        self.__sizes: Dict[str, int] = dict()
+
+        lats = [lat for lat, _ in self.__polygon]
+        lngs = [lng for _, lng in self.__polygon]
+        for tile in self.__grid(min(lats), min(lngs), max(lats), max(lngs), tile_km, name):
+            if self.__touches(tile):
+                self.__active[tile.name] = tile
+
+        log.debug(f'Planned {len(self.__active)} tiles of {tile_km}km for {name}')
+
+    def __grid(self, sw_lat: float, sw_lng: float, ne_lat: float, ne_lng: float, tile_km: float, prefix: str) -> List[Region]:
+        """ Covers the box with rows x cols tiles of roughly `tile_km` """
+
+        mid_lat = math.radians((sw_lat + ne_lat) / 2)
+        rows = max(1, math.ceil((ne_lat - sw_lat) * KM_PER_DEG_LAT / tile_km))
+        cols = max(1, math.ceil((ne_lng - sw_lng) * KM_PER_DEG_LAT * math.cos(mid_lat) / tile_km))
+
+        d_lat = (ne_lat - sw_lat) / rows
+        d_lng = (ne_lng - sw_lng) / cols
+
+        return [
+            Region(
+                f'{prefix}:{row}:{col}',
+                sw_lat + row * d_lat, sw_lng + col * d_lng,
+                sw_lat + (row + 1) * d_lat, sw_lng + (col + 1) * d_lng
+            )
+            for row in range(rows) for col in range(cols)
+        ]
+
+    def __touches(self, tile: Region) -> bool:
+        """ Whether the tile overlaps the polygon (good enough for tiles smaller than the polygon) """
+
+        corners = [
+            (tile.sw_lat, tile.sw_lng), (tile.sw_lat, tile.ne_lng),
+            (tile.ne_lat, tile.ne_lng), (tile.ne_lat, tile.sw_lng),
+            ((tile.sw_lat + tile.ne_lat) / 2, (tile.sw_lng + tile.ne_lng) / 2)
+        ]
+
+        if any(point_in_polygon(lat, lng, self.__polygon) for lat, lng in corners):
+            return True
+
+        return any(tile.sw_lat <= lat <= tile.ne_lat and tile.sw_lng <= lng <= tile.ne_lng for lat, lng in self.__polygon)
+
+    def tiles(self) -> List[Region]:
+        """ Returns all tiles that should be polled right now """
+        return list(self.__active.values())
+
+    def is_active(self, tile: Region) -> bool:
+        return tile.name in self.__active
+
+    def is_tile(self, region: Region) -> bool:
+        """ Whether the region was planned here (and not configured by hand) """
+        return region.name.startswith(f'{self.__name}:')
+
+    def owns(self, tile: Region, lat: float, lng: float) -> bool:
+        """ Whether an encounter at lat/lng belongs to this tile
+
+        Tiles own their south and west border but not their north and east
+        border, and only points inside the polygon.
+        """
+
+        if not (tile.sw_lat <= lat < tile.ne_lat and tile.sw_lng <= lng < tile.ne_lng):
+            return False
+
+        return point_in_polygon(lat, lng, self.__polygon)
+
+    def observe(self, tile: Region, nbytes: int, timed_out: bool=False) -> List[Region]:
+        """ Records the size of a response for `tile`
+
+        Returns the tiles that replace it (and its siblings) from now on,
+        an empty list means nothing changes.
+        """
+
+        if not self.is_active(tile):
+            return []
+
+        area = tile_area_km2(tile)
+
+        if nbytes and area:
+            density = nbytes / area
+            self.bytes_per_km2 = density if self.bytes_per_km2 is None else 0.8 * self.bytes_per_km2 + 0.2 * density
+
+        self.__sizes[tile.name] = nbytes
+
+        edge_km = math.sqrt(area)
+
+        if (nbytes > self.__max_bytes or timed_out) and edge_km / 2 >= self.__min_tile_km:
+            return self.__split(tile, nbytes)
+
+        return self.__merge(tile)
+
+    def __split(self, tile: Region, nbytes: int) -> List[Region]:
+
+        edge_km = math.sqrt(tile_area_km2(tile))
+
+        # aim for half the limit, timeouts (no size known) are sized from what the other tiles returned,
+        # or just get quartered before any did
+        if nbytes > self.__max_bytes:
+            expected = nbytes
+        elif self.bytes_per_km2 is not None:
+            expected = self.bytes_per_km2 * tile_area_km2(tile)
+        else:
+            expected = 0
+
+        parts = max(2, math.ceil(math.sqrt(2 * expected / self.__max_bytes)))
+
+        child_km = max(self.__min_tile_km, edge_km / parts)
+        children = [
+            child for child in self.__grid(tile.sw_lat, tile.sw_lng, tile.ne_lat, tile.ne_lng, child_km, tile.name)
+            if self.__touches(child)
+        ]
+
+        del self.__active[tile.name]
+        self.__sizes.pop(tile.name, None)
+
+        self.__children[tile.name] = [child.name for child in children]
+        for child in children:
+            self.__parents[child.name] = tile
+            self.__active[child.name] = child
+
+        log.debug(f'Split {tile.name} ({nbytes} bytes) into {len(children)} tiles of {child_km:.2f}km')
+        return children
+
+    def __merge(self, tile: Region) -> List[Region]:
+
+        parent = self.__parents.get(tile.name)
+        if parent is None:
+            return []
+
+        siblings = self.__children[parent.name]
+
+        # only once all siblings reported, and all of them together are still small
+        if any(name not in self.__sizes for name in siblings):
+            return []
+        if sum(self.__sizes[name] for name in siblings) > self.__max_bytes / 4:
+            return []
+
+        for name in siblings:
+            self.__active.pop(name, None)
+            self.__sizes.pop(name, None)
+            del self.__parents[name]
+        del self.__children[parent.name]
+
+        self.__active[parent.name] = parent
+
+        log.debug(f'Merged {len(siblings)} tiles back into {parent.name}')
+        return [parent]
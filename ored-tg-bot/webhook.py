@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+""" Receives the bot's updates over a webhook instead of long polling getUpdates
+
+Telegram posts every update as JSON to the url set with `setWebhook`, a
+small aiohttp server takes them on the event loop the scraper and the send
+queue run on. Handlers stay the synchronous ones of the dispatcher, they
+run one after another (like with polling) in a single thread of their own,
+so a slow reply never holds up the polls.
+
+Telegram only talks HTTPS (on 443, 80, 88 or 8443), the server speaks plain
+HTTP and is meant to sit behind a reverse proxy terminating TLS. Requests
+without the secret token given to `setWebhook` are turned away. Locally it
+can be fed by hand:
+
+    curl -H 'X-Telegram-Bot-Api-Secret-Token: SECRET' -H 'Content-Type: application/json' \\
+        -d '{"update_id": 1, "message": {"message_id": 1, "date": 0, "chat": {"id": 123, "type": "private"}, "text": "/ping"}}' \\
+        http://127.0.0.1:8443/PATH
+"""
+
+import asyncio
+import hmac
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from aiohttp import web
+from telegram import Update
+from telegram.ext import Dispatcher
+
+from common.metrics import REGISTRY
+
+log = logging.getLogger('ored-tg')
+
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+WEBHOOK_UPDATES = REGISTRY.counter('ored_webhook_updates', 'Updates posted to the webhook by outcome', ['outcome'])
+
+
+class WebhookServer:
+    """ Serves `path` on `host`:`port`, hands every update posted there to `dispatcher` """
+
+    def __init__(self, dispatcher: Dispatcher, path: str, secret_token: str, host: str='127.0.0.1', port: int=8443, max_body: int=1024 * 1024) -> None:
+        self.__dispatcher = dispatcher
+        self.__path = path
+        self.__secret = secret_token.encode()
+        self.__host = host
+        self.__port = port
+        self.__max_body = max_body
+
+        # updates are handled in order, like the dispatcher thread does when polling
+        self.__handlers = ThreadPoolExecutor(max_workers=1, thread_name_prefix='ored-updates')
+        self.__runner: Optional[web.AppRunner] = None
+
+    async def __receive(self, request: web.Request) -> web.Response:
+
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, '').encode(), self.__secret):
+            WEBHOOK_UPDATES.labels('forbidden').inc()
+            log.warning(f'Webhook request from {request.remote} without the secret token')
+            return web.Response(status=403)
+
+        try:
+            data = json.loads(await request.read())
+            update = Update.de_json(data, self.__dispatcher.bot)
+        except (ValueError, TypeError, KeyError) as err:
+            WEBHOOK_UPDATES.labels('malformed').inc()
+            log.error(f'Malformed update posted to the webhook: {err!r}')
+            return web.Response(status=400)
+
+        if update is None:
+            WEBHOOK_UPDATES.labels('malformed').inc()
+            return web.Response(status=400)
+
+        WEBHOOK_UPDATES.labels('ok').inc()
+
+        # Telegram only waits for the 200, not for the reply
+        asyncio.get_running_loop().run_in_executor(self.__handlers, self.__dispatcher.process_update, update)
+        return web.Response()
+
+    async def start(self) -> None:
+
+        app = web.Application(client_max_size=self.__max_body)
+        app.router.add_post(self.__path, self.__receive)
+
+        self.__runner = web.AppRunner(app, access_log=None)
+        await self.__runner.setup()
+        await web.TCPSite(self.__runner, self.__host, self.__port).start()
+
+        log.debug(f'Receiving updates on http://{self.__host}:{self.__port}{self.__path}')
+
+    async def close(self) -> None:
+        """ Stops taking updates, waits for the ones being handled """
+
+        if self.__runner is not None:
+            await self.__runner.cleanup()
+            self.__runner = None
+
+        # a handler might be waiting for the event loop itself, e.g. stopping the scraper
+        await asyncio.get_running_loop().run_in_executor(None, self.__handlers.shutdown)
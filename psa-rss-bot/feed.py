@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# -*- coding: UTF-8 -*-
+
+from typing import (AsyncIterable, AsyncIterator, Iterable, Iterator, List,
+                    NamedTuple, Optional, Tuple, Union)
+from xml.etree.ElementTree import Element, ParseError, XMLPullParser
+
+# markers for `FeedStream.__step`
+_MORE = object()
+_END = object()
+
+
+class Item(NamedTuple):
+    """ The parts of a feed item the reader cares about """
+
+    guid: str
+    title: str
+    pub_date: str
+    categories: List[str]
+
+
+def parse_soup(content: bytes) -> Tuple[Optional[str], List[Item]]:
+    """ Parses the whole feed with BeautifulSoup
+
+    Returns the lastBuildDate (None if missing) and all items.
+    """
+
+    from bs4 import BeautifulSoup
+
+    feed = BeautifulSoup(content, 'xml') # using lxml strips the CDATA stuff!!!
+
+    last_build_tag = feed.find('lastBuildDate')
+    if not last_build_tag:
+        return None, []
+
+    items = [
+        Item(
+            item.find('guid').string,
+            item.find('title').string,
+            item.find('pubDate').string,
+            [ cat.string for cat in item.find_all('category') ]
+        )
+        for item in feed.find_all('item')
+    ]
+
+    return last_build_tag.string, items
+
+
+class FeedStream:
+    """ Parses a feed incrementally while its bytes come in
+
+    `chunks` is either an iterable or an async iterable of bytes. Call
+    `read_header` (or `aread_header`) first to get the lastBuildDate, then
+    iterate over the stream (with `for` or `async for`) to get the items
+    one at a time. Parsing (and with it reading from `chunks`) stops as
+    soon as the caller stops iterating.
+
+    Reading the header raises `ParseError` if the response is not a feed,
+    e.g. when blocked by cloudflare. A feed that breaks off later just ends
+    the iteration and leaves the error in `error`.
+    """
+
+    def __init__(self, chunks: Union[Iterable[bytes], AsyncIterable[bytes]]) -> None:
+        self.__chunks = chunks
+        self.__chunk_iter = None
+        self.__parser = XMLPullParser(events=('start', 'end'))
+        self.__done = False
+        self.__channel: Optional[Element] = None
+        self.last_build_date: Optional[str] = None
+        self.error: Optional[ParseError] = None
+
+    def __step(self, header: bool):
+        """ Handles the events parsed so far
+
+        Returns the lastBuildDate (or None if the first item comes first)
+        when reading the `header`, otherwise the next item. Returns `_MORE`
+        if that needs more data and `_END` once the feed is done.
+        """
+
+        for event, elem in self.__parser.read_events():
+
+            if event == 'start':
+                if elem.tag == 'channel':
+                    self.__channel = elem
+                elif elem.tag == 'item' and header:
+                    return None
+                continue
+
+            if header:
+                if elem.tag == 'lastBuildDate' and self.__channel is not None:
+                    return elem.text
+                continue
+
+            if elem.tag == 'item':
+                item = Item(
+                    elem.findtext('guid'),
+                    elem.findtext('title'),
+                    elem.findtext('pubDate'),
+                    [ cat.text for cat in elem.findall('category') ]
+                )
+
+                # drop finished items, so memory stays flat no matter how long the feed is
+                if self.__channel is not None:
+                    self.__channel.remove(elem)
+
+                return item
+
+        return _END if self.__done else _MORE
+
+    def __feed(self, chunk: Optional[bytes]) -> None:
+
+        if chunk is None:
+            self.__done = True
+            self.__parser.close()
+        else:
+            self.__parser.feed(chunk)
+
+    def __pull(self, header: bool):
+
+        if self.__chunk_iter is None:
+            self.__chunk_iter = iter(self.__chunks)
+
+        while True:
+            result = self.__step(header)
+            if result is not _MORE:
+                return result
+            self.__feed(next(self.__chunk_iter, None))
+
+    async def __apull(self, header: bool):
+
+        if self.__chunk_iter is None:
+            self.__chunk_iter = self.__chunks.__aiter__()
+
+        while True:
+            result = self.__step(header)
+            if result is not _MORE:
+                return result
+            try:
+                chunk = await self.__chunk_iter.__anext__()
+            except StopAsyncIteration:
+                chunk = None
+            self.__feed(chunk)
+
+    def read_header(self) -> Optional[str]:
+        """ Reads until the lastBuildDate of the channel (or the first item) and returns it """
+
+        header = self.__pull(True)
+        self.last_build_date = None if header is _END else header
+        return self.last_build_date
+
+    async def aread_header(self) -> Optional[str]:
+        """ Same as `read_header`, for async chunks """
+
+        header = await self.__apull(True)
+        self.last_build_date = None if header is _END else header
+        return self.last_build_date
+
+    def __iter__(self) -> Iterator[Item]:
+
+        try:
+            while True:
+                item = self.__pull(False)
+                if item is _END:
+                    return
+                yield item
+        except ParseError as pe:
+            self.error = pe
+
+    async def __aiter__(self) -> AsyncIterator[Item]:
+
+        try:
+            while True:
+                item = await self.__apull(False)
+                if item is _END:
+                    return
+                yield item
+        except ParseError as pe:
+            self.error = pe
@@ -1,38 +1,53 @@
 #!/usr/bin/env python3
 # -*- coding: UTF-8 -*-
 
+import asyncio
 import logging
 import os
+import random
 import re
 import signal
 import sys
 import time
 from datetime import datetime
+from functools import partial
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlparse
 
-import requests
-from bs4 import BeautifulSoup
+import aiohttp
 
 from telegram import ParseMode, Bot
 from telegram.error import InvalidToken as TelegramInvalidTokenError
 from telegram.ext import Updater
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from common.logs import ALERTED, TelegramAlertHandler, rotating_file, start_logging
+from common.metrics import REGISTRY, start_exporter
+from common.resilience import ErrorAggregator, backoff, circuit
+from common.store import open_store
+from feed import FeedStream, ParseError, parse_soup
+
 log = logging.getLogger('rss')
 log.setLevel(logging.DEBUG)
 
-fh = logging.FileHandler('./rss.log', 'w', 'utf-8')
-ch = logging.StreamHandler()
+# set once the token checked out, alerts before only get logged
+BOT: Optional[Bot] = None
 
-fh.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+def send_alert(chat_id, text: str):
+    """ Runs on the logging thread, not on the event loop """
+    if BOT is not None:
+        BOT.send_message(chat_id=chat_id, text=text)
+
+fh = rotating_file(os.environ.get('RSS_LOG_PATH', './rss.log'), formatter=logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+ch = logging.StreamHandler()
 ch.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s', '%H:%M:%S'))
 
-log.addHandler(fh)
-log.addHandler(ch)
+# errors that werent sent already go to the chat as well, see common/logs.py.
+# on the root logger, so common/ and the libraries dont log into the void
+logging.getLogger('common').setLevel(logging.INFO)
+start_logging(logging.getLogger(), fh, ch, TelegramAlertHandler(send_alert, os.environ.get('TELEGRAM_CHAT_MYSELF_ID'), interval=6 * 3600))
 
-try:
-    PSA_FEED = os.environ['PSA_FEED_URL']
-except KeyError:
-    log.error('No feed url found!')
-    sys.exit(-1)
+FEEDS: List['Feed'] = []
 
 try:
     CHAT_ME = os.environ['TELEGRAM_CHAT_MYSELF_ID']
@@ -40,64 +55,195 @@ except KeyError:
     log.error('No chat ID found!')
     sys.exit(-1)
 
+# 'stream' parses items while they download and stops at the first known one,
+# 'soup' builds the whole BeautifulSoup tree first
+PARSER = os.environ.get('RSS_PARSER', 'stream')
+CHUNK_SIZE = 16 * 1024
+
+# default seconds between two polls of a feed, unchanged polls are cheap thanks to conditional requests
+POLL_INTERVAL = int(os.environ.get('RSS_POLL_INTERVAL', 3600))
+
+# polls are spread randomly by this fraction of the interval, so feeds dont fire in lockstep
+POLL_JITTER = 0.1
+
+# all feeds share one connection pool
+MAX_CONNECTIONS = int(os.environ.get('RSS_MAX_CONNECTIONS', 10))
+MAX_CONNECTIONS_PER_HOST = int(os.environ.get('RSS_MAX_CONNECTIONS_PER_HOST', 2))
+
+# aiohttp negotiates gzip/deflate on its own, and brotli if the brotli package is installed
+HEADERS = { 'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X x.y; rv:42.0) Gecko/20100101 Firefox/42.0' }
+
 IGNORE_PATTERN = re.compile(r'psa|x265|hevc|\d{4}', flags=re.IGNORECASE)
 ESCAPE_CHARS = re.compile(r'(\(|\)|\[|\]|\.|\=)')
 GUID_PATTERN = re.compile(r'\?p\=(?P<guid>\d+)$')
 
-DB = dict()
-previousLast = ''
+# remember articles for this long, so restarts dont announce the whole feed again
+DB_TTL = 30 * 24 * 3600
+LAST_BUILD_KEY = 'lastBuildDate'
+ETAG_KEY = 'etag'
+LAST_MODIFIED_KEY = 'lastModified'
+
+# Prometheus metrics on http://127.0.0.1:RSS_METRICS_PORT/metrics and/or in a textfile, off by default
+METRICS_PORT = int(os.environ.get('RSS_METRICS_PORT', 0))
+METRICS_TEXTFILE = os.environ.get('RSS_METRICS_TEXTFILE')
+
+POLLS = REGISTRY.counter('rss_polls', 'Feed polls by outcome: changed, unchanged, not_modified, blocked, broken or failed', ['feed', 'outcome'])
+POLL_SECONDS = REGISTRY.histogram('rss_poll_seconds', 'Duration of a feed poll, from request to processed', ['feed'])
+ARTICLES = REGISTRY.counter('rss_articles', 'New or updated articles announced', ['feed'])
+SEND_SECONDS = REGISTRY.histogram('rss_telegram_send_seconds', 'Duration of Telegram sends')
+SEND_ERRORS = REGISTRY.counter('rss_telegram_errors', 'Failed Telegram sends by error', ['error'])
+
+# the first failure of a feed is sent right away, repeats in a summary every few hours
+ALERTS = ErrorAggregator(interval=6 * 3600)
+
+class Feed:
+    """ One feed with its own poll interval and dedup state """
+
+    def __init__(self, name: str, url: str, interval: int, store_path: str=None) -> None:
+        self.name = name
+        self.url = url
+        self.interval = interval
+
+        # feeds on the same host share it, a host that is down isnt asked again until a probe is due
+        self.breaker = circuit(urlparse(url).hostname or url, failure_threshold=3, reset_timeout=300, max_reset_timeout=6 * 3600)
+
+        self.store = open_store(store_path, name)
+
+        self.db: Dict[str, str] = { key: value for key, (value, _) in self.store.load().items() }
+        self.previous_last = self.db.pop(LAST_BUILD_KEY, '')
+        self.previous_etag = self.db.pop(ETAG_KEY, '')
+        self.previous_modified = self.db.pop(LAST_MODIFIED_KEY, '')
+
+    def remember_validators(self, r: aiohttp.ClientResponse) -> None:
+        """ Keeps ETag and Last-Modified of a processed response for the next conditional request """
+
+        self.previous_etag = r.headers.get('ETag', '')
+        self.previous_modified = r.headers.get('Last-Modified', '')
+
+        self.store.put(ETAG_KEY, self.previous_etag, time.time() + DB_TTL)
+        self.store.put(LAST_MODIFIED_KEY, self.previous_modified, time.time() + DB_TTL)
+
+def feeds_from_env() -> List[Tuple[str, str, int]]:
+    """ Returns (name, url, interval) for every configured feed
+
+    `PSA_FEED_URL` is polled every `RSS_POLL_INTERVAL` seconds, `RSS_FEEDS`
+    adds more feeds as comma separated "url [interval]" entries.
+    """
+
+    feeds = []
+
+    if os.environ.get('PSA_FEED_URL'):
+        feeds.append(('psa', os.environ['PSA_FEED_URL'], POLL_INTERVAL))
+
+    for entry in os.environ.get('RSS_FEEDS', '').split(','):
+        parts = entry.split()
+        if parts:
+            feeds.append((parts[0], parts[0], int(parts[1]) if len(parts) > 1 else POLL_INTERVAL))
+
+    return feeds
 
 def shut_down(signal, frame):
     log.info('Killed.')
+    for feed in FEEDS:
+        feed.store.close()
     sys.exit(0)
 
-def work(bot: Bot):
-
-    global previousLast
-    log.info('Requesting...')
+async def send(bot: Bot, text: str, parse_mode: str):
+    """ Sends a message on a worker thread, so the other feeds keep polling """
 
     try:
-        r = requests.get(PSA_FEED, headers={ 'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X x.y; rv:42.0) Gecko/20100101 Firefox/42.0' })
-    except requests.RequestException as rex:
-        log.error(f'Failed to get feed because {rex}')
-        bot.send_message(chat_id=CHAT_ME, text=f'REQUEST FAILED\n{rex}', parse_mode=ParseMode.HTML)
-        return
+        with SEND_SECONDS.time():
+            await asyncio.get_running_loop().run_in_executor(None, partial(bot.send_message, chat_id=CHAT_ME, text=text, parse_mode=parse_mode))
+    except Exception as err:
+        SEND_ERRORS.labels(type(err).__name__).inc()
+        raise
+
+async def alert(bot: Bot, feed: Feed, text: str, parse_mode: str):
+    """ Counts a failed poll, sends the text if it is the first failure of the feed """
 
-    feed = BeautifulSoup(r.content, 'xml') # using lxml strips the CDATA stuff!!!
+    # feeds of one host share its breaker, each counts its own failures in a row
+    feed.breaker.failure(feed.name)
 
-    # with open('./testfeed.rss', 'r') as rssin:
-    #     feed = BeautifulSoup(rssin, 'xml')
+    text = ALERTS.report(feed.name, text)
+    if text:
+        await send(bot, text, parse_mode)
 
-    last_build_tag = feed.find('lastBuildDate')
+async def recovered(bot: Bot, feed: Feed):
 
-    if not last_build_tag:
-        log.error(f'Failed to get feed because cloudflare')
-        bot.send_message(chat_id=CHAT_ME, text='*BLOCKED BY CLOUDFLARE*', parse_mode=ParseMode.MARKDOWN_V2)
+    feed.breaker.success(feed.name)
+
+    text = ALERTS.resolve(feed.name)
+    if text:
+        await send(bot, text, None)
+
+async def work(bot: Bot, session: aiohttp.ClientSession, feed: Feed):
+
+    if not feed.breaker.allow():
+        POLLS.labels(feed.name, 'skipped').inc()
+        log.info(f'Skipping {feed.name}, {feed.breaker.name} is down')
+        return
+
+    log.info(f'Requesting {feed.name}...')
+
+    headers = dict(HEADERS)
+    if feed.previous_etag:
+        headers['If-None-Match'] = feed.previous_etag
+    if feed.previous_modified:
+        headers['If-Modified-Since'] = feed.previous_modified
+
+    try:
+        with POLL_SECONDS.labels(feed.name).time():
+            async with session.get(feed.url, headers=headers) as r:
+                await handle(bot, feed, r)
+    except (aiohttp.ClientError, asyncio.TimeoutError) as rex:
+        POLLS.labels(feed.name, 'failed').inc()
+        log.error(f'Failed to get feed {feed.name} because {rex!r}', extra=ALERTED)
+        await alert(bot, feed, f'REQUEST FAILED\n{rex!r}', ParseMode.HTML)
+
+async def handle(bot: Bot, feed: Feed, r: aiohttp.ClientResponse):
+
+    # nothing changed since the last processed response, skip parsing altogether
+    if r.status == 304:
+        POLLS.labels(feed.name, 'not_modified').inc()
+        log.info(f'{feed.name}: Not modified')
+        await recovered(bot, feed)
         return
 
+    if PARSER == 'soup':
+        last, items = parse_soup(await r.read())
+    else:
+        items = FeedStream(r.content.iter_chunked(CHUNK_SIZE))
+        try:
+            last = await items.aread_header()
+        except ParseError:
+            last = None
+
+    if not last:
+        POLLS.labels(feed.name, 'blocked').inc()
+        log.error(f'Failed to get feed {feed.name} because cloudflare', extra=ALERTED)
+        await alert(bot, feed, '*BLOCKED BY CLOUDFLARE*', ParseMode.MARKDOWN_V2)
+        return
 
-    last = last_build_tag.string
+    await recovered(bot, feed)
 
-    if last != previousLast:
+    if last != feed.previous_last:
 
         last_build = datetime.strptime(last, '%a, %d %b %Y %H:%M:%S %z')
         last_build_formatted = last_build.astimezone().strftime('%d.%m.%Y %H:%M:%S')
-        log.info(f'New feed from {last_build_formatted}')
-
-        lbf = last_build_formatted.replace('.', '\.')
+        log.info(f'New feed {feed.name} from {last_build_formatted}')
 
         articles = []
 
-        for item in feed.find_all('item'):
+        async for item in aiter_items(items):
 
-            short_link = item.find('guid').string
-            article_name = item.find('title').string
-            updated_at = item.find('pubDate').string
+            short_link = item.guid
+            article_name = item.title
+            updated_at = item.pub_date
 
             dt = datetime.strptime(updated_at, '%a, %d %b %Y %H:%M:%S %z')
             dt_formatted = dt.astimezone().strftime('%H:%M:%S')
 
-            categories = [ cat.string.strip() for cat in item.find_all('category') if not re.search(IGNORE_PATTERN, cat.string) ]
+            categories = [ cat.strip() for cat in item.categories if not re.search(IGNORE_PATTERN, cat) ]
 
             m = re.search(GUID_PATTERN, short_link)
             if not m:
@@ -105,10 +251,14 @@ def work(bot: Bot):
                 continue
 
             guid = m.group('guid')
-            entry = DB.get(guid)
+            entry = feed.db.get(guid)
 
             if entry == dt_formatted:
                 log.info(f'UNCHANGED: {article_name}')
+
+                # newest items come first, so the rest is known as well
+                if PARSER == 'stream':
+                    break
                 continue
 
             log.info(f'{"NEW" if entry is None else "UPDATED"}: {article_name} ({short_link}) at {dt_formatted}')
@@ -116,15 +266,73 @@ def work(bot: Bot):
             escaped_article_name = re.sub(ESCAPE_CHARS, r'\\\1', article_name)
             articles.append(f'[{escaped_article_name}]({short_link}) um _{dt_formatted}_')
 
-            DB[guid] = dt_formatted
+            feed.db[guid] = dt_formatted
+            feed.store.put(guid, dt_formatted, time.time() + DB_TTL)
 
-        if len(articles):
-            bot.send_message(chat_id=CHAT_ME, text='\n'.join(articles), parse_mode=ParseMode.MARKDOWN_V2)
+        ARTICLES.labels(feed.name).inc(len(articles))
 
-        previousLast = last
+        if len(articles):
+            await send(bot, '\n'.join(articles), ParseMode.MARKDOWN_V2)
+
+        if PARSER == 'stream' and items.error:
+            # keep previous_last, so the next poll reads the feed again
+            POLLS.labels(feed.name, 'broken').inc()
+            log.error(f'Feed {feed.name} broke off: {items.error}')
+            feed.store.flush()
+            return
+
+        POLLS.labels(feed.name, 'changed').inc()
+        feed.previous_last = last
+        feed.store.put(LAST_BUILD_KEY, last, time.time() + DB_TTL)
+        feed.remember_validators(r)
+        feed.store.flush()
     else:
-        log.info('Nothing changed')
-        bot.send_message(chat_id=CHAT_ME, text='_Nothing changed_', parse_mode=ParseMode.MARKDOWN_V2)
+        POLLS.labels(feed.name, 'unchanged').inc()
+        log.info(f'{feed.name}: Nothing changed')
+        feed.remember_validators(r)
+        feed.store.flush()
+        await send(bot, '_Nothing changed_', ParseMode.MARKDOWN_V2)
+
+async def aiter_items(items):
+    """ Iterates over a parsed item list or a `FeedStream` alike """
+
+    if isinstance(items, list):
+        for item in items:
+            yield item
+    else:
+        async for item in items:
+            yield item
+
+async def poll(bot: Bot, session: aiohttp.ClientSession, feed: Feed):
+    """ Polls one feed forever, on its own interval with some jitter """
+
+    # dont start all feeds at the same moment
+    await asyncio.sleep(random.uniform(0, POLL_JITTER * feed.interval))
+
+    while True:
+        try:
+            await work(bot, session, feed)
+
+            for summary in ALERTS.flush():
+                await send(bot, summary, None)
+        except Exception:
+            log.exception(f'Polling {feed.name} failed')
+
+        delay = feed.interval * random.uniform(1 - POLL_JITTER, 1 + POLL_JITTER)
+        if feed.breaker.failures:
+            # a failed poll is retried sooner, but not before the circuit lets it through
+            delay = max(min(delay, backoff(feed.breaker.failures - 1, base=60, cap=feed.interval)), feed.breaker.retry_in())
+
+        await asyncio.sleep(delay)
+
+async def run(bot: Bot):
+    """ Polls all feeds concurrently over one shared connection pool """
+
+    connector = aiohttp.TCPConnector(limit=MAX_CONNECTIONS, limit_per_host=MAX_CONNECTIONS_PER_HOST)
+    timeout = aiohttp.ClientTimeout(sock_connect=30, sock_read=30)
+
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        await asyncio.gather(*[ poll(bot, session, feed) for feed in FEEDS ])
 
 def main():
 
@@ -140,9 +348,21 @@ def main():
         log.error(f'API Token {token} is not valid!')
         sys.exit(-1)
 
-    while True:
-        work(updater.bot)
-        time.sleep(3600)
+    feeds = feeds_from_env()
+    if not feeds:
+        log.error('No feed url found!')
+        sys.exit(-1)
+
+    store_path = os.environ.get('RSS_STORE_PATH')
+    FEEDS.extend(Feed(name, url, interval, store_path) for name, url, interval in feeds)
+    log.info(f'Polling {len(FEEDS)} feed(s)')
+
+    global BOT
+    BOT = updater.bot
+
+    start_exporter(METRICS_PORT, METRICS_TEXTFILE)
+
+    asyncio.run(run(updater.bot))
 
 if __name__ == '__main__':
     signal.signal(signal.SIGINT, shut_down)